@@ -0,0 +1,134 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+from deid_export.container_cache import CONTAINER_CACHE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_THREADS = 8
+DEFAULT_MAX_CONCURRENCY = 64
+
+
+class AsyncFlywheelClient:
+    """An asyncio adapter for the Flywheel client operations used by the exporter.
+
+    The Flywheel SDK is synchronous, so each call is run on a small shared thread pool and at most max_threads
+    requests are sent at once. Up to max_concurrency calls may be awaited at once; calls beyond the number of threads
+    wait in the pool's queue instead of each holding a thread, so a large number of pending requests is multiplexed
+    on max_threads threads. The pool is shut down by close().
+    """
+    def __init__(self, fw_client, max_threads=DEFAULT_MAX_THREADS, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """
+        Args:
+            fw_client (flywheel.Client): an instance of the flywheel client
+            max_threads (int): the number of threads on which calls are made
+            max_concurrency (int): the maximum number of calls awaited at once
+        """
+        self.fw_client = fw_client
+        self.max_concurrency = max_concurrency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads,
+                                                               thread_name_prefix='async_flywheel')
+        # created for each event loop on which calls are made, since a semaphore belongs to the loop that uses it
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) on the thread pool and returns its result
+
+        Args:
+            func (callable): the synchronous function to call
+            *args: positional arguments for func
+            **kwargs: keyword arguments for func
+
+        Returns:
+            the return value of func
+        """
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        async with self._semaphore:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            try:
+                return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+            finally:
+                self.in_flight -= 1
+
+    async def get(self, container_id):
+        return await self.run(self.fw_client.get, container_id)
+
+    async def reload(self, container):
+        """Reloads container through the shared container cache"""
+        return await self.run(CONTAINER_CACHE.reload, container)
+
+    async def find_first(self, finder, query):
+        """Returns the first result of query for finder (e.g. project.subjects), or None"""
+        return await self.run(finder.find_first, query)
+
+    async def add_subject(self, project, **kwargs):
+        subject = await self.run(project.add_subject, **kwargs)
+        CONTAINER_CACHE.invalidate(project.id)
+        return subject
+
+    async def add_session(self, subject, **kwargs):
+        session = await self.run(subject.add_session, **kwargs)
+        CONTAINER_CACHE.invalidate(subject.id)
+        return session
+
+    async def add_acquisition(self, session, **kwargs):
+        acquisition = await self.run(session.add_acquisition, **kwargs)
+        CONTAINER_CACHE.invalidate(session.id)
+        return acquisition
+
+    async def download_file(self, file_obj, dest_path):
+        """Downloads file_obj (a file of a container) to dest_path"""
+        return await self.run(file_obj.download, dest_path)
+
+    async def read_file(self, file_obj):
+        """Returns the content of file_obj (a file of a container)"""
+        return await self.run(file_obj.read)
+
+    async def delete_file(self, container, filename):
+        try:
+            return await self.run(container.delete_file, filename)
+        finally:
+            CONTAINER_CACHE.invalidate(container.id)
+
+    async def upload_file(self, container, file_path):
+        try:
+            return await self.run(container.upload_file, file_path)
+        finally:
+            CONTAINER_CACHE.invalidate(container.id)
+
+    async def update_file_info(self, container, filename, info):
+        try:
+            return await self.run(container.update_file_info, filename, info)
+        finally:
+            CONTAINER_CACHE.invalidate(container.id)
+
+    async def update_file(self, container, filename, metadata):
+        try:
+            return await self.run(container.update_file, filename, metadata)
+        finally:
+            CONTAINER_CACHE.invalidate(container.id)
+
+    async def get_job_logs(self, job_id):
+        return await self.run(self.fw_client.get_job_logs, job_id)
+
+    def get_counts(self):
+        """Returns a dictionary of the number of calls made and the maximum number awaited at once"""
+        return {
+            'async_calls': self.calls,
+            'async_max_in_flight': self.max_in_flight
+        }
+
+    def close(self):
+        """Shuts down the thread pool once the calls made on it have returned"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,320 @@
+import asyncio
+import concurrent.futures
+import copy
+import functools
+import logging
+import os
+import time
+
+from deid_export.async_client import DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_THREADS, AsyncFlywheelClient
+from deid_export.container_export import SessionExporter, load_template_dict, run_session_export_task
+from deid_export.export_summary import ExportSummary
+from deid_export.origin_snapshot import OriginSnapshot
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSessionExporter(SessionExporter):
+    """A SessionExporter that downloads, de-identifies and uploads a session's files concurrently on an asyncio event
+    loop.
+
+    API calls are made through an AsyncFlywheelClient, which may be shared by the exporters of many sessions so that
+    their requests are bounded and multiplexed together on its thread pool. Files are de-identified on a separate
+    executor, so that de-identification does not hold the threads on which requests are made.
+    """
+    def __init__(self, fw_client, template_dict, origin_session, dest_proj_id, async_client=None, deid_executor=None,
+                 **kwargs):
+        """
+        Args:
+            fw_client (flywheel.Client): an instance of the flywheel client
+            template_dict (dict): the de-identification template
+            origin_session (flywheel.Session): the session to export
+            dest_proj_id (str): the id of the project to which to export
+            async_client (AsyncFlywheelClient): the client on which to make calls, one is created (and closed by
+                close()) if not provided
+            deid_executor (concurrent.futures.Executor): the executor on which to de-identify files, a single thread
+                is created (and shut down by close()) if not provided
+            **kwargs: additional keyword arguments for SessionExporter
+        """
+        super().__init__(fw_client, template_dict, origin_session, dest_proj_id, **kwargs)
+        self._owns_async_client = async_client is None
+        self.async_client = async_client or AsyncFlywheelClient(fw_client)
+        self._owns_deid_executor = deid_executor is None
+        if deid_executor is None:
+            deid_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='async_deid')
+        self.deid_executor = deid_executor
+
+    async def initialize_files_async(self, subject_files=False, project_files=False, overwrite=False):
+        # containers are found or created in order, since later containers are children of earlier ones
+        return await self.async_client.run(self.initialize_files, subject_files=subject_files,
+                                           project_files=project_files, overwrite=overwrite)
+
+    async def reload_dest_async(self, file_exporter):
+        """Reloads the destination parent of a file and returns the destination file, or None if it does not exist"""
+        file_exporter.dest_parent = await self.async_client.reload(file_exporter.dest_parent)
+        file_exporter.dest = file_exporter.dest_parent.get_file(file_exporter.filename) if file_exporter.filename \
+            else None
+        return file_exporter.dest
+
+    async def deidentify_async(self, file_exporter, previous_reserved, reserved):
+        """
+        Downloads a file through the async client, then de-identifies it on the de-identification executor
+        Args:
+            file_exporter (FileExporter): the file to de-identify
+            previous_reserved (asyncio.Event): set once the previous file has reserved its spool space, or None
+            reserved (asyncio.Event): set once this file has reserved its spool space
+        """
+        loop = asyncio.get_running_loop()
+        in_memory = file_exporter.can_deidentify_in_memory(self.deid_profile)
+        # Spool space is reserved in file order, so a file waiting for the files before it to be checked for
+        # collisions never holds space that they are waiting for
+        try:
+            if previous_reserved is not None:
+                await previous_reserved.wait()
+            if not in_memory:
+                # waiting for spool space holds neither a request thread nor a de-identification thread
+                await loop.run_in_executor(None, file_exporter.reserve_spool)
+        finally:
+            reserved.set()
+
+        start = time.monotonic()
+        try:
+            if in_memory:
+                origin_content = await self.async_client.read_file(file_exporter.origin)
+                file_exporter.record_stage('download', time.monotonic() - start, len(origin_content))
+                deid_kwargs = {'origin_content': origin_content}
+            else:
+                local_file_path = file_exporter.get_download_path()
+                await self.async_client.download_file(file_exporter.origin, local_file_path)
+                file_exporter.record_stage('download', time.monotonic() - start, os.path.getsize(local_file_path))
+                deid_kwargs = {'local_file_path': local_file_path}
+        except BaseException:
+            file_exporter.cleanup()
+            raise
+        await loop.run_in_executor(self.deid_executor,
+                                   functools.partial(file_exporter.deidentify, self.deid_profile, **deid_kwargs))
+
+    async def upload_async(self, file_exporter):
+        """Uploads a de-identified file through the async client, as FileExporter.upload"""
+        if await self.reload_dest_async(file_exporter):
+            if not file_exporter.overwrite:
+                file_exporter.error_handler(f'{file_exporter.filename} cannot be uploaded to '
+                                            f'{file_exporter.dest_parent.id}. File exists and overwrite is set to '
+                                            'False')
+                return
+            await self.async_client.delete_file(file_exporter.dest_parent, file_exporter.filename)
+        upload_file, upload_bytes = file_exporter.get_upload_file()
+        start = time.monotonic()
+        try:
+            await self.async_client.upload_file(file_exporter.dest_parent, upload_file)
+        finally:
+            file_exporter.record_stage('upload', time.monotonic() - start, upload_bytes)
+        file_exporter.state = 'upload_attempted'
+        self.summary.increment('upload_attempts')
+        self.summary.increment('upload_bytes', file_exporter.origin.get('size') or 0)
+
+    async def update_metadata_async(self, file_exporter):
+        """Updates the metadata of an uploaded file through the async client, as FileExporter.update_metadata"""
+        if not await self.reload_dest_async(file_exporter):
+            file_exporter.error_handler(f'could not update metadata for {file_exporter.filename}: '
+                                        f'{file_exporter.origin.id} - file was not found!')
+            return
+        metadata_dict = file_exporter.get_metadata_dict().copy()
+        info_dict = metadata_dict.pop('info', None)
+        start = time.monotonic()
+        try:
+            if info_dict:
+                await self.async_client.update_file_info(file_exporter.dest_parent, file_exporter.filename, info_dict)
+            if metadata_dict:
+                await self.async_client.update_file(file_exporter.dest_parent, file_exporter.filename, metadata_dict)
+        finally:
+            file_exporter.record_stage('metadata', time.monotonic() - start)
+        # confirmed (and marked exported) when the status of the file is loaded, as in FileExporter.reload
+        file_exporter.state = 'metadata_updated'
+
+    async def upload_file_async(self, file_exporter):
+        """Uploads a de-identified file and updates its metadata, as SessionExporter.upload_file"""
+        self._uploads_in_flight += 1
+        self.summary.update_max('upload_concurrency', self._uploads_in_flight)
+        try:
+            if file_exporter.state == 'processed':
+                await self.upload_async(file_exporter)
+            if file_exporter.state == 'upload_attempted':
+                await self.update_metadata_async(file_exporter)
+        except Exception as e:
+            file_exporter.error_handler(f'an exception was raised when uploading {file_exporter.filename}: {e}')
+        finally:
+            self._uploads_in_flight -= 1
+            file_exporter.cleanup()
+        return file_exporter
+
+    async def local_file_export_async(self):
+        """
+        De-identifies the session's files concurrently, uploading each one concurrently once it and the files before it
+            have been de-identified
+
+        Returns:
+            pandas.DataFrame: the export status of the files
+        """
+        deid_tasks = list()
+        previous_reserved = None
+        for file_exporter in self.files:
+            if file_exporter.state == 'error':
+                deid_tasks.append(None)
+                continue
+            reserved = asyncio.Event()
+            deid_tasks.append(asyncio.ensure_future(self.deidentify_async(file_exporter, previous_reserved, reserved)))
+            previous_reserved = reserved
+
+        # collisions are resolved in file order, as in local_file_export
+        fname_dict = dict()
+        upload_tasks = list()
+        try:
+            for file_exporter, deid_task in zip(self.files, deid_tasks):
+                if deid_task is not None:
+                    await deid_task
+                if file_exporter.filename and not self.check_filename_collision(fname_dict, file_exporter):
+                    upload_tasks.append(asyncio.ensure_future(self.upload_file_async(file_exporter)))
+                else:
+                    file_exporter.cleanup()
+        finally:
+            # on error, wait for the files already started so that none is still being exported when this returns
+            results = await asyncio.gather(*[task for task in deid_tasks + upload_tasks if task is not None],
+                                           return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return await self.async_client.run(self.get_status_df)
+
+    def close(self):
+        """Returns the de-identification profile to PROFILE_CACHE and closes the async client and de-identification
+        executor if they were created by the exporter"""
+        super().close()
+        if self._owns_async_client:
+            self._owns_async_client = False
+            self.async_client.close()
+        if self._owns_deid_executor:
+            self._owns_deid_executor = False
+            self.deid_executor.shutdown(wait=True)
+
+
+async def export_session_async(fw_client, origin_session_id, dest_proj_id, template_path, subject_files=False,
+                               project_files=False, overwrite=False, async_client=None, summary=None,
+                               template_dict=None, **kwargs):
+    """
+    Exports a session with an AsyncSessionExporter. Arguments are as for container_export.export_session
+
+    Args:
+        async_client (AsyncFlywheelClient): the client on which to make calls, so that concurrent session exports can
+            share one bound on in-flight requests
+        summary (ExportSummary): an optional summary to which to add the session export counts
+        template_dict (dict): a template to use instead of the one at template_path (e.g. a subject template)
+        **kwargs: additional keyword arguments for AsyncSessionExporter (e.g. deid_executor, journal)
+
+    Returns:
+        pandas.DataFrame or None: the export status of the session's files
+    """
+    template = copy.deepcopy(template_dict) if template_dict is not None else load_template_dict(template_path)
+    owns_async_client = async_client is None
+    async_client = async_client or AsyncFlywheelClient(fw_client)
+    try:
+        snapshot = kwargs.pop('snapshot', None)
+        if snapshot is not None:
+            origin_session = snapshot.get(origin_session_id)
+        else:
+            origin_session = await async_client.run(fw_client.get_session, origin_session_id)
+            snapshot = await async_client.run(OriginSnapshot, fw_client, origin_session)
+            if summary is not None:
+                summary.increment('origin_snapshot_api_calls', snapshot.api_calls)
+        session_exporter = await async_client.run(
+            AsyncSessionExporter, fw_client=fw_client, template_dict=template, origin_session=origin_session,
+            dest_proj_id=dest_proj_id, async_client=async_client, snapshot=snapshot, **kwargs
+        )
+        try:
+            await session_exporter.initialize_files_async(subject_files=subject_files, project_files=project_files,
+                                                          overwrite=overwrite)
+            session_export_df = await session_exporter.local_file_export_async()
+        finally:
+            session_exporter.close()
+    finally:
+        if owns_async_client:
+            async_client.close()
+    session_exporter.summarize_stages(session_export_df)
+    if summary is not None:
+        summary.merge(session_exporter.summary)
+    if session_export_df is not None and len(session_export_df) >= 1:
+        return session_export_df
+    return None
+
+
+async def iter_export_tasks_async(fw_client, tasks, dest_proj_id, max_workers=1, max_api_concurrency=0,
+                                  **export_kwargs):
+    """
+    Exports the sessions described by tasks on the running event loop, yielding their results as they complete, as
+        container_export.iter_session_export_results does with a worker pool
+
+    At most max_workers sessions are exported at once, and their files are de-identified on a shared pool of
+    max_workers threads. API calls are made through a shared AsyncFlywheelClient. Tasks that only report errors or
+    export project files are run with run_session_export_task on the client's threads.
+
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        tasks (list): list of SessionExportTask objects
+        dest_proj_id (str): the id of the project to which to export
+        max_workers (int): the maximum number of sessions to export concurrently
+        max_api_concurrency (int): the maximum number of API calls awaited at once, DEFAULT_MAX_CONCURRENCY if 0
+        **export_kwargs: additional keyword arguments for export_session_async (e.g. overwrite, journal)
+
+    Yields:
+        tuple: (SessionExportTask, pandas.DataFrame or None, ExportSummary)
+    """
+    max_workers = max(1, max_workers or 1)
+    async_client = AsyncFlywheelClient(fw_client, max_threads=DEFAULT_MAX_THREADS,
+                                       max_concurrency=max_api_concurrency or DEFAULT_MAX_CONCURRENCY)
+    deid_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async_deid')
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def _export_task(task):
+        async with semaphore:
+            if task.error_msg or task.session_id is None:
+                session_df, summary = await async_client.run(run_session_export_task, fw_client, task, dest_proj_id,
+                                                             **export_kwargs)
+                return task, session_df, summary
+            summary = ExportSummary()
+            try:
+                session_df = await export_session_async(
+                    fw_client, task.session_id, dest_proj_id, task.template_path, subject_files=task.subject_files,
+                    project_files=task.project_files, async_client=async_client, summary=summary,
+                    template_dict=task.template_dict, deid_executor=deid_executor, **export_kwargs
+                )
+            finally:
+                if export_kwargs.get('journal') is not None:
+                    await async_client.run(export_kwargs['journal'].flush)
+            return task, session_df, summary
+
+    # the first session of each subject is exported before the rest, as in iter_session_export_results
+    seen_subjects = set()
+    first_tasks = list()
+    other_tasks = list()
+    for task in tasks:
+        if task.subject_id in seen_subjects:
+            other_tasks.append(task)
+        else:
+            seen_subjects.add(task.subject_id)
+            first_tasks.append(task)
+
+    pending = list()
+    try:
+        for phase_tasks in [first_tasks, other_tasks]:
+            pending = [asyncio.ensure_future(_export_task(task)) for task in phase_tasks]
+            for next_result in asyncio.as_completed(pending):
+                yield await next_result
+    finally:
+        # sessions still being exported when the results are no longer consumed (e.g. an exception) are cancelled
+        for future in pending:
+            future.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        async_client.close()
+        deid_executor.shutdown(wait=True)
+    async_counts = async_client.get_counts()
+    log.debug(f'Made {async_counts["async_calls"]} API calls, at most {async_counts["async_max_in_flight"]} at once')
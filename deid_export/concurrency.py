@@ -0,0 +1,170 @@
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+from deid_export.retry import get_status_code
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_API_CONCURRENCY = 32
+
+# responses that mean the server is overloaded or rate limiting requests
+THROTTLE_STATUSES = {429, 503}
+
+
+class AdaptiveLimiter:
+    """An additive-increase/multiplicative-decrease (AIMD) limit on the number of concurrent API calls.
+
+    Each call that succeeds while latency and the recent error rate are healthy raises the limit by increase / limit,
+    i.e. by about `increase` per limit's worth of calls. A throttling (429/503) or server error (5xx) response, or a
+    recent error rate above max_error_rate, multiplies the limit by backoff_factor. Decreases are applied at most once
+    per cooldown seconds so that a burst of failures from the same window of calls backs off once.
+    """
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=DEFAULT_MAX_API_CONCURRENCY, increase=1.0,
+                 backoff_factor=0.5, latency_tolerance=4.0, max_error_rate=0.1, window=50, cooldown=1.0):
+        """
+        Args:
+            initial_limit (int): the initial number of concurrent calls
+            min_limit (int): the lowest the limit is reduced to
+            max_limit (int): the highest the limit is raised to
+            increase (float): the amount by which the limit grows per limit's worth of healthy calls
+            backoff_factor (float): the factor by which the limit is multiplied on throttling or server errors
+            latency_tolerance (float): a call slower than this multiple of the smoothed baseline latency is unhealthy
+                and does not raise the limit
+            max_error_rate (float): the fraction of failed calls in the window above which the limit is reduced
+            window (int): the number of recent calls over which the error rate is measured
+            cooldown (float): the minimum number of seconds between decreases
+        """
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.increase = increase
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.calls = 0
+        self.throttle_events = 0
+        self.error_events = 0
+        self.max_limit_reached = int(self.limit)
+        self.baseline_latency = None
+        self._results = collections.deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, status=None, failed=False):
+        """
+        Releases a call slot and adjusts the limit from the outcome of the call
+
+        Args:
+            latency (float): the duration of the call in seconds
+            status (int): the HTTP status of a failed call, if known
+            failed (bool): whether the call raised an exception
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            throttled = status in THROTTLE_STATUSES
+            server_error = status is not None and status >= 500 and not throttled
+            # client errors (e.g. 403, 404) say nothing about the server's load
+            self._results.append(throttled or server_error or (failed and status is None))
+            if throttled or server_error:
+                if throttled:
+                    self.throttle_events += 1
+                else:
+                    self.error_events += 1
+                self._decrease(f'{"throttled" if throttled else "server error"} ({status})')
+            elif self._get_error_rate() > self.max_error_rate:
+                self._decrease(f'error rate {self._get_error_rate():.0%}')
+            elif not failed:
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                healthy = latency <= self.baseline_latency * self.latency_tolerance
+                # the baseline follows the typical latency slowly, so that a burst of slow calls stands out
+                self.baseline_latency += 0.05 * (min(latency, self.baseline_latency * self.latency_tolerance)
+                                                 - self.baseline_latency)
+                if healthy:
+                    self._increase()
+            self._condition.notify_all()
+
+    def _get_error_rate(self):
+        if len(self._results) < self._results.maxlen:
+            return 0.0
+        return sum(self._results) / len(self._results)
+
+    def _increase(self):
+        previous_limit = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+        if int(self.limit) > previous_limit:
+            self.max_limit_reached = max(self.max_limit_reached, int(self.limit))
+            log.debug(f'Raised API concurrency limit to {int(self.limit)}')
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        previous_limit = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        self._results.clear()
+        log.warning(f'API calls {reason}, reducing API concurrency limit from {previous_limit} to {int(self.limit)}')
+
+    @contextlib.contextmanager
+    def limit_call(self):
+        """A context manager that holds a call slot for the duration of a call and records its outcome"""
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.release(time.monotonic() - start, status=get_status_code(e), failed=True)
+            raise
+        else:
+            self.release(time.monotonic() - start)
+
+    def get_counts(self):
+        """Returns a dictionary of calls made and throttling and server error events"""
+        return {
+            'api_calls': self.calls,
+            'api_throttle_events': self.throttle_events,
+            'api_server_error_events': self.error_events
+        }
+
+
+def install_limiter(fw_client, limiter):
+    """
+    Routes every request made by fw_client through limiter, replacing any previously installed limiter
+
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        limiter (AdaptiveLimiter): the limiter to install
+    """
+    api_client = fw_client.api_client
+    call_api = getattr(api_client, '_unlimited_call_api', api_client.call_api)
+
+    @functools.wraps(call_api)
+    def limited_call_api(*args, **kwargs):
+        with limiter.limit_call():
+            return call_api(*args, **kwargs)
+
+    api_client._unlimited_call_api = call_api
+    api_client.call_api = limited_call_api
+
+
+def uninstall_limiter(fw_client):
+    """Restores fw_client's requests to the state before install_limiter"""
+    api_client = fw_client.api_client
+    call_api = getattr(api_client, '_unlimited_call_api', None)
+    if call_api is not None:
+        api_client.call_api = call_api
+        del api_client._unlimited_call_api
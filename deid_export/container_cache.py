@@ -0,0 +1,136 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 30
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class ContainerCache:
+    """A thread-safe cache of reloaded Flywheel containers keyed by container id.
+
+    Concurrent reloads of the same container are coalesced into a single request. Entries expire after ttl seconds,
+    are replaced when a caller passes a copy of the container with a newer modified timestamp than the cached copy,
+    and must be invalidated explicitly by code that modifies the container (or its files). A reload that was in flight
+    when its container was invalidated is returned to its caller but not cached, since it may predate the change.
+    Expired entries are removed
+    when they are next requested, and the least recently used entries are evicted when there are more than max_entries,
+    so that a long export does not hold every container it has loaded.
+    """
+    def __init__(self, ttl=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            ttl (float): the number of seconds for which a reloaded container is served from the cache
+            max_entries (int): the maximum number of containers in the cache
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        # container id: (container, load time), least recently used first
+        self._entries = collections.OrderedDict()
+        # container id: [lock, number of threads holding or waiting for it, generation], the generation is incremented
+        # by invalidate() so that reloads in flight can tell that the container was modified
+        self._key_locks = dict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _key_lock(self, container_id):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(container_id, [threading.Lock(), 0, 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield key_lock
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[container_id]
+
+    def _get_fresh(self, container):
+        with self._lock:
+            entry = self._entries.get(container.id)
+            if entry is None:
+                return None
+            cached, loaded_at = entry
+            if time.monotonic() - loaded_at > self.ttl:
+                del self._entries[container.id]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(container.id)
+        modified = container.get('modified')
+        cached_modified = cached.get('modified')
+        if modified and cached_modified and modified > cached_modified:
+            return None
+        return cached
+
+    def reload(self, container):
+        """Returns a reloaded copy of container, from the cache if a fresh copy is available
+
+        Args:
+            container (flywheel container): the container to reload
+
+        Returns:
+            flywheel container: the reloaded container
+        """
+        cached = self._get_fresh(container)
+        if cached is None:
+            # Only one thread reloads a given container at a time, the others wait and use its result unless the
+            # container was invalidated during the reload
+            with self._key_lock(container.id) as key_lock:
+                cached = self._get_fresh(container)
+                if cached is None:
+                    with self._lock:
+                        generation = key_lock[2]
+                    reloaded = container.reload()
+                    with self._lock:
+                        self.misses += 1
+                        if key_lock[2] != generation:
+                            return reloaded
+                        self._entries[container.id] = (reloaded, time.monotonic())
+                        self._entries.move_to_end(container.id)
+                        while len(self._entries) > self.max_entries:
+                            self._entries.popitem(last=False)
+                            self.evictions += 1
+                    return reloaded
+        with self._lock:
+            self.hits += 1
+        return cached
+
+    def invalidate(self, container_id):
+        """Removes container_id from the cache so that the next reload requests it
+
+        Args:
+            container_id (str): the id of the modified container
+        """
+        with self._lock:
+            self.invalidations += 1
+            self._entries.pop(container_id, None)
+            if container_id in self._key_locks:
+                self._key_locks[container_id][2] += 1
+
+    def clear(self):
+        """Removes all containers from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_counts(self):
+        """Returns a dictionary of cache hits, misses, invalidations and evictions (of expired or least recently used
+        containers)"""
+        return {
+            'container_cache_hits': self.hits,
+            'container_cache_misses': self.misses,
+            'container_cache_invalidations': self.invalidations,
+            'container_cache_evictions': self.evictions
+        }
+
+
+# Shared by all FileExporter instances and find_or_create_* helpers in a process
+CONTAINER_CACHE = ContainerCache()
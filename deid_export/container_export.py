@@ -1,30 +1,52 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass
 import argparse
+import asyncio
+import concurrent.futures
+import copy
+import datetime
 import hashlib
 import json
 import logging
 import os
+import queue
 import re
 import time
-import tempfile
 import signal
 import sys
+import threading
 
-import joblib
 import pandas as pd
 import flywheel
 import yaml
+from joblib.externals.loky import get_reusable_executor
 
-from deid_export.retry import retry
+from deid_export.retry import get_retry_counts, retry
 from deid_export.metadata_export import get_container_metadata
-from deid_export.file_exporter import FileExporter
+from deid_export.export_summary import ExportSummary
+from deid_export.origin_snapshot import OriginSnapshot, load_acquisitions, load_container
+from deid_export.dest_index import DestinationIndex
+from deid_export.container_cache import CONTAINER_CACHE
+from deid_export.export_journal import STATUS_KEYS, ExportJournal
+from deid_export.concurrency import DEFAULT_MAX_API_CONCURRENCY, AdaptiveLimiter, install_limiter, uninstall_limiter
+from deid_export.export_plan import PLAN_COLUMNS, get_collisions, get_existing_filenames, get_matching_file_profile, \
+    load_throughput_history, log_export_plan, predict_export_filename, record_throughput
+from deid_export.file_exporter import STAGE_STATUS_KEYS, FileExporter
+from deid_export.profile_cache import PROFILE_CACHE
+from deid_export.profiling import DEFAULT_TOP_N, PROFILE_MODES, profile_option
+from deid_export.spool import SPOOL, exit_on_sigterm, spool_option
+from deid_export.sharding import PROJECT_FILES_SHARD, get_shard_path, in_shard, validate_shard
 from deid_export import deid_template
 from flywheel_migration import deidentify
 
 log = logging.getLogger(__name__)
 log.setLevel('INFO')
 
+# the columns of the export status csv, in order
+STATUS_COLUMNS = STATUS_KEYS + STAGE_STATUS_KEYS
+# how often blocked pipeline stages check whether another stage has stopped
+PIPELINE_POLL_SECONDS = 0.1
+
 
 def hash_string(input_str):
     """
@@ -64,17 +86,7 @@ def matches_file(deid_profile, file_obj):
     return return_bool
 
 
-def load_template_dict(template_file_path):
-    """
-    Determines whether the file at template_file_path is JSON or YAML and returns the Python dictionary representation
-    Args:
-        template_file_path (str): path to the JSON or YAML file
-    Raises:
-        ValueError: when fails to load the template
-    Returns:
-        (dict): dictionary representation of the the template file
-
-    """
+def _parse_template_dict(template_file_path):
     _, ext = os.path.splitext(template_file_path.lower())
 
     template = None
@@ -94,6 +106,21 @@ def load_template_dict(template_file_path):
         raise ValueError(f'Could not load template at: {template_file_path}')
 
 
+def load_template_dict(template_file_path):
+    """
+    Determines whether the file at template_file_path is JSON or YAML and returns the Python dictionary representation.
+        Templates are parsed once per content and then served from PROFILE_CACHE
+    Args:
+        template_file_path (str): path to the JSON or YAML file
+    Raises:
+        ValueError: when fails to load the template
+    Returns:
+        (dict): dictionary representation of the the template file
+
+    """
+    return PROFILE_CACHE.get_template(template_file_path, _parse_template_dict)
+
+
 def get_api_key_from_client(fw_client):
     """
     Parses the api key from an instance of the flywheel client
@@ -130,7 +157,7 @@ def quote_numeric_string(input_str):
     return output_str
 
 
-def find_or_create_subject(origin_subject, dest_proj, export_config=None):
+def find_or_create_subject(origin_subject, dest_proj, export_config=None, snapshot=None, dest_index=None):
     """
     Searches the destination project for a subject with code matching origin_subject.code (or 'code' from subject_config
         if provided). If found, the subject metadata is updated to match the whitelisted metadata of origin_subject.
@@ -139,12 +166,14 @@ def find_or_create_subject(origin_subject, dest_proj, export_config=None):
         origin_subject (flywheel.Subject): the subject to export
         dest_proj(flywheel.Project): the project in which to search/create the subject
         export_config (dict): an optional dictionary specifying metadata whitelists and container codes/labels
+        snapshot (OriginSnapshot): an optional snapshot from which to load origin_subject
+        dest_index (DestinationIndex): an optional index of destination containers to search instead of querying
 
     Returns:
         (flywheel.Subject): the found or created subject in dest_proj
     """
-    origin_subject = origin_subject.reload()
-    dest_proj = dest_proj.reload()
+    origin_subject = load_container(origin_subject, snapshot)
+    dest_proj = CONTAINER_CACHE.reload(dest_proj)
     if not export_config:
         export_config = {'subject': {}}
     subject_config = export_config.get('subject', {})
@@ -152,7 +181,11 @@ def find_or_create_subject(origin_subject, dest_proj, export_config=None):
     query_code = quote_numeric_string(new_code)
 
     # Since subject code must be unique within a project, we do not need to search by info.export.origin_id
-    dest_subject = dest_proj.subjects.find_first(f'code={query_code}')
+    if dest_index is not None:
+        dest_subject = dest_index.find('subject', dest_proj.id, new_code, finder=dest_proj.subjects,
+                                       query=f'code={query_code}')
+    else:
+        dest_subject = dest_proj.subjects.find_first(f'code={query_code}')
     # Copy over metadata as specified
     meta_dict = get_container_metadata(origin_container=origin_subject, export_dict=export_config)
 
@@ -161,17 +194,21 @@ def find_or_create_subject(origin_subject, dest_proj, export_config=None):
 
         # Add the subject to the destination project
         new_subject = dest_proj.add_subject(code=new_code, label=new_code, **meta_dict)
+        CONTAINER_CACHE.invalidate(dest_proj.id)
 
         # Reload the newly-created container
-        dest_subject = new_subject.reload()
+        dest_subject = CONTAINER_CACHE.reload(new_subject)
+        if dest_index is not None:
+            dest_index.add('subject', dest_proj.id, new_code, None, dest_subject)
     else:
         log.debug(f'Using destination subject ({dest_subject.id})')
         dest_subject.update(meta_dict)
-        dest_subject.reload()
+        CONTAINER_CACHE.invalidate(dest_subject.id)
     return dest_subject
 
 
-def find_or_create_subject_session(origin_session, dest_subject, export_config=None):
+def find_or_create_subject_session(origin_session, dest_subject, export_config=None, snapshot=None,
+                                   dest_index=None):
     """
     Searches the destination subject (dest_subject) for a session with with label matching origin_session.label
         (or 'label' from session_config, if provided) and info.export.origin_id = hash_string(origin_session.id)
@@ -181,35 +218,47 @@ def find_or_create_subject_session(origin_session, dest_subject, export_config=N
         origin_session (flywheel.Session): the session to be exported
         dest_subject (flywheel.Subject): the subject to which to export the session
         export_config (dict): an optional dictionary specifying metadata whitelists and container codes/labels
+        snapshot (OriginSnapshot): an optional snapshot from which to load origin_session
+        dest_index (DestinationIndex): an optional index of destination containers to search instead of querying
 
     Returns:
         (flywheel.Session): the found or created session in dest_subject
     """
-    origin_session = origin_session.reload()
-    dest_subject = dest_subject.reload()
+    origin_session = load_container(origin_session, snapshot)
+    dest_subject = CONTAINER_CACHE.reload(dest_subject)
     if not export_config:
         export_config = {'session': {}}
     session_config = export_config.get('session', {})
     new_label = session_config.get('label', origin_session.label)
+    origin_id_hash = hash_string(origin_session.id)
     query = (
         f'label={quote_numeric_string(new_label)},'
-        f'info.export.origin_id="{hash_string(origin_session.id)}"'
+        f'info.export.origin_id="{origin_id_hash}"'
     )
-    dest_session = dest_subject.sessions.find_first(query)
+    if dest_index is not None:
+        dest_session = dest_index.find('session', dest_subject.id, new_label, origin_id_hash,
+                                       finder=dest_subject.sessions, query=query)
+    else:
+        dest_session = dest_subject.sessions.find_first(query)
     # Copy over metadata as specified
     meta_dict = get_container_metadata(origin_container=origin_session, export_dict=export_config)
     if not dest_session:
         log.debug(f'Creating destination session for ({origin_session.id})')
         # Add session to subject
         dest_session = dest_subject.add_session(label=new_label, **meta_dict)
+        CONTAINER_CACHE.invalidate(dest_subject.id)
+        if dest_index is not None:
+            dest_index.add('session', dest_subject.id, new_label, origin_id_hash, dest_session)
     else:
         log.debug(f'Using destination session ({dest_session.id})')
         dest_session.update(meta_dict)
-        dest_session = dest_session.reload()
+        CONTAINER_CACHE.invalidate(dest_session.id)
+        dest_session = CONTAINER_CACHE.reload(dest_session)
     return dest_session
 
 
-def find_or_create_session_acquisition(origin_acquisition, dest_session, export_config=None):
+def find_or_create_session_acquisition(origin_acquisition, dest_session, export_config=None, snapshot=None,
+                                       dest_index=None):
     """
     Searches the destination session (dest_session) for an acquisition with label matching origin_acquisition.label
         (or 'label' from acquisition_config, if provided) and info.export.origin_id = hash_string(origin_acquisition.id)
@@ -220,19 +269,26 @@ def find_or_create_session_acquisition(origin_acquisition, dest_session, export_
         origin_acquisition (flywheel.Acquisition): the acquisition to be exported
         dest_session (flywheel.Session): the session to which to export the acquisition
         export_config (dict): an optional dictionary specifying metadata whitelists and container codes/labels
+        snapshot (OriginSnapshot): an optional snapshot from which to load origin_acquisition
+        dest_index (DestinationIndex): an optional index of destination containers to search instead of querying
 
     Returns:
         (flywheel.Acquisition): the found or created acquisition in dest_session
     """
-    origin_acquisition = origin_acquisition.reload()
-    dest_session = dest_session.reload()
+    origin_acquisition = load_container(origin_acquisition, snapshot)
+    dest_session = CONTAINER_CACHE.reload(dest_session)
     if not export_config:
         export_config = {'acquisition': {}}
+    origin_id_hash = hash_string(origin_acquisition.id)
     query = (
         f'label={quote_numeric_string(origin_acquisition.label)},'
-        f'info.export.origin_id="{hash_string(origin_acquisition.id)}"'
+        f'info.export.origin_id="{origin_id_hash}"'
     )
-    dest_acquisition = dest_session.acquisitions.find_first(query)
+    if dest_index is not None:
+        dest_acquisition = dest_index.find('acquisition', dest_session.id, origin_acquisition.label, origin_id_hash,
+                                           finder=dest_session.acquisitions, query=query)
+    else:
+        dest_acquisition = dest_session.acquisitions.find_first(query)
     # Copy over metadata as specified
     meta_dict = get_container_metadata(origin_container=origin_acquisition, export_dict=export_config)
     if not dest_acquisition:
@@ -240,15 +296,19 @@ def find_or_create_session_acquisition(origin_acquisition, dest_session, export_
 
         # Add acquisition to session
         dest_acquisition = dest_session.add_acquisition(label=origin_acquisition.label, **meta_dict)
+        CONTAINER_CACHE.invalidate(dest_session.id)
+        if dest_index is not None:
+            dest_index.add('acquisition', dest_session.id, origin_acquisition.label, origin_id_hash,
+                           dest_acquisition)
     else:
         log.debug(f'Using destination acquisition ({dest_acquisition.id})')
         dest_acquisition.update(meta_dict)
-        dest_acquisition.reload()
+        CONTAINER_CACHE.invalidate(dest_acquisition.id)
     return dest_acquisition
 
 
 def initialize_container_file_export(fw_client, deid_profile, origin_container, dest_container, overwrite=False,
-                                     config=None):
+                                     config=None, journal=None, profile_hash=None, in_memory_max_bytes=0):
     """
     Initializes a list of FileExporter objects for the origin_container/dest_container combination
 
@@ -259,6 +319,9 @@ def initialize_container_file_export(fw_client, deid_profile, origin_container,
         origin_container (flywheel.<Container>): the container with files to be exported
         dest_container (flywheel.<Container>): the container to which files are to be exported
         overwrite (bool): whether to overwrite files that currently exist in dest_container
+        journal (ExportJournal): an optional journal in which to record file state transitions
+        profile_hash (str): the hash of the de-identification template, recorded in exported file info
+        in_memory_max_bytes (int): the size up to which files are de-identified in memory where possible
 
     Returns:
         (list): list of FileExporter objects
@@ -271,7 +334,8 @@ def initialize_container_file_export(fw_client, deid_profile, origin_container,
                 f'Initializing {origin_container.container_type} {origin_container.id} file {container_file.name}')
             tmp_file_exporter = FileExporter(fw_client=fw_client, origin_parent=origin_container,
                                              origin_filename=container_file.name, dest_parent=dest_container,
-                                             overwrite=overwrite, config=config)
+                                             overwrite=overwrite, config=config, journal=journal,
+                                             profile_hash=profile_hash, in_memory_max_bytes=in_memory_max_bytes)
             file_exporter_list.append(tmp_file_exporter)
         else:
             log.debug('Ignoring file %s, as it does not have a matching template', container_file.name)
@@ -283,25 +347,46 @@ def initialize_container_file_export(fw_client, deid_profile, origin_container,
 class SessionExporter:
 
     def __init__(self, fw_client, template_dict, origin_session, dest_proj_id,
-                 dest_container_id=None):
+                 dest_container_id=None, max_upload_workers=1, pipeline_depth=0, snapshot=None, dest_index=None,
+                 journal=None, resume=False, delta=False, in_memory_max_bytes=0):
         self.client = fw_client
-        self.deid_profile, self.export_config = deid_template.load_deid_profile(template_dict)
+        self.journal = journal
+        self.resume = resume
+        self.delta = delta
+        # the status of files skipped because they were exported by a previous run or are unchanged
+        self.skipped_status = list()
+        self.snapshot = snapshot
+        self.dest_index = dest_index
+        self.max_upload_workers = max(1, max_upload_workers or 1)
+        self.pipeline_depth = pipeline_depth
+        self.in_memory_max_bytes = in_memory_max_bytes
+        self.summary = ExportSummary()
+        self._uploads_in_flight = 0
+        self._upload_lock = threading.Lock()
+        # returned to PROFILE_CACHE by close()
+        self.deid_profile, self.export_config, self.profile_hash = PROFILE_CACHE.acquire(template_dict)
 
-        self.origin_project = fw_client.get_project(origin_session.project)
         self.dest_proj = fw_client.get_project(dest_proj_id)
-        self.origin = origin_session.reload()
         # self.log = logging.getLogger(f'{self.origin.id}_exporter')
 
         self.errors = list()
         self.files = list()
         self.dest_subject = None
+        self.dest = None
+        self.load_origin(origin_session, dest_container_id=dest_container_id)
+
+    def load_origin(self, origin_session, dest_container_id=None):
+        """Loads the origin session and project, and the destination session if dest_container_id is provided"""
+        if self.snapshot is not None:
+            self.origin_project = self.snapshot.get(origin_session.project)
+        else:
+            self.origin_project = self.client.get_project(origin_session.project)
+        self.origin = load_container(origin_session, self.snapshot)
 
         # use dest_container_id if it's been provided
         if dest_container_id:
-            self.dest = fw_client.get_session(dest_container_id)
-            self.dest_subject = self.dest.subject.reload()
-        else:
-            self.dest = None
+            self.dest = self.client.get_session(dest_container_id)
+            self.dest_subject = CONTAINER_CACHE.reload(self.dest.subject)
 
     def find_or_create_dest_subject(self):
 
@@ -309,7 +394,9 @@ class SessionExporter:
             self.dest_subject = find_or_create_subject(
                 origin_subject=self.origin.subject,
                 dest_proj=self.dest_proj,
-                export_config=self.export_config
+                export_config=self.export_config,
+                snapshot=self.snapshot,
+                dest_index=self.dest_index
             )
         return self.dest_subject
 
@@ -321,7 +408,9 @@ class SessionExporter:
             self.dest = find_or_create_subject_session(
                 origin_session=self.origin,
                 dest_subject=self.dest_subject,
-                export_config=self.export_config
+                export_config=self.export_config,
+                snapshot=self.snapshot,
+                dest_index=self.dest_index
             )
         return self.dest
 
@@ -329,15 +418,17 @@ class SessionExporter:
 
         if not self.dest:
             self.find_or_create_dest()
-        self.origin = self.origin.reload()
-        for acquisition in self.origin.acquisitions():
+        self.origin = load_container(self.origin, self.snapshot)
+        for acquisition in load_acquisitions(self.origin, self.snapshot):
             find_or_create_session_acquisition(
                 origin_acquisition=acquisition,
                 dest_session=self.dest,
-                export_config=self.export_config
+                export_config=self.export_config,
+                snapshot=self.snapshot,
+                dest_index=self.dest_index
             )
 
-        self.dest.reload()
+        self.dest = CONTAINER_CACHE.reload(self.dest)
 
     def initialize_files(self, subject_files=False, project_files=False, overwrite=False):
         log.debug(f'Initializing {self.origin.id} files')
@@ -348,93 +439,377 @@ class SessionExporter:
         if project_files is True:
             proj_file_list = initialize_container_file_export(deid_profile=self.deid_profile,
                                                               fw_client=self.client,
-                                                              origin_container=self.origin_project.reload(),
-                                                              dest_container=self.dest_proj.reload(),
+                                                              origin_container=load_container(self.origin_project,
+                                                                                              self.snapshot),
+                                                              dest_container=CONTAINER_CACHE.reload(self.dest_proj),
                                                               config=self.export_config,
-                                                              overwrite=overwrite)
+                                                              overwrite=overwrite, journal=self.journal,
+                                                              profile_hash=self.profile_hash,
+                                                              in_memory_max_bytes=self.in_memory_max_bytes)
             self.files.extend(proj_file_list)
 
         # subject files
         if subject_files is True:
             subj_file_list = initialize_container_file_export(deid_profile=self.deid_profile,
                                                               fw_client=self.client,
-                                                              origin_container=self.origin.subject.reload(),
-                                                              dest_container=self.dest.subject.reload(),
+                                                              origin_container=load_container(self.origin.subject,
+                                                                                              self.snapshot),
+                                                              dest_container=CONTAINER_CACHE.reload(self.dest.subject),
                                                               config=self.export_config,
-                                                              overwrite=overwrite)
+                                                              overwrite=overwrite, journal=self.journal,
+                                                              profile_hash=self.profile_hash,
+                                                              in_memory_max_bytes=self.in_memory_max_bytes)
             self.files.extend(subj_file_list)
 
         # session files
         sess_file_list = initialize_container_file_export(deid_profile=self.deid_profile,
                                                           fw_client=self.client, origin_container=self.origin,
-                                                          dest_container=self.dest.reload(),
+                                                          dest_container=CONTAINER_CACHE.reload(self.dest),
                                                           config=self.export_config,
-                                                          overwrite=overwrite)
+                                                          overwrite=overwrite, journal=self.journal,
+                                                          profile_hash=self.profile_hash,
+                                                          in_memory_max_bytes=self.in_memory_max_bytes)
         self.files.extend(sess_file_list)
 
-        self.origin = self.origin.reload()
+        self.origin = load_container(self.origin, self.snapshot)
         # acquisition files
-        for origin_acq in self.origin.acquisitions():
-            origin_acq = origin_acq.reload()
+        for origin_acq in load_acquisitions(self.origin, self.snapshot):
 
             dest_acq = find_or_create_session_acquisition(
                 origin_acquisition=origin_acq,
                 dest_session=self.dest,
-                export_config=self.export_config
+                export_config=self.export_config,
+                snapshot=self.snapshot,
+                dest_index=self.dest_index
             )
             tmp_acq_file_list = initialize_container_file_export(deid_profile=self.deid_profile,
                                                                  fw_client=self.client, origin_container=origin_acq,
                                                                  dest_container=dest_acq,
                                                                  config=self.export_config,
-                                                                 overwrite=overwrite)
+                                                                 overwrite=overwrite, journal=self.journal,
+                                                                 profile_hash=self.profile_hash,
+                                                                 in_memory_max_bytes=self.in_memory_max_bytes)
             self.files.extend(tmp_acq_file_list)
 
+        if self.resume and self.journal is not None:
+            self.skip_exported_files()
+        if self.delta:
+            self.skip_unchanged_files()
+
         return self.files
 
-    def local_file_export(self):
-        # De-identify
+    def skip_exported_files(self):
+        """Removes the files that the journal records as exported from self.files, keeping their journaled status"""
+        files = list()
         for file_exporter in self.files:
-            if file_exporter.state != 'error':
-                file_exporter.deidentify(self.deid_profile)
-        fname_dict = dict()
+            status_dict = self.journal.get_exported_status(file_exporter.origin_parent.id,
+                                                           file_exporter.origin_filename,
+                                                           file_exporter.dest_parent.id)
+            if status_dict:
+                log.debug(f'Skipping {file_exporter.origin_filename}, which was exported by a previous run')
+                self.skipped_status.append(status_dict)
+            else:
+                files.append(file_exporter)
+        self.summary.increment('files_resumed', len(self.files) - len(files))
+        self.files = files
+
+    def skip_unchanged_files(self):
+        """
+        Removes the files whose origin content and de-identification profile match those recorded on their exported
+            copies from self.files, keeping their status
+        """
+        files = list()
         for file_exporter in self.files:
-            if file_exporter.filename:
-                if file_exporter.dest_parent.id not in fname_dict.keys():
-                    fname_dict[file_exporter.dest_parent.id] = [file_exporter.filename]
+            if file_exporter.skip_if_unchanged():
+                log.debug(f'Skipping {file_exporter.origin_filename}, which is unchanged since it was exported')
+                self.skipped_status.append(file_exporter.get_status_dict())
+            else:
+                files.append(file_exporter)
+        self.summary.increment('files_unchanged', len(self.files) - len(files))
+        self.files = files
+
+    @staticmethod
+    def check_filename_collision(fname_dict, file_exporter):
+        """
+        Records file_exporter.filename for its destination parent in fname_dict, flagging file_exporter with an error
+            if another file has already claimed the filename in the same destination
+        Args:
+            fname_dict (dict): dictionary of destination parent id to list of claimed filenames
+            file_exporter (FileExporter): the file exporter to check
+
+        Returns:
+            bool: whether the filename was already claimed
+        """
+        if not file_exporter.filename:
+            return False
+        if file_exporter.dest_parent.id not in fname_dict.keys():
+            fname_dict[file_exporter.dest_parent.id] = [file_exporter.filename]
+        else:
+            if file_exporter.filename not in fname_dict.get(file_exporter.dest_parent.id):
+                fname_dict[file_exporter.dest_parent.id].append(file_exporter.filename)
+
+            else:
+                file_exporter.error_handler(
+                    f'Cannot upload {file_exporter.filename} ({file_exporter.origin.id}) to '
+                    f'{file_exporter.dest_parent.id} because another file has already been uploaded with '
+                    'the same name. Please use filename output strings that will create unique filenames in'
+                    ' your de-identification template.'
+                )
+                return True
+        return False
+
+    def local_file_export(self):
+        if self.pipeline_depth:
+            return self.pipeline_file_export(max_pending=self.pipeline_depth)
+        # Files are uploaded as soon as they are de-identified (and checked for collisions, in file order), so that
+        # the spool only holds the files waiting to be uploaded
+        fname_dict = dict()
+        upload_futures = list()
+        executor = self.get_upload_executor()
+        try:
+            for file_exporter in self.files:
+                try:
+                    if file_exporter.state != 'error':
+                        file_exporter.deidentify(self.deid_profile)
+                    upload = file_exporter.filename and not self.check_filename_collision(fname_dict, file_exporter)
+                except BaseException:
+                    file_exporter.cleanup()
+                    raise
+                if not upload:
+                    file_exporter.cleanup()
+                elif executor is not None:
+                    upload_futures.append(executor.submit(self.upload_and_cleanup, file_exporter))
                 else:
-                    if file_exporter.filename not in fname_dict.get(file_exporter.dest_parent.id):
-                        fname_dict[file_exporter.dest_parent.id].append(file_exporter.filename)
+                    self.upload_and_cleanup(file_exporter)
+            for upload_future in upload_futures:
+                upload_future.result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return self.get_status_df()
+
+    def get_upload_executor(self):
+        """Returns a thread pool of max_upload_workers threads on which to upload files, or None if files are uploaded
+        one at a time"""
+        if self.max_upload_workers > 1 and len(self.files) > 1:
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_upload_workers,
+                                                         thread_name_prefix=f'{self.origin.id}_upload')
+        return None
 
-                    else:
-                        file_exporter.error_handler(
-                            f'Cannot upload {file_exporter.filename} ({file_exporter.origin.id}) to '
-                            f'{file_exporter.dest_parent.id} because another file has already been uploaded with '
-                            'the same name. Please use filename output strings that will create unique filenames in'
-                            ' your de-identification template.'
-                        )
+    def pipeline_file_export(self, max_pending=2):
+        """
+        Exports files in three overlapping stages (download, de-identify, upload) connected by queues holding at most
+            max_pending files, so that the network and CPU are kept busy at the same time. Up to max_upload_workers
+            files are uploaded at once, so no more than max_pending + max_upload_workers + 1 de-identified files are
+            held locally at once
+
+        Args:
+            max_pending (int): the maximum number of files waiting between stages
+
+        Returns:
+            pandas.DataFrame: the export status of the files
+        """
+        download_queue = queue.Queue(maxsize=max_pending)
+        deid_queue = queue.Queue(maxsize=max_pending)
+        # set when a stage fails (or the export ends), so that no stage is left blocked on a queue
+        stop_event = threading.Event()
+        stage_errors = list()
+
+        def _put(stage_queue, item):
+            while not stop_event.is_set():
+                try:
+                    stage_queue.put(item, timeout=PIPELINE_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _get(stage_queue):
+            while not stop_event.is_set():
+                try:
+                    return stage_queue.get(timeout=PIPELINE_POLL_SECONDS)
+                except queue.Empty:
+                    pass
+            return None
 
-        for file_exporter in self.files:
+        def _download_stage():
+            try:
+                for file_exporter in self.files:
+                    if file_exporter.state == 'error':
+                        continue
+                    try:
+                        if file_exporter.can_deidentify_in_memory(self.deid_profile):
+                            origin = {'origin_content': file_exporter.read()}
+                        else:
+                            # waits for spool space when the spool is full
+                            origin = {'local_file_path': file_exporter.download()}
+                    except Exception as e:
+                        file_exporter.error_handler(f'an exception was raised when downloading '
+                                                    f'{file_exporter.origin_filename}: {e}')
+                        file_exporter.cleanup()
+                        continue
+                    if not _put(download_queue, (file_exporter, origin)):
+                        file_exporter.cleanup()
+                        break
+            except BaseException as e:
+                stage_errors.append(e)
+                stop_event.set()
+            finally:
+                _put(download_queue, None)
+
+        def _deid_stage():
+            try:
+                for file_exporter, origin in iter(lambda: _get(download_queue), None):
+                    try:
+                        # a downloaded copy is removed from the spool once it has been de-identified
+                        file_exporter.deidentify(self.deid_profile, **origin)
+                    except Exception as e:
+                        file_exporter.error_handler(f'an exception was raised when de-identifying '
+                                                    f'{file_exporter.origin_filename}: {e}')
+                        file_exporter.cleanup()
+                        continue
+                    if not _put(deid_queue, file_exporter):
+                        file_exporter.cleanup()
+                        break
+            except BaseException as e:
+                stage_errors.append(e)
+                stop_event.set()
+            finally:
+                _put(deid_queue, None)
+
+        stage_threads = [
+            threading.Thread(target=_download_stage, name=f'{self.origin.id}_download', daemon=True),
+            threading.Thread(target=_deid_stage, name=f'{self.origin.id}_deid', daemon=True)
+        ]
+        for stage_thread in stage_threads:
+            stage_thread.start()
+
+        def _upload(file_exporter):
+            try:
+                self.upload_file(file_exporter)
+            except Exception as e:
+                # keep draining the queue so the download and de-id stages are not left blocked
+                file_exporter.error_handler(f'an exception was raised when uploading {file_exporter.filename}: {e}')
+            finally:
+                file_exporter.cleanup()
+
+        # Upload stage, collisions are checked in file order before files are handed to the upload workers
+        fname_dict = dict()
+        upload_futures = set()
+        executor = self.get_upload_executor()
+        try:
+            for file_exporter in iter(lambda: _get(deid_queue), None):
+                self.summary.update_max('pipeline_queue_depth', deid_queue.qsize() + 1)
+                if not file_exporter.filename or self.check_filename_collision(fname_dict, file_exporter):
+                    file_exporter.cleanup()
+                elif executor is None:
+                    _upload(file_exporter)
+                else:
+                    # wait for a free upload worker, so that files waiting to be uploaded stay in the bounded queue
+                    if len(upload_futures) >= self.max_upload_workers:
+                        _, upload_futures = concurrent.futures.wait(
+                            upload_futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    upload_futures.add(executor.submit(_upload, file_exporter))
+            for upload_future in upload_futures:
+                upload_future.result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            stop_event.set()
+            for stage_thread in stage_threads:
+                stage_thread.join()
+            # files left between stages by a failed stage
+            for stage_queue in (download_queue, deid_queue):
+                while not stage_queue.empty():
+                    item = stage_queue.get_nowait()
+                    if item is not None:
+                        (item[0] if isinstance(item, tuple) else item).cleanup()
+        if stage_errors:
+            raise stage_errors[0]
+
+        return self.get_status_df()
+
+    def upload_and_cleanup(self, file_exporter):
+        """Uploads a de-identified file with upload_file, then removes its local copies"""
+        try:
+            return self.upload_file(file_exporter)
+        finally:
+            file_exporter.cleanup()
+
+    def upload_file(self, file_exporter):
+        """Uploads a de-identified file and updates its metadata, tracking the number of concurrent uploads"""
+        with self._upload_lock:
+            self._uploads_in_flight += 1
+            self.summary.update_max('upload_concurrency', self._uploads_in_flight)
+        try:
             file_exporter.reload()
-            if file_exporter.state != 'error' and file_exporter.filename:
+            if file_exporter.state != 'error':
                 file_exporter.upload()
-        for file_exporter in self.files:
+                self.summary.increment('upload_attempts')
+                self.summary.increment('upload_bytes', file_exporter.origin.get('size') or 0)
             file_exporter.reload()
             if file_exporter.state == 'upload_attempted':
                 file_exporter.update_metadata()
-
-        dict_list = [file_exporter.get_status_dict() for file_exporter in self.files]
-        export_df = pd.DataFrame(dict_list)
-
-        del dict_list
-        return export_df
+        finally:
+            with self._upload_lock:
+                self._uploads_in_flight -= 1
+        return file_exporter
 
     def get_status_df(self):
-        if not self.files:
+        if not self.files and not self.skipped_status:
             return None
         else:
-            status_df = pd.DataFrame([file_exporter.get_status_dict() for file_exporter in self.files])
+            dict_list = self.skipped_status + [file_exporter.get_status_dict() for file_exporter in self.files]
+            status_df = pd.DataFrame(dict_list).reindex(columns=STATUS_COLUMNS)
             return status_df
 
+    def close(self):
+        """Returns the de-identification profile to PROFILE_CACHE, once the session's files are exported"""
+        if self.deid_profile is not None:
+            PROFILE_CACHE.release(self.profile_hash, self.deid_profile, self.export_config)
+            self.deid_profile = None
+
+    def summarize_stages(self, status_df):
+        """
+        Adds the stage timings and bytes of status_df to the session summary and logs their percentiles
+        Args:
+            status_df (pandas.DataFrame): the export status of the session's files
+        """
+        if not isinstance(status_df, pd.DataFrame):
+            return
+        stage_summary = ExportSummary()
+        for key in STAGE_STATUS_KEYS:
+            if key not in status_df:
+                continue
+            # files skipped or failed before a stage have no value for it
+            for value in status_df[key].dropna():
+                stage_summary.add_sample(key, value)
+        stage_summary.log_summary(log, title=f'Session {self.origin.id} stage summary')
+        self.summary.merge(stage_summary)
+
+
+class ProjectFilesExporter(SessionExporter):
+    """Exports the files attached to the origin project on their own, for exports in which no session carries them
+    (e.g. a shard of a project export that has no sessions)"""
+
+    def load_origin(self, origin_project, dest_container_id=None):
+        self.origin_project = self.origin = load_container(origin_project, self.snapshot)
+
+    def initialize_files(self, subject_files=False, project_files=True, overwrite=False):
+        log.debug(f'Initializing project {self.origin.id} files')
+        self.files = initialize_container_file_export(deid_profile=self.deid_profile, fw_client=self.client,
+                                                      origin_container=self.origin,
+                                                      dest_container=CONTAINER_CACHE.reload(self.dest_proj),
+                                                      config=self.export_config, overwrite=overwrite,
+                                                      journal=self.journal, profile_hash=self.profile_hash,
+                                                      in_memory_max_bytes=self.in_memory_max_bytes)
+        if self.resume and self.journal is not None:
+            self.skip_exported_files()
+        if self.delta:
+            self.skip_unchanged_files()
+        return self.files
+
 
 # TODO: Allow files to be exported without template
 def export_session(
@@ -445,37 +820,119 @@ def export_session(
         subject_files=False,
         project_files=False,
         csv_output_path=None,
-        overwrite=False):
-    template = load_template_dict(template_path)
-    origin_session = fw_client.get_session(origin_session_id)
+        overwrite=False,
+        max_upload_workers=1,
+        pipeline_depth=0,
+        summary=None,
+        snapshot=None,
+        dest_index=None,
+        journal=None,
+        resume=False,
+        delta=False,
+        in_memory_max_bytes=0,
+        template_dict=None):
+    # template_dict (e.g. a subject template built from the subject csv) is used instead of the template at
+    # template_path
+    template = copy.deepcopy(template_dict) if template_dict is not None else load_template_dict(template_path)
+    if snapshot is not None:
+        origin_session = snapshot.get(origin_session_id)
+    else:
+        origin_session = fw_client.get_session(origin_session_id)
+        snapshot = OriginSnapshot(fw_client, origin_session)
+        if summary is not None:
+            summary.increment('origin_snapshot_api_calls', snapshot.api_calls)
 
     session_exporter = SessionExporter(
         fw_client=fw_client,
         origin_session=origin_session,
         dest_proj_id=dest_proj_id,
-        template_dict=template
+        template_dict=template,
+        max_upload_workers=max_upload_workers,
+        pipeline_depth=pipeline_depth,
+        snapshot=snapshot,
+        dest_index=dest_index,
+        journal=journal,
+        resume=resume,
+        delta=delta,
+        in_memory_max_bytes=in_memory_max_bytes
     )
 
-    session_exporter.initialize_files(subject_files=subject_files, project_files=project_files, overwrite=overwrite)
-    session_export_df = session_exporter.local_file_export()
-    if len(session_export_df) >= 1:
+    return run_exporter(session_exporter, template_path, subject_files=subject_files, project_files=project_files,
+                        overwrite=overwrite, summary=summary, csv_output_path=csv_output_path)
+
+
+def export_project_files(fw_client, origin_project_id, dest_proj_id, template_path, csv_output_path=None,
+                         overwrite=False, summary=None, snapshot=None, template_dict=None, **exporter_kwargs):
+    """
+    Exports the files attached to the origin project on their own, as export_session does along with a session's files
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        origin_project_id (str): the id of the project whose files to export
+        dest_proj_id (str): the id of the project to which to export
+        template_path (str): the path to the de-identification template
+        csv_output_path (str): an optional path to which to write the export status
+        overwrite (bool): whether to overwrite existing files in the destination project
+        summary (ExportSummary): an optional summary to which to add the export counts
+        snapshot (OriginSnapshot): an optional snapshot from which to load the origin project
+        template_dict (dict): a template to use instead of the one at template_path
+        **exporter_kwargs: additional keyword arguments for ProjectFilesExporter (e.g. journal, max_upload_workers)
+
+    Returns:
+        pandas.DataFrame or None: the export status of the project's files
+    """
+    template = copy.deepcopy(template_dict) if template_dict is not None else load_template_dict(template_path)
+    if snapshot is not None:
+        origin_project = snapshot.get(origin_project_id)
+    else:
+        origin_project = fw_client.get_project(origin_project_id)
+    project_exporter = ProjectFilesExporter(fw_client, template, origin_project, dest_proj_id, snapshot=snapshot,
+                                            **exporter_kwargs)
+    return run_exporter(project_exporter, template_path, project_files=True, overwrite=overwrite, summary=summary,
+                        csv_output_path=csv_output_path)
+
+
+def run_exporter(exporter, template_path, subject_files=False, project_files=False, overwrite=False, summary=None,
+                 csv_output_path=None):
+    """
+    Initializes and exports the files of a SessionExporter (or ProjectFilesExporter), then closes it
+    Args:
+        exporter (SessionExporter): the exporter
+        template_path (str): the path to the de-identification template, for error messages
+        subject_files (bool): whether to export the subject files
+        project_files (bool): whether to export the project files
+        overwrite (bool): whether to overwrite existing files in the destination project
+        summary (ExportSummary): an optional summary to which to add the export counts
+        csv_output_path (str): an optional path to which to write the export status
+
+    Returns:
+        pandas.DataFrame or None: the export status of the files
+    """
+    try:
+        exporter.initialize_files(subject_files=subject_files, project_files=project_files, overwrite=overwrite)
+        export_df = exporter.local_file_export()
+    finally:
+        exporter.close()
+    exporter.summarize_stages(export_df)
+    if summary is not None:
+        summary.merge(exporter.summary)
+    if export_df is not None and len(export_df) >= 1:
         if csv_output_path:
-            session_export_df.to_csv(csv_output_path, index=False)
+            export_df.to_csv(csv_output_path, index=False)
 
-        if session_export_df['state'].all() == 'error':
+        if export_df['state'].all() == 'error':
             log.error(
-                f'Failed to export all {origin_session_id} files.'
+                f'Failed to export all {exporter.origin.id} files.'
                 f' Please check template {os.path.basename(template_path)}'
             )
-        return session_export_df
+        return export_df
     else:
         return None
 
 
 def get_session_error_df(fw_client, session_obj, error_msg, deid_profile, project_files=False,
-                         subject_files=False):
+                         subject_files=False, snapshot=None):
 
-    session_obj = session_obj.reload()
+    session_obj = load_container(session_obj, snapshot)
     status_dict_list = list()
 
     def _append_file_status_dicts(parent_obj):
@@ -495,121 +952,708 @@ def get_session_error_df(fw_client, session_obj, error_msg, deid_profile, projec
 
     # Handle project files
     if project_files:
-        project_obj = fw_client.get_project(session_obj.project)
+        if snapshot is not None:
+            project_obj = snapshot.get(session_obj.project)
+        else:
+            project_obj = fw_client.get_project(session_obj.project)
         _append_file_status_dicts(project_obj)
     # Handle subject files
     if subject_files:
-        subject_obj = session_obj.subject.reload()
+        subject_obj = load_container(session_obj.subject, snapshot)
         _append_file_status_dicts(subject_obj)
     # Handle session files
     _append_file_status_dicts(session_obj)
     # Handle acquisition files
-    for acquisition_obj in session_obj.acquisitions():
-        acquisition_obj = acquisition_obj.reload()
+    for acquisition_obj in load_acquisitions(session_obj, snapshot):
         _append_file_status_dicts(acquisition_obj)
 
     session_df = pd.DataFrame(status_dict_list)
     return session_df
 
 
-# TODO: incorporate filetype list
-def export_container(fw_client, container_id, dest_proj_id, template_path, csv_output_path=None, overwrite=False,
-                     subject_csv_path=None, new_code_col=deid_template.DEFAULT_NEW_SUBJECT_CODE_COL,
-                     old_code_col=deid_template.DEFAULT_SUBJECT_CODE_COL):
-    container = fw_client.get(container_id).reload()
+def plan_session(task, dest_proj_id, snapshot, dest_index, dest_proj=None):
+    """
+    Plans the export of the session described by task from the origin snapshot and destination index, without
+        downloading files or querying the destination
+    Args:
+        task (SessionExportTask): the session to plan
+        dest_proj_id (str): the id of the project to which to export
+        snapshot (OriginSnapshot): a snapshot of the origin hierarchy
+        dest_index (DestinationIndex): an index of the destination project's containers
+        dest_proj (flywheel.Project): the destination project, whose files project files are checked against
 
-    template_obj = None
-    df = None
-    error_count = 0
-    template_obj = load_template_dict(template_path)
+    Returns:
+        list: list of plan row dictionaries with the keys of export_plan.PLAN_COLUMNS, one for each container with
+            files to export or that will be created
+    """
+    template_dict = task.get_template_dict()
+    deid_profile, export_config, profile_hash = PROFILE_CACHE.acquire(template_dict)
+    plan_rows = list()
+
+    def _get_child(children, container_id):
+        # finder results include files without info, which is all that planning needs
+        return next((child for child in children if child.id == container_id), None) or snapshot.get(container_id)
+
+    def _get_filenames(dest_container):
+        # indexed containers are finder results, which include their files
+        if dest_container is None:
+            return list()
+        return [file_obj.get('name') for file_obj in dest_container.get('files') or list()]
+
+    def _plan_container(origin_container, dest_id, dest_filenames=(), include_files=True):
+        predicted_filenames = list()
+        total_bytes = 0
+        for file_obj in (origin_container.get('files') or list()) if include_files else list():
+            file_profile = get_matching_file_profile(deid_profile, file_obj)
+            if file_profile is None:
+                continue
+            total_bytes += file_obj.get('size') or 0
+            predicted_filenames.append(predict_export_filename(file_profile, file_obj.get('name')))
+        collisions = get_collisions(predicted_filenames)
+        existing_filenames = get_existing_filenames(predicted_filenames, dest_filenames)
+        plan_rows.append({
+            'container_type': origin_container.container_type,
+            'origin_id': origin_container.id,
+            'origin_label': origin_container.get('label'),
+            'dest_id': dest_id,
+            'create_container': dest_id is None,
+            'file_count': len(predicted_filenames),
+            'total_bytes': total_bytes,
+            'unpredictable_filenames': predicted_filenames.count(None),
+            'collisions': sum(predicted_filenames.count(filename) - 1 for filename in collisions),
+            'collision_filenames': '\t'.join(collisions),
+            'existing_files': len(existing_filenames),
+            'existing_filenames': '\t'.join(existing_filenames),
+            'errors': task.error_msg
+        })
+
+    if task.session_id is None:
+        _plan_container(snapshot.get(task.project_id), dest_proj_id, _get_filenames(dest_proj))
+        PROFILE_CACHE.release(profile_hash, deid_profile, export_config)
+        return plan_rows
+
+    origin_subject = _get_child(snapshot.subjects(), task.subject_id)
+    origin_session = _get_child(snapshot.sessions(task.subject_id), task.session_id)
+    if task.project_files:
+        _plan_container(snapshot.get(origin_session.parents.project), dest_proj_id, _get_filenames(dest_proj))
+
+    subject_code = export_config.get('subject', dict()).get('code', origin_subject.code)
+    dest_subject = dest_index.find_indexed('subject', dest_proj_id, subject_code)
+    dest_subject_id = dest_subject.id if dest_subject is not None else None
+    if task.subject_files or dest_subject_id is None:
+        _plan_container(origin_subject, dest_subject_id, _get_filenames(dest_subject), include_files=task.subject_files)
+
+    dest_session = None
+    if dest_subject_id:
+        session_label = export_config.get('session', dict()).get('label', origin_session.label)
+        dest_session = dest_index.find_indexed('session', dest_subject_id, session_label,
+                                               hash_string(origin_session.id))
+    dest_session_id = dest_session.id if dest_session is not None else None
+    _plan_container(origin_session, dest_session_id, _get_filenames(dest_session))
+
+    for origin_acquisition in snapshot.acquisitions(origin_session.id):
+        dest_acquisition = None
+        if dest_session_id:
+            dest_acquisition = dest_index.find_indexed('acquisition', dest_session_id, origin_acquisition.label,
+                                                       hash_string(origin_acquisition.id))
+        _plan_container(origin_acquisition, dest_acquisition.id if dest_acquisition is not None else None,
+                        _get_filenames(dest_acquisition))
+    PROFILE_CACHE.release(profile_hash, deid_profile, export_config)
+    return plan_rows
+
+
+# backends that export sessions on a pool of workers: threads, or the loky processes that joblib runs on
+POOL_BACKENDS = ['thread', 'process']
+# the asyncio backend exports sessions on an event loop with deid_export.async_export rather than a worker pool
+WORKER_BACKENDS = POOL_BACKENDS + ['asyncio']
+
+# flywheel.Client instances created by process-backend workers, keyed by api key
+_WORKER_CLIENTS = dict()
+# DestinationIndex instances created by process-backend workers, keyed by (api key, destination project id)
+_WORKER_DEST_INDEXES = dict()
+# AdaptiveLimiter instances installed on the clients of process-backend workers, keyed by api key
+_WORKER_LIMITERS = dict()
+
+
+@dataclass
+class SessionExportTask:
+    """A session to be exported by export_container along with the template and container file flags that apply to
+    it"""
+    session_id: str
+    subject_id: str
+    template_path: str
+    project_files: bool = False
+    subject_files: bool = False
+    error_msg: str = None
+    # the subject template built from the subject csv, which is used instead of the template at template_path
+    template_dict: dict = None
+    # set (with session_id and subject_id None) for a task that only exports the files of this origin project
+    project_id: str = None
+
+    def get_template_dict(self):
+        """Returns a copy of the template that applies to the session"""
+        if self.template_dict is not None:
+            return copy.deepcopy(self.template_dict)
+        return load_template_dict(self.template_path)
+
+
+def run_session_export_task(fw_client, task, dest_proj_id, **export_kwargs):
+    """
+    Exports the session described by task (or reports its files as errors if task.error_msg is set)
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        task (SessionExportTask): the session to export
+        dest_proj_id (str): the id of the project to which to export
+        **export_kwargs: additional keyword arguments for export_session (e.g. overwrite, max_upload_workers)
 
-    if subject_csv_path and template_obj:
-        df = deid_template.validate(deid_template_path=template_path, csv_path=subject_csv_path,
-                                    subject_code_col=old_code_col, new_subject_code_col=new_code_col)
+    Returns:
+        tuple: (pandas.DataFrame or None, ExportSummary) the export status of the session's files and the session
+            export summary
+    """
+    summary = ExportSummary()
+    try:
+        session_df = _run_session_export_task(fw_client, task, dest_proj_id, summary, **export_kwargs)
+    finally:
+        # process workers have their own copy of the journal, commit its transitions before the task returns
+        if export_kwargs.get('journal') is not None:
+            export_kwargs['journal'].flush()
+    return session_df, summary
+
+
+def _run_session_export_task(fw_client, task, dest_proj_id, summary, **export_kwargs):
+    if task.error_msg:
+        template_dict = task.get_template_dict()
+        snapshot = export_kwargs.get('snapshot')
+        if snapshot is not None:
+            session_obj = snapshot.get(task.session_id)
+        else:
+            session_obj = fw_client.get_session(task.session_id)
+        with PROFILE_CACHE.checkout(template_dict) as (sess_deid_profile, _):
+            session_df = get_session_error_df(fw_client=fw_client, session_obj=session_obj, error_msg=task.error_msg,
+                                              deid_profile=sess_deid_profile, snapshot=snapshot)
+    elif task.session_id is None:
+        session_df = export_project_files(
+            fw_client=fw_client,
+            origin_project_id=task.project_id,
+            dest_proj_id=dest_proj_id,
+            template_path=task.template_path,
+            template_dict=task.template_dict,
+            csv_output_path=None,
+            summary=summary,
+            **export_kwargs)
+    else:
+        session_df = export_session(
+            fw_client=fw_client,
+            origin_session_id=task.session_id,
+            dest_proj_id=dest_proj_id,
+            template_path=task.template_path,
+            template_dict=task.template_dict,
+            subject_files=task.subject_files,
+            project_files=task.project_files,
+            csv_output_path=None,
+            summary=summary,
+            **export_kwargs)
+    return session_df
 
-    def _export_session(session_id, session_template_path, project_files=False,
-                        subject_files=False, sess_error_msg=None):
-        template_dict = load_template_dict(session_template_path)
 
-        if sess_error_msg:
-            sess_deid_profile, exp_dict = deid_template.load_deid_profile(template_dict)
-            session_obj = fw_client.get_session(session_id)
-            session_df = get_session_error_df(fw_client=fw_client, session_obj=session_obj, error_msg=sess_error_msg,
-                                              deid_profile=sess_deid_profile)
+def _run_session_export_task_in_process(api_key, task, dest_proj_id, use_dest_index=False, max_api_concurrency=0,
+                                        spool_max_bytes=0, spool_dir=None, **export_kwargs):
+    # flywheel.Client is not shared across processes, each worker creates its own from the api key
+    if api_key not in _WORKER_CLIENTS:
+        _WORKER_CLIENTS[api_key] = flywheel.Client(api_key)
+        if max_api_concurrency:
+            _WORKER_LIMITERS[api_key] = AdaptiveLimiter(initial_limit=max_api_concurrency,
+                                                        max_limit=max_api_concurrency)
+            install_limiter(_WORKER_CLIENTS[api_key], _WORKER_LIMITERS[api_key])
+    fw_client = _WORKER_CLIENTS[api_key]
+    if (SPOOL.max_bytes, SPOOL.base_dir) != (spool_max_bytes, spool_dir):
+        SPOOL.configure(max_bytes=spool_max_bytes, base_dir=spool_dir)
+    spool_counts_before = SPOOL.get_counts()
+    limiter = _WORKER_LIMITERS.get(api_key)
+    limiter_counts_before = limiter.get_counts() if limiter is not None else dict()
+    cache_counts_before = CONTAINER_CACHE.get_counts()
+    profile_counts_before = PROFILE_CACHE.get_counts()
+    retry_counts_before = get_retry_counts()
+    dest_index = None
+    if use_dest_index:
+        # Other workers create containers that this worker's index will not see, so misses are confirmed by query
+        index_key = (api_key, dest_proj_id)
+        if index_key not in _WORKER_DEST_INDEXES:
+            _WORKER_DEST_INDEXES[index_key] = DestinationIndex(fw_client, dest_proj_id, authoritative=False)
+            counts_before = dict.fromkeys(_WORKER_DEST_INDEXES[index_key].get_counts().keys(), 0)
         else:
-            session_df = export_session(
-                fw_client=fw_client,
-                origin_session_id=session_id,
-                dest_proj_id=dest_proj_id,
-                template_path=session_template_path,
-                subject_files=subject_files,
-                project_files=project_files,
-                csv_output_path=None,
-                overwrite=overwrite)
-        df_count = session_df['state'].value_counts().get('error', 0)
-
-        if isinstance(session_df, pd.DataFrame):
-            if csv_output_path and not os.path.isfile(csv_output_path) and (len(session_df) >= 1):
-                session_df.to_csv(csv_output_path, index=False)
-            elif csv_output_path and os.path.isfile(csv_output_path) and (len(session_df) >= 1):
-                session_df.to_csv(csv_output_path, mode='a', header=False, index=False)
-        return df_count
-
-    def _get_subject_template(subject_obj, directory_path):
-        subj_template_path = os.path.join(directory_path, f'{subject_obj.id}_{os.path.basename(template_path)}')
+            counts_before = _WORKER_DEST_INDEXES[index_key].get_counts()
+        dest_index = _WORKER_DEST_INDEXES[index_key]
+    try:
+        session_df, summary = run_session_export_task(fw_client, task, dest_proj_id, dest_index=dest_index,
+                                                      **export_kwargs)
+    finally:
+        # the journal is unpickled for each task, so its connection would not be used again
+        if export_kwargs.get('journal') is not None:
+            export_kwargs['journal'].close()
+    if dest_index is not None:
+        for key, count in dest_index.get_counts().items():
+            summary.increment(key, count - counts_before[key])
+    for key, count in CONTAINER_CACHE.get_counts().items():
+        summary.increment(key, count - cache_counts_before[key])
+    for key, count in PROFILE_CACHE.get_counts().items():
+        summary.increment(key, count - profile_counts_before[key])
+    for key, count in get_retry_counts().items():
+        summary.increment(key, count - retry_counts_before.get(key, 0))
+    for key, count in SPOOL.get_counts().items():
+        summary.increment(key, count - spool_counts_before[key])
+    summary.update_max('spool_reserved_bytes', SPOOL.max_reserved_bytes)
+    if limiter is not None:
+        for key, count in limiter.get_counts().items():
+            summary.increment(key, count - limiter_counts_before[key])
+        summary.update_max('api_concurrency_limit', limiter.max_limit_reached)
+    return session_df, summary
+
+
+def iter_session_export_results(fw_client, tasks, dest_proj_id, max_workers=1, backend='thread',
+                                max_api_concurrency=0, **export_kwargs):
+    """
+    Exports the sessions described by tasks, yielding (task, session_df, session_summary) tuples as the sessions are
+    exported
+
+    When max_workers > 1, sessions are exported concurrently and their results are yielded in the order in which they
+    complete, rather than the order of tasks. The first session of each subject is exported before the
+    rest of that subject's sessions so that sessions of the same subject do not race to create the destination subject
+    (this session also carries the subject and project files). With the asyncio backend, the files of each session are
+    also downloaded, de-identified and uploaded concurrently.
+
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        tasks (list): list of SessionExportTask objects
+        dest_proj_id (str): the id of the project to which to export
+        max_workers (int): the maximum number of sessions to export concurrently
+        backend (str): 'thread', 'process' or 'asyncio'
+        max_api_concurrency (int): the maximum number of concurrent API calls of process-backend workers, which
+            is shared between the workers (in the thread backend, calls are limited by fw_client's limiter), or of
+            API calls awaited at once in the asyncio backend
+        **export_kwargs: additional keyword arguments for export_session (e.g. overwrite, max_upload_workers)
+
+    Yields:
+        tuple: (SessionExportTask, pandas.DataFrame or None, ExportSummary)
+    """
+    if backend not in WORKER_BACKENDS:
+        raise ValueError(f'Unknown backend {backend}. Must be one of {WORKER_BACKENDS}')
+
+    if backend == 'asyncio':
+        # imported here since deid_export.async_export extends SessionExporter
+        from deid_export.async_export import iter_export_tasks_async
+        log.info(f'Exporting {len(tasks)} sessions with {max_workers} concurrent asyncio sessions')
+        loop = asyncio.new_event_loop()
+        results = iter_export_tasks_async(fw_client, tasks, dest_proj_id, max_workers=max_workers,
+                                          max_api_concurrency=max_api_concurrency, **export_kwargs)
         try:
-            subj_template_path = deid_template.get_updated_template(
-                df=df, deid_template=template_obj, subject_code=subject_obj.code,
-                subject_code_col=old_code_col, dest_template_path=subj_template_path)
-            error_msg = None
-        except Exception as e:
-            error_msg = f'An exception occured when creating subject template for {subject.code}: {e}'
-            log.error(error_msg, exc_info=True)
-        return subj_template_path, error_msg
-
-    def _export_subject(subject_obj, project_files=False):
-        subject_error_count = 0
-        subj_error_msg = None
-        with tempfile.TemporaryDirectory() as temp_dir:
-            subj_template_path = template_path
-            if isinstance(df, pd.DataFrame):
-                subj_template_path, subj_error_msg = _get_subject_template(subject_obj=subject_obj,
-                                                                           directory_path=temp_dir)
+            while True:
+                try:
+                    result = loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield result
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+        return
+
+    if not max_workers or max_workers <= 1:
+        for task in tasks:
+            yield (task, *run_session_export_task(fw_client, task, dest_proj_id, **export_kwargs))
+        return
+
+    if backend == 'process':
+        task_func = _run_session_export_task_in_process
+        client_arg = get_api_key_from_client(fw_client)
+        # snapshots and indexes are not shared across processes, workers load their own
+        export_kwargs.pop('snapshot', None)
+        export_kwargs['use_dest_index'] = export_kwargs.pop('dest_index', None) is not None
+        # each worker's client limits its own calls, and each worker's spool its own space, to a share of the total
+        if max_api_concurrency:
+            export_kwargs['max_api_concurrency'] = max(1, max_api_concurrency // max_workers)
+        if SPOOL.max_bytes:
+            export_kwargs['spool_max_bytes'] = max(1, SPOOL.max_bytes // max_workers)
+        export_kwargs['spool_dir'] = SPOOL.base_dir
+        # the executor is reused by later exports, as joblib's loky backend reuses it, so it is not shut down
+        executor = get_reusable_executor(max_workers=max_workers)
+    else:
+        task_func = run_session_export_task
+        client_arg = fw_client
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    seen_subjects = set()
+    first_indices = list()
+    other_indices = list()
+    for index, task in enumerate(tasks):
+        if task.subject_id in seen_subjects:
+            other_indices.append(index)
+        else:
+            seen_subjects.add(task.subject_id)
+            first_indices.append(index)
+
+    log.info(f'Exporting {len(tasks)} sessions with {max_workers} {backend} workers')
+    futures = dict()
+    try:
+        for indices in [first_indices, other_indices]:
+            futures = {executor.submit(task_func, client_arg, tasks[index], dest_proj_id, **export_kwargs): index
+                       for index in indices}
+            for future in concurrent.futures.as_completed(futures):
+                yield (tasks[futures[future]], *future.result())
+    finally:
+        # sessions that have not started when the results are no longer consumed (e.g. an exception) are not exported
+        for future in futures:
+            future.cancel()
+        if backend == 'thread':
+            executor.shutdown(wait=True)
+
+
+def append_status_csv(session_df, csv_output_path):
+    """
+    Writes session_df to csv_output_path, appending without a header if the file already exists
+    Args:
+        session_df (pandas.DataFrame): the export status DataFrame for a session
+        csv_output_path (str): path to the status csv
+    """
+    if not isinstance(session_df, pd.DataFrame) or len(session_df) < 1:
+        return
+    # error and skipped file statuses may not have every column, and appended rows must line up with the header
+    session_df = session_df.reindex(columns=STATUS_COLUMNS)
+    if not os.path.isfile(csv_output_path):
+        session_df.to_csv(csv_output_path, index=False)
+    else:
+        session_df.to_csv(csv_output_path, mode='a', header=False, index=False)
+
+
+# TODO: incorporate filetype list
+@profile_option
+@spool_option
+def export_container(fw_client, container_id, dest_proj_id, template_path, csv_output_path=None, overwrite=False,
+                     subject_csv_path=None, new_code_col=deid_template.DEFAULT_NEW_SUBJECT_CODE_COL,
+                     old_code_col=deid_template.DEFAULT_SUBJECT_CODE_COL, max_workers=1, backend='thread',
+                     max_upload_workers=1, pipeline_depth=0, journal_path=None, resume=False, delta=False,
+                     session_ids=None, plan=False, plan_output_path=None, throughput_history_path=None,
+                     max_api_concurrency=DEFAULT_MAX_API_CONCURRENCY, shard_index=0, shard_count=1,
+                     in_memory_max_bytes=0, snapshot=None, dest_index=None, failed_session_ids=None):
+    if resume and not journal_path:
+        raise ValueError('journal_path is required to resume an export')
+    validate_shard(shard_index, shard_count)
+    start_time = time.time()
+    container = fw_client.get(container_id).reload()
+    export_summary = ExportSummary()
+    if container.container_type not in ['subject', 'project', 'session']:
+        raise ValueError(f'Cannot load container type {container.container_type}. Must be session, subject, or project')
+    # a snapshot and index may be passed in by a caller that exports the same containers repeatedly (watch_container)
+    if snapshot is None:
+        snapshot = OriginSnapshot(fw_client, container)
+    if dest_index is None:
+        dest_index = DestinationIndex(fw_client, dest_proj_id)
+    snapshot_api_calls_before = snapshot.api_calls
+    dest_index_counts_before = dest_index.get_counts()
+    # Containers cached by a previous export in this process may have been modified since
+    CONTAINER_CACHE.clear()
+    cache_counts_before = CONTAINER_CACHE.get_counts()
+    profile_counts_before = PROFILE_CACHE.get_counts()
+    retry_counts_before = get_retry_counts()
+    spool_counts_before = SPOOL.get_counts()
+    limiter = None
+    if max_api_concurrency:
+        # start at the concurrency the worker settings would use without a limiter, and adapt from there
+        initial_limit = max(4, max_workers * max(1, max_upload_workers or 1))
+        limiter = AdaptiveLimiter(initial_limit=initial_limit, max_limit=max_api_concurrency)
+        install_limiter(fw_client, limiter)
+    journal = None
+    try:
+        journal = ExportJournal(journal_path) if journal_path else None
+        if resume and not plan and csv_output_path and os.path.isfile(csv_output_path):
+            # the status of files exported by the previous run is carried over from the journal
+            log.info(f'Replacing status csv {csv_output_path} from the previous run')
+            os.remove(csv_output_path)
+
+        template_obj = None
+        df = None
+        error_count = 0
+        template_obj = load_template_dict(template_path)
+
+        if subject_csv_path and template_obj:
+            df = deid_template.validate(deid_template_path=template_path, csv_path=subject_csv_path,
+                                        subject_code_col=old_code_col, new_subject_code_col=new_code_col)
+
+        subject_templates = None
+        if isinstance(df, pd.DataFrame):
+            # the csv columns are resolved against the template once, subject templates are then built in memory
+            subject_templates = deid_template.SubjectTemplateMap(df, template_obj, subject_code_col=old_code_col)
+
+        def _get_subject_template(subject_obj):
+            subj_template_dict = None
+            try:
+                subj_template_dict = subject_templates.get_template(subject_obj.code)
+                error_msg = None
+            except Exception as e:
+                error_msg = f'An exception occured when creating subject template for {subject_obj.code}: {e}'
+                log.error(error_msg, exc_info=True)
+            return subj_template_dict, error_msg
+
+        def _get_subject_tasks(subject_obj, project_files=False):
+            subj_error_msg = None
+            subj_template_dict = None
+            if subject_templates is not None:
+                subj_template_dict, subj_error_msg = _get_subject_template(subject_obj=subject_obj)
+            subject_tasks = list()
             subject_files = True
-            for session in subject_obj.sessions():
-                sess_count = _export_session(session_id=session.id, session_template_path=subj_template_path,
-                                             project_files=project_files, subject_files=subject_files,
-                                             sess_error_msg=subj_error_msg)
-                subject_error_count += sess_count
+            for session in snapshot.sessions(subject_obj.id):
+                subject_tasks.append(SessionExportTask(session_id=session.id, subject_id=subject_obj.id,
+                                                       template_path=template_path, template_dict=subj_template_dict,
+                                                       project_files=project_files, subject_files=subject_files,
+                                                       error_msg=subj_error_msg))
                 subject_files = False
                 project_files = False
-        return subject_error_count
+            return subject_tasks
+
+        tasks = list()
+        if container.container_type == 'project':
+            project_files = shard_index == PROJECT_FILES_SHARD
+            for subject in snapshot.subjects():
+                if not in_shard(subject.id, shard_index, shard_count):
+                    continue
+                subject_tasks = _get_subject_tasks(subject_obj=subject, project_files=project_files)
+                tasks.extend(subject_tasks)
+                if subject_tasks:
+                    project_files = False
+            if project_files and session_ids is None:
+                # no session of this shard carries the project files
+                tasks.append(SessionExportTask(session_id=None, subject_id=None, template_path=template_path,
+                                               project_files=True, project_id=container.id))
+
+        elif container.container_type == 'subject':
+            tasks = _get_subject_tasks(subject_obj=container, project_files=False)
+
+        elif container.container_type == 'session':
+            session_export_error = None
+            sess_template_dict = None
+            if subject_templates is not None:
+                sess_template_dict, session_export_error = _get_subject_template(subject_obj=container.subject)
+            tasks = [SessionExportTask(session_id=container_id, subject_id=container.subject.id,
+                                       template_path=template_path, template_dict=sess_template_dict,
+                                       error_msg=session_export_error)]
+
+        if session_ids is not None:
+            tasks = [task for task in tasks if task.session_id in session_ids]
+        if shard_count > 1:
+            # subjects of a project are filtered as they are listed, those of a subject or session are filtered here
+            tasks = [task for task in tasks
+                     if task.project_id is not None or in_shard(task.subject_id, shard_index, shard_count)]
+            log.info(f'Shard {shard_index} of {shard_count} is exporting {len(tasks)} sessions')
+
+        if plan:
+            plan_rows = list()
+            dest_proj = fw_client.get_project(dest_proj_id)
+            for task in tasks:
+                plan_rows.extend(plan_session(task=task, dest_proj_id=dest_proj_id, snapshot=snapshot,
+                                              dest_index=dest_index, dest_proj=dest_proj))
+            plan_df = pd.DataFrame(plan_rows, columns=PLAN_COLUMNS)
+            if plan_output_path:
+                plan_df.to_csv(plan_output_path, index=False)
+            log_export_plan(plan_df, load_throughput_history(throughput_history_path), overwrite=overwrite)
+            # nothing is exported, so there are no file export errors: the expected ones are reported in the plan
+            return 0
+
+        session_results = iter_session_export_results(fw_client=fw_client, tasks=tasks, dest_proj_id=dest_proj_id,
+                                                      max_workers=max_workers, backend=backend, overwrite=overwrite,
+                                                      max_upload_workers=max_upload_workers,
+                                                      pipeline_depth=pipeline_depth, snapshot=snapshot,
+                                                      dest_index=dest_index, journal=journal, resume=resume,
+                                                      delta=delta, max_api_concurrency=max_api_concurrency,
+                                                      in_memory_max_bytes=in_memory_max_bytes)
+        for task, session_df, session_summary in session_results:
+            export_summary.merge(session_summary)
+            if task.session_id is not None:
+                export_summary.increment('sessions')
+            if isinstance(session_df, pd.DataFrame):
+                session_error_count = session_df['state'].value_counts().get('error', 0)
+                error_count += session_error_count
+                # reported to a caller that retries the sessions with errors (watch_container)
+                if session_error_count and failed_session_ids is not None and task.session_id is not None:
+                    failed_session_ids.add(task.session_id)
+                if csv_output_path:
+                    append_status_csv(session_df, csv_output_path)
+        if csv_output_path and not os.path.isfile(csv_output_path):
+            # no file statuses were reported (e.g. a shard without sessions), the csv is written with its header only
+            pd.DataFrame(columns=STATUS_COLUMNS).to_csv(csv_output_path, index=False)
+
+        log.info(f'Export for {container.container_type} {container.id} is complete with {error_count} file export '
+                 'errors')
+        export_summary.increment('origin_snapshot_api_calls', snapshot.api_calls - snapshot_api_calls_before)
+        for key, count in dest_index.get_counts().items():
+            export_summary.increment(key, count - dest_index_counts_before[key])
+        # process workers report the counts of their own caches with each session summary
+        for key, count in CONTAINER_CACHE.get_counts().items():
+            export_summary.increment(key, count - cache_counts_before[key])
+        for key, count in PROFILE_CACHE.get_counts().items():
+            export_summary.increment(key, count - profile_counts_before[key])
+        for key, count in get_retry_counts().items():
+            export_summary.increment(key, count - retry_counts_before.get(key, 0))
+        for key, count in SPOOL.get_counts().items():
+            export_summary.increment(key, count - spool_counts_before[key])
+        export_summary.update_max('spool_reserved_bytes', SPOOL.max_reserved_bytes)
+        if limiter is not None:
+            for key, count in limiter.get_counts().items():
+                export_summary.increment(key, count)
+            export_summary.update_max('api_concurrency_limit', limiter.max_limit_reached)
+            log.info(f'API concurrency limit is {int(limiter.limit)} at the end of the export')
+        export_summary.log_summary(log)
+        if throughput_history_path:
+            record_throughput(throughput_history_path, file_count=export_summary.counters.get('upload_attempts', 0),
+                              byte_count=export_summary.counters.get('upload_bytes', 0),
+                              seconds=time.time() - start_time)
+        return error_count
+    finally:
+        if journal is not None:
+            journal.close()
+        if limiter is not None:
+            uninstall_limiter(fw_client)
+
+
+def load_watch_state(state_path):
+    """
+    Loads the watch state (the high-water mark of origin modification times already exported and the sessions to
+        retry) from state_path
+    Args:
+        state_path (str): path to the json state file
 
-    if container.container_type not in ['subject', 'project', 'session']:
-        raise ValueError(f'Cannot load container type {container.container_type}. Must be session, subject, or project')
+    Returns:
+        dict: the watch state, empty if state_path does not exist
+    """
+    if not state_path or not os.path.isfile(state_path):
+        return dict()
+    with open(state_path, 'r') as f_data:
+        return json.load(f_data)
+
+
+def save_watch_state(state_path, state):
+    """Writes the watch state to state_path, replacing the previous state atomically"""
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f_data:
+        json.dump(state, f_data)
+    os.replace(tmp_path, state_path)
+
+
+def format_watch_timestamp(timestamp):
+    """Formats a datetime as a UTC ISO 8601 string for use in finder filters"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def get_modified_session_ids(fw_client, container, since=None):
+    """
+    Returns the ids of the sessions within container that were created or modified, or that contain acquisitions that
+        were created or modified, after since
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        container (flywheel.Project, flywheel.Subject or flywheel.Session): the container to search
+        since (str): a UTC ISO 8601 timestamp, if None all sessions are returned
+
+    Returns:
+        tuple: (set, str) the set of session ids and the latest modified timestamp of the matching containers (or
+            since if there are none)
+    """
+    if container.container_type == 'session':
+        session_filter = f'_id={container.id}'
+        acquisition_filter = f'parents.session={container.id}'
+    else:
+        session_filter = acquisition_filter = f'parents.{container.container_type}={container.id}'
+    if since:
+        session_filter = f'{session_filter},modified>{since}'
+        acquisition_filter = f'{acquisition_filter},modified>{since}'
+
+    session_ids = set()
+    # the high-water mark uses the server's timestamps so that it does not depend on the local clock
+    high_water_mark = since
+    for finder, filter_str in [(fw_client.sessions, session_filter), (fw_client.acquisitions, acquisition_filter)]:
+        for modified_container in finder.iter_find(filter_str):
+            if modified_container.container_type == 'session':
+                session_ids.add(modified_container.id)
+            else:
+                session_ids.add(modified_container.parents.session)
+            if modified_container.modified:
+                modified = format_watch_timestamp(modified_container.modified)
+                if not high_water_mark or modified > high_water_mark:
+                    high_water_mark = modified
+    return session_ids, high_water_mark
+
+
+def watch_container(fw_client, container_id, dest_proj_id, template_path, state_path, poll_interval=60,
+                    max_polls=None, **export_kwargs):
+    """
+    Repeatedly exports the sessions within a container that were created or modified since the previous poll.
+
+    The high-water mark (the latest modified timestamp of the containers exported so far) is persisted to state_path
+        after each poll so that a restarted watch picks up where it left off. A poll that fails is retried from the
+        same high-water mark at the next interval. The ids of sessions with file export errors are persisted along
+        with it and the sessions are exported again by the next poll, until they are exported without errors (use
+        delta or overwrite so that their files exported by a previous poll are not reported as existing). The origin
+        snapshot and destination index are built by the first poll that exports sessions and kept for the rest of the
+        watch: later polls only reload the modified sessions.
+    Args:
+        fw_client (flywheel.Client): an instance of the flywheel client
+        container_id (str): the id of the project, subject or session to watch
+        dest_proj_id (str): the id of the project to which to export
+        template_path (str): the path to the de-identification template
+        state_path (str): path to the json file in which to persist the high-water mark
+        poll_interval (float): the number of seconds between the start of consecutive polls
+        max_polls (int): the number of polls after which to stop watching, watches indefinitely if None
+        **export_kwargs: additional keyword arguments for export_container (e.g. max_workers, csv_output_path)
 
-    elif container.container_type == 'project':
-        project_files = True
-        for subject in container.subjects():
-            subj_error_count = _export_subject(subject_obj=subject, project_files=project_files)
-            error_count += subj_error_count
-            project_files = False
-
-    elif container.container_type == 'subject':
-        project_files = False
-        error_count = _export_subject(subject_obj=container, project_files=project_files)
-
-    elif container.container_type == 'session':
-        session_export_error = None
-        with tempfile.TemporaryDirectory() as temp_dir:
-            sess_template_path = template_path
-            if isinstance(df, pd.DataFrame):
-                sess_template_path, session_export_error = _get_subject_template(subject_obj=container.subject,
-                                                                                 directory_path=temp_dir)
-            error_count = _export_session(session_id=container_id, session_template_path=sess_template_path,
-                                          sess_error_msg=session_export_error)
-
-    log.info(f'Export for {container.container_type} {container.id} is complete with {error_count} file export errors')
+    Returns:
+        int: the total number of file export errors
+    """
+    container = fw_client.get(container_id)
+    state = load_watch_state(state_path)
+    if state.get('container_id') not in (None, container_id):
+        raise ValueError(f'{state_path} records the watch state of container {state["container_id"]}, '
+                         f'not {container_id}')
+    error_count = 0
+    poll_count = 0
+    snapshot = None
+    dest_index = None
+    while max_polls is None or poll_count < max_polls:
+        poll_start = time.time()
+        poll_count += 1
+        since = state.get('high_water_mark')
+        retry_session_ids = set(state.get('failed_session_ids') or list())
+        failed_session_ids = set()
+        try:
+            session_ids, high_water_mark = get_modified_session_ids(fw_client, container, since=since)
+            if retry_session_ids:
+                log.info(f'Retrying {len(retry_session_ids)} sessions with file export errors')
+                session_ids = session_ids | retry_session_ids
+            if session_ids:
+                log.info(f'Exporting {len(session_ids)} sessions modified since {since or "the start"}')
+                if snapshot is None:
+                    snapshot = OriginSnapshot(fw_client, fw_client.get(container_id))
+                else:
+                    snapshot.refresh_sessions(session_ids)
+                if dest_index is None:
+                    dest_index = DestinationIndex(fw_client, dest_proj_id)
+                error_count += export_container(fw_client=fw_client, container_id=container_id,
+                                                dest_proj_id=dest_proj_id, template_path=template_path,
+                                                session_ids=session_ids, snapshot=snapshot, dest_index=dest_index,
+                                                failed_session_ids=failed_session_ids, **export_kwargs)
+                # only the first export resumes the previous run, later polls would discard the status csv
+                export_kwargs['resume'] = False
+            else:
+                log.debug(f'No sessions modified since {since}')
+            state = {'container_id': container_id, 'high_water_mark': high_water_mark,
+                     'failed_session_ids': sorted(failed_session_ids)}
+            save_watch_state(state_path, state)
+        except Exception as e:
+            log.error(f'Watch poll {poll_count} failed and will be retried: {e}', exc_info=True)
+
+        if max_polls is not None and poll_count >= max_polls:
+            break
+        time.sleep(max(0.0, poll_interval - (time.time() - poll_start)))
     return error_count
 
 
@@ -625,7 +1669,53 @@ if __name__ == '__main__':
                         help='Overwrite existing files in the destination project where present',
                         action='store_true')
     parser.add_argument('--subject_csv_path', help='path to the subject csv', default=None)
+    parser.add_argument('--max_workers', help='number of sessions to export concurrently', type=int, default=1)
+    parser.add_argument('--worker_backend', help='worker pool backend used when max_workers > 1',
+                        choices=WORKER_BACKENDS, default='thread')
+    parser.add_argument('--max_upload_workers', help='number of concurrent file uploads per session', type=int,
+                        default=1)
+    parser.add_argument('--pipeline_depth', type=int, default=0,
+                        help='overlap download, de-id and upload with at most this many files queued between stages')
+    parser.add_argument('--journal_path', help='path of the SQLite journal of file export states', default=None)
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files that the journal records as exported by a previous run')
+    parser.add_argument('--delta', action='store_true',
+                        help='skip files whose origin content and template are unchanged since they were exported')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, exporting sessions created or modified since the previous poll')
+    parser.add_argument('--poll_interval', type=float, default=60,
+                        help='number of seconds between polls in watch mode')
+    parser.add_argument('--state_path', default=None,
+                        help='path of the json file that persists the watch high-water mark and failed sessions')
+    parser.add_argument('--plan', action='store_true',
+                        help='write an export plan with file counts, sizes and collisions without exporting anything')
+    parser.add_argument('--plan_output_path', default=None, help='path to which to write the export plan csv')
+    parser.add_argument('--throughput_history_path', default=None,
+                        help='path of the json history of export throughput used to estimate export durations')
+    parser.add_argument('--max_api_concurrency', type=int, default=DEFAULT_MAX_API_CONCURRENCY,
+                        help='upper bound of the adaptive limit on concurrent API calls, 0 disables the limit')
+    parser.add_argument('--profile', choices=PROFILE_MODES, default=None,
+                        help='profile the whole run, or the de-identification of the slowest files')
+    parser.add_argument('--profile_top_n', type=int, default=DEFAULT_TOP_N,
+                        help='number of slowest files whose profiles are kept with --profile files')
+    parser.add_argument('--profile_output_dir', default=None,
+                        help='directory to which to write profiles, defaults to the directory of the output csv')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='index of the shard of subjects to export, between 0 and shard_count - 1')
+    parser.add_argument('--shard_count', type=int, default=1,
+                        help='number of shards among which subjects are partitioned, each shard writes its own csv '
+                             '(merge them with python -m deid_export.sharding)')
+    parser.add_argument('--spool_max_mb', type=int, default=0,
+                        help='MB of local disk that downloaded, extracted and de-identified files may use at once, '
+                             'new files wait for space beyond this, 0 for no limit')
+    parser.add_argument('--in_memory_max_kb', type=int, default=0,
+                        help='KB up to which files whose file profile allows it (e.g. xml, json) are downloaded, '
+                             'de-identified and uploaded in memory, 0 to always use the disk')
+    parser.add_argument('--spool_dir', default=None,
+                        help='directory in which to write downloaded, extracted and de-identified files, defaults to '
+                             'the system temporary directory')
     args = parser.parse_args()
+    exit_on_sigterm()
     if args.api_key:
         fw = flywheel.Client(args.api_key)
     else:
@@ -636,13 +1726,43 @@ if __name__ == '__main__':
     csv_output_path = os.path.join(os.getcwd(), f'{origin_container.container_type}_{origin_container.id}_export.csv')
     if args.csv_output_path:
         csv_output_path = args.csv_output_path
+    csv_output_path = get_shard_path(csv_output_path, args.shard_index, args.shard_count)
 
-    export_container(
+    export_args = dict(
         fw_client=fw,
         container_id=origin_container.id,
         dest_proj_id=dest_project.id,
         template_path=args.template_path,
         csv_output_path=csv_output_path,
         overwrite=args.overwrite_files,
-        subject_csv_path=args.subject_csv_path
+        subject_csv_path=args.subject_csv_path,
+        max_workers=args.max_workers,
+        backend=args.worker_backend,
+        max_upload_workers=args.max_upload_workers,
+        pipeline_depth=args.pipeline_depth,
+        journal_path=get_shard_path(args.journal_path, args.shard_index, args.shard_count),
+        resume=args.resume,
+        delta=args.delta,
+        throughput_history_path=args.throughput_history_path,
+        max_api_concurrency=args.max_api_concurrency,
+        profile=args.profile,
+        profile_top_n=args.profile_top_n,
+        profile_output_dir=args.profile_output_dir,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        spool_max_bytes=args.spool_max_mb * 2 ** 20,
+        in_memory_max_bytes=args.in_memory_max_kb * 2 ** 10,
+        spool_dir=args.spool_dir
     )
+    if args.watch:
+        state_path = args.state_path or os.path.join(
+            os.getcwd(), f'{origin_container.container_type}_{origin_container.id}_watch_state.json'
+        )
+        watch_container(state_path=state_path, poll_interval=args.poll_interval, **export_args)
+    elif args.plan:
+        plan_output_path = args.plan_output_path or os.path.join(
+            os.getcwd(), f'{origin_container.container_type}_{origin_container.id}_export_plan.csv'
+        )
+        export_container(plan=True, plan_output_path=plan_output_path, **export_args)
+    else:
+        export_container(**export_args)
@@ -3,21 +3,42 @@ import contextlib
 import filecmp
 import fs
 from fs import osfs
+import joblib
+from fs.memoryfs import MemoryFS
 import json
 import logging
 import os
 import shutil
-import tempfile
 import zipfile
 
 
 import yaml
 
-from flywheel_migration import deidentify
 from flywheel_migration.deidentify.deid_profile import DeIdProfile
 
+from deid_export.profile_cache import PROFILE_CACHE, get_content_hash, validate_profile
+from deid_export.spool import FILE_SPOOL_FACTOR, SPOOL, get_path_size
+from deid_export.zip_writer import (COMPRESSION_TYPES, DEFAULT_COMPRESSION, is_member_unchanged, open_output_zip,
+                                    validate_compression, write_members)
+
 log = logging.getLogger(__name__)
 
+# file profiles that read and write files only through the pyfilesystem API, so that they can de-identify files held
+# in a MemoryFS (the others, e.g. dicom, png and tiff, need system paths)
+MEMORY_FS_PROFILES = ('csv', 'json', 'key-value-text-file', 'table', 'tsv', 'xml')
+# the default maximum uncompressed size of the archive members that are extracted and de-identified together when
+# streaming an archive
+DEFAULT_BATCH_BYTES = 64 * 2 ** 20
+
+# file profiles loaded by process workers, keyed by (profile path, profile content hash, profile name, date increment)
+_WORKER_FILE_PROFILES = dict()
+
+
+def get_zip_size(zip_path):
+    """Returns the total uncompressed size of the members of a zip"""
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        return sum(zip_item.file_size for zip_item in zipf.infolist())
+
 
 def extract_files(zip_path, output_directory):
     """Extracts the files in a zip to an output directory
@@ -39,40 +60,61 @@ def extract_files(zip_path, output_directory):
     return file_list
 
 
-def recreate_zip(dest_zip, file_directory, output_directory=None):
+def _get_replacement_path(file_path, zip_item, changed_files=None):
+    # the file with which to replace a member, or None to copy the member as it is
+    if zip_item.is_dir():
+        return None
+    if not os.path.isfile(file_path):
+        log.warning(f'Extracted file {file_path} does not exist! Copying from original archive.')
+        return None
+    if changed_files is not None and os.path.normpath(file_path) not in changed_files:
+        return None
+    if is_member_unchanged(file_path, zip_item):
+        return None
+    return file_path
+
+
+def recreate_zip(dest_zip, file_directory, output_directory=None, changed_files=None,
+                 compression=DEFAULT_COMPRESSION, compresslevel=None, compression_workers=1):
     """Return path to resultant zip given dest_zip and file_directory
 
     Given a dest_zip and file_directory that contains extracted(modified) files from dest_zip,
     this function will replace dest_zip with a zip that contains files from file_directory that
     match the original zip's filename. If output_directory is provided, the resulting zip will be saved to
-    output_directory rather than overwriting dest_zip.
+    output_directory rather than overwriting dest_zip. Members whose file is identical to the original (or not in
+    changed_files) are copied from dest_zip without being decompressed, keeping their original compression.
 
     Args:
         dest_zip (str): Path to the zip archive to be modified
         file_directory (str): Path to the directory that contains files to replace those in dest_zip
         output_directory (str): Directory to which to save output zip, if None, will overwrite dest_zip
+        changed_files (list): Optional paths of the files in file_directory that may differ from the original
+            members, if not provided, every file is compared to its member
+        compression (str): the compression of the replaced members, one of zip_writer.COMPRESSION_TYPES
+        compresslevel (int): the compression level, the default of the compression if None
+        compression_workers (int): the number of threads that deflate replaced members
 
     Returns:
         (str): A path to the resultant zip
     """
-    # temporary directory context
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # temporary file context
-        _, tmp_zip_path = tempfile.mkstemp(dir=temp_dir)
+    if changed_files is not None:
+        changed_files = {os.path.normpath(file_path) for file_path in changed_files}
+    # spool directory context, with space for the new zip
+    with SPOOL.reserve(get_zip_size(dest_zip)) as temp_dir:
+        tmp_zip_path = os.path.join(temp_dir, os.path.basename(dest_zip))
         # read zip context
         with zipfile.ZipFile(dest_zip, 'r') as zin:
             # write zip context
-            with zipfile.ZipFile(tmp_zip_path, 'w') as zout:
+            with open_output_zip(tmp_zip_path, compression=compression, compresslevel=compresslevel) as zout:
                 # preserve the archive comment
                 zout.comment = zin.comment
-                for zip_item in zin.infolist():
-                    file_path = os.path.join(file_directory, zip_item.filename)
-                    # If the file exists, in file_directory, add that, otherwise, add from dest_zip
-                    if os.path.exists(file_path):
-                        zout.write(file_path, zip_item.filename)
-                    else:
-                        log.warning(f'Extracted file {file_path} does not exist! Copying from original archive.')
-                        zout.writestr(zip_item.filename, zin.read(zip_item.filename))
+                # If the file exists, in file_directory, and was changed, add that, otherwise, add from dest_zip
+                members = (
+                    (zip_item, _get_replacement_path(os.path.join(file_directory, zip_item.filename), zip_item,
+                                                     changed_files=changed_files))
+                    for zip_item in zin.infolist()
+                )
+                write_members(zin, zout, members, compression_workers=compression_workers)
 
         if output_directory:
             output_path = os.path.join(output_directory, os.path.basename(dest_zip))
@@ -175,8 +217,184 @@ def deidentify_file(deid_profile, file_path, output_directory):
     return deid_path
 
 
+def deidentify_bytes(deid_profile, filename, content):
+    """
+    De-identifies a file held in memory, without writing to disk. The file must be handled by one of
+        MEMORY_FS_PROFILES
+
+    Args:
+        deid_profile(DeIdProfile): the de-identification profile to use to process the file
+        filename (str): the name of the file
+        content (bytes): the content of the file
+
+    Returns:
+        tuple: (str, bytes) the name and content of the de-identified file, or (None, None) if the profile did not
+            output a file
+    """
+    with MemoryFS() as src_fs, MemoryFS() as dst_fs:
+        src_fs.writebytes(filename, content)
+        deid_profile.process_file(src_fs=src_fs, src_file=filename, dst_fs=dst_fs)
+        deid_files = list(dst_fs.walk.files())
+        if not deid_files:
+            return None, None
+        return fs.path.basename(deid_files[0]), dst_fs.readbytes(deid_files[0])
+
+
+def load_file_profile(profile_path, profile_name='dicom', date_increment=None):
+    """
+    Loads the file profile profile_name of the de-id profile at profile_path, applying the date increment and the
+        remove_private_tags option of the template
+
+    Args:
+        profile_path (str): Path to the de-id profile
+        profile_name (str): Name of the profile to pass .get_file_profile()
+        date_increment (str): Date offset to apply to the profile
+
+    Returns:
+        flywheel_migration.deidentify.file_profile.FileProfile: the file profile
+    """
+    # Load the de-id profile as a dictionary, parsed once per template content. A new profile is compiled from it since
+    # callers patch the file profile
+    template_dict = PROFILE_CACHE.get_template(profile_path, parse_deid_template)
+    remove_private_tags = (template_dict.get(profile_name) or dict()).get('remove_private_tags') == True
+
+    deid_profile = DeIdProfile()
+    deid_profile.load_config(template_dict)
+    validate_profile(deid_profile, profile_path)
+
+    if date_increment:
+        deid_profile.date_increment = date_increment
+
+    # Get the dicom profile from the de-id profile
+    file_profile = deid_profile.get_file_profile(profile_name)
+    if remove_private_tags:
+        file_profile.remove_private_tags = True
+    return file_profile
+
+
+def _get_worker_file_profile(profile_path, profile_name, date_increment):
+    key = (profile_path, get_content_hash(profile_path), profile_name, date_increment)
+    if key not in _WORKER_FILE_PROFILES:
+        _WORKER_FILE_PROFILES[key] = load_file_profile(profile_path, profile_name=profile_name,
+                                                       date_increment=date_increment)
+    return _WORKER_FILE_PROFILES[key]
+
+
+def is_process_safe(file_profile):
+    """Returns True if files can be de-identified with file_profile in several processes at once. Pixel scrubbing
+    writes its filter and temporary files to fixed paths shared by all processes, so profiles that scrub pixels are
+    not."""
+    return not getattr(file_profile, 'pixel_actions', None) and not getattr(file_profile, 'detect', None)
+
+
+def _deidentify_file_chunk(profile_path, profile_name, date_increment, input_directory, output_directory, file_list):
+    file_profile = _get_worker_file_profile(profile_path, profile_name, date_increment)
+    # the state of each file loaded (its series, study and SOP instance UIDs), in order, so that the parent can
+    # validate the files of all chunks against a single file state
+    file_states = list()
+    load_record = file_profile.load_record
+
+    def recording_load_record(state, src_fs, path):
+        if isinstance(state, dict):
+            # each file is loaded as if it were the first, files are validated against each other by the parent
+            state.update({key: None for key in ('series_uid', 'session_uid') if key in state})
+            if 'sop_uids' in state:
+                state['sop_uids'] = set()
+        record, modified = load_record(state, src_fs, path)
+        if record is not None and hasattr(record, 'get'):
+            file_states.append((path, record.get('SeriesInstanceUID'), record.get('StudyInstanceUID'),
+                                record.get('SOPInstanceUID')))
+        return record, modified
+
+    with osfs.OSFS(input_directory) as src_fs, osfs.OSFS(output_directory) as dst_fs:
+        def default_path(state, record, path):
+            dst_fs.makedirs(fs.path.dirname(path), recreate=True)
+            return path
+
+        file_profile.get_dest_path = default_path
+        file_profile.load_record = recording_load_record
+        try:
+            file_profile.process_files(src_fs, dst_fs, file_list)
+        finally:
+            del file_profile.load_record
+    return file_states
+
+
+def _validate_file_states(file_states, file_state, output_directory):
+    """
+    Validates the series, study and SOP instance UIDs of files de-identified by process_files_parallel in file order,
+        as DicomFileProfile.load_record does when they are processed in a single call, removing the de-identified
+        copies of the files that re-use a SOPInstanceUID
+
+    Args:
+        file_states (list): (path, SeriesInstanceUID, StudyInstanceUID, SOPInstanceUID) tuples of the files loaded
+        file_state (dict): the file state of the profile, updated with the UIDs of the files
+        output_directory (str): Directory to which the files were de-identified
+    """
+    for file_path, series_uid, session_uid, sop_uid in file_states:
+        if file_state['series_uid'] is not None:
+            if series_uid != file_state['series_uid']:
+                log.warning('DICOM %s has a different SeriesInstanceUID (%s) from the rest of the series: %s',
+                            file_path, series_uid, file_state['series_uid'])
+            elif session_uid != file_state['session_uid']:
+                log.warning('DICOM %s has a different StudyInstanceUID (%s) from the rest of the series: %s',
+                            file_path, session_uid, file_state['session_uid'])
+        else:
+            file_state['series_uid'] = series_uid
+            file_state['session_uid'] = session_uid
+
+        if not sop_uid:
+            continue
+        if sop_uid in file_state['sop_uids']:
+            log.error(f'DICOM {file_path} re-uses SOPInstanceUID {sop_uid}, and will be excluded!')
+            deid_path = os.path.join(output_directory, file_path.lstrip('/'))
+            if os.path.isfile(deid_path):
+                os.remove(deid_path)
+        else:
+            file_state['sop_uids'].add(sop_uid)
+
+
+def process_files_parallel(profile_path, input_directory, output_directory, file_list, profile_name='dicom',
+                           date_increment=None, n_jobs=2, file_state=None):
+    """
+    De-identifies the files of file_list with n_jobs processes, as file_profile.process_files would in a single call.
+        file_list is split into n_jobs contiguous chunks, each de-identified by a worker with its own copy of the
+        profile (loaded once per worker process). Workers return the series, study and SOP instance UIDs of the files
+        they load, which are validated in file order against file_state: as when processed serially, files from
+        another series or study are reported, and a DICOM file that re-uses the SOPInstanceUID of an earlier file is
+        excluded from the output.
+
+    Args:
+        profile_path (str): Path to the de-id profile to apply
+        input_directory (str): Directory containing the files to be de-identified
+        output_directory (str): Directory to which to save de-identified files, at their paths in input_directory
+        file_list (list): relative paths of the files to process, in order
+        profile_name (str): Name of the profile to pass .get_file_profile()
+        date_increment (str): Date offset to apply to the profile
+        n_jobs (int): the number of worker processes
+        file_state (dict): the DICOM file state of files processed before file_list (e.g. earlier batches of an
+            archive), updated with the files of file_list
+    """
+    if file_state is None:
+        file_state = {'series_uid': None, 'session_uid': None, 'sop_uids': set()}
+    # create the output subdirectories up front, so that workers do not race to create them
+    for file_path in file_list:
+        os.makedirs(os.path.join(output_directory, os.path.dirname(file_path.lstrip('/'))), exist_ok=True)
+
+    chunk_size = -(-len(file_list) // n_jobs)
+    chunks = [file_list[i:i + chunk_size] for i in range(0, len(file_list), chunk_size)]
+    with joblib.Parallel(n_jobs=len(chunks), backend='loky') as parallel:
+        chunk_results = parallel(
+            joblib.delayed(_deidentify_file_chunk)(profile_path, profile_name, date_increment, input_directory,
+                                                   output_directory, chunk) for chunk in chunks
+        )
+
+    for file_states in chunk_results:
+        _validate_file_states(file_states, file_state, output_directory)
+
+
 def deidentify_files(profile_path, input_directory, profile_name='dicom', file_list=None,
-                     output_directory=None, date_increment=None):
+                     output_directory=None, date_increment=None, n_jobs=1):
     """
     Given profile_path to a valid flywheel de-id profile with a "dicom" namespace, this function
     replaces original files with de-identified copies of DICOM files .
@@ -192,19 +410,15 @@ def deidentify_files(profile_path, input_directory, profile_name='dicom', file_l
         date_increment (str): Date offset to apply to the profile
         file_list (list, optional): Optional list of relative paths of files to process, if not provided, will work
             on all files in the input_directory
+        n_jobs (int): the number of processes among which to split the files, see process_files_parallel. Profiles
+            that scrub pixels are always applied in a single process
 
     Returns:
         list: list of paths to deidentified files or None if no files are de-identified
     """
-    with tempfile.TemporaryDirectory() as tmp_deid_dir:
-        # Load the de-id profile from a file
-        deid_profile = deidentify.load_profile(profile_path)
-
-        # Load the de-id profile as a dictionary
-        template_dict = parse_deid_template(profile_path)
-
-        if date_increment:
-            deid_profile.date_increment = date_increment
+    # spool space for the de-identified copies of the files
+    with SPOOL.reserve(get_path_size(input_directory, file_list)) as tmp_deid_dir:
+        file_profile = load_file_profile(profile_path, profile_name=profile_name, date_increment=date_increment)
 
         # OSFS setup
         src_fs = osfs.OSFS(input_directory)
@@ -222,16 +436,13 @@ def deidentify_files(profile_path, input_directory, profile_name='dicom', file_l
         def default_path(state, record, path):
             dst_fs.makedirs(fs.path.dirname(path), recreate=True)
             return path
-        
-        # Get the dicom profile from the de-id profile
-        file_profile = deid_profile.get_file_profile(profile_name)
-        if template_dict.get(profile_name):
-            file_dict = template_dict.get(profile_name)
-            if file_dict.get('remove_private_tags') == True:
-                file_profile.remove_private_tags = True
 
-        file_profile.get_dest_path = default_path
-        file_profile.process_files(src_fs, dst_fs, file_list)
+        if n_jobs > 1 and len(file_list) > 1 and is_process_safe(file_profile):
+            process_files_parallel(profile_path, input_directory, tmp_deid_dir, file_list, profile_name=profile_name,
+                                   date_increment=date_increment, n_jobs=n_jobs)
+        else:
+            file_profile.get_dest_path = default_path
+            file_profile.process_files(src_fs, dst_fs, file_list)
 
         # get list of modified files in tmp_deid_dir
         deid_files = [match.path for match in dst_fs.glob('**/*', case_sensitive=False) if not match.info.is_dir]
@@ -252,19 +463,175 @@ def deidentify_files(profile_path, input_directory, profile_name='dicom', file_l
     return deid_paths
 
 
-def deid_archive(zip_path, profile_path, output_directory=None, date_increment=None):
-    with tempfile.TemporaryDirectory() as temp_dir:
+def iter_member_batches(zip_items, max_batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Splits the members of an archive, in order, into batches whose total uncompressed size is at most max_batch_bytes.
+        A member larger than max_batch_bytes is a batch of its own.
+
+    Args:
+        zip_items (list): the zipfile.ZipInfo of the members
+        max_batch_bytes (int): the maximum uncompressed size of a batch
+
+    Yields:
+        list: the zipfile.ZipInfo of the members of a batch
+    """
+    batch = list()
+    batch_bytes = 0
+    for zip_item in zip_items:
+        if batch and batch_bytes + zip_item.file_size > max_batch_bytes:
+            yield batch
+            batch = list()
+            batch_bytes = 0
+        batch.append(zip_item)
+        batch_bytes += zip_item.file_size
+    if batch:
+        yield batch
+
+
+def deid_archive_streaming(zip_path, profile_path, output_directory=None, date_increment=None,
+                           max_batch_bytes=DEFAULT_BATCH_BYTES, n_jobs=1, compression=DEFAULT_COMPRESSION,
+                           compresslevel=None, compression_workers=1):
+    """
+    De-identifies the DICOM members of a zip without extracting the whole archive. Members are extracted, in batches
+        of at most max_batch_bytes (or one member, if larger), de-identified and written to the output zip in the order
+        of the original archive, so the spool holds at most a batch and its de-identified copies. The output zip is
+        written next to its destination and moved into place once complete.
+
+    Args:
+        zip_path (str): Path to the zip to de-identify
+        profile_path (str): Path to the de-id profile to apply
+        output_directory (str): Directory to which to save output zip, if None, will overwrite zip_path
+        date_increment (str): Date offset to apply to the profile
+        max_batch_bytes (int): the maximum uncompressed size of the members extracted at once
+        n_jobs (int): the number of processes among which to split the members of each batch, see
+            process_files_parallel
+        compression (str): the compression of the de-identified members, see recreate_zip
+        compresslevel (int): the compression level, the default of the compression if None
+        compression_workers (int): the number of threads that deflate de-identified members
+
+    Returns:
+        (str): A path to the resultant zip
+    """
+    file_profile = load_file_profile(profile_path, date_increment=date_increment)
+    # share the file state (e.g. the SOPInstanceUIDs already seen) across batches, as when the archive is processed in
+    # a single process_files call, and clean it up (e.g. remove the pixel scrubbing filter) after the last batch
+    file_state = file_profile.create_file_state()
+    cleanup_file_state = file_profile.cleanup
+    file_profile.create_file_state = lambda: file_state
+    file_profile.cleanup = lambda state: None
+    parallel = n_jobs > 1 and is_process_safe(file_profile)
+
+    def process_batch(src_dir, dst_dir, file_list):
+        if parallel and len(file_list) > 1:
+            process_files_parallel(profile_path, src_dir, dst_dir, file_list, date_increment=date_increment,
+                                   n_jobs=n_jobs, file_state=file_state)
+            return
+        with osfs.OSFS(src_dir) as src_fs, osfs.OSFS(dst_dir) as dst_fs:
+            # Monkey-patch get_dest_path to return the original path, creating any missing subdirectories
+            def default_path(state, record, path):
+                dst_fs.makedirs(fs.path.dirname(path), recreate=True)
+                return path
+
+            file_profile.get_dest_path = default_path
+            file_profile.process_files(src_fs, dst_fs, file_list)
+
+    if output_directory:
+        output_path = os.path.join(output_directory, os.path.basename(zip_path))
+    else:
+        output_path = zip_path
+    part_path = f'{output_path}.part'
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zin, \
+                open_output_zip(part_path, compression=compression, compresslevel=compresslevel) as zout:
+            # preserve the archive comment
+            zout.comment = zin.comment
+            for batch in iter_member_batches(zin.infolist(), max_batch_bytes=max_batch_bytes):
+                batch_bytes = sum(zip_item.file_size for zip_item in batch)
+                with SPOOL.reserve(FILE_SPOOL_FACTOR * batch_bytes) as batch_dir:
+                    _deid_member_batch(zin, zout, batch, batch_dir, process_batch,
+                                       compression_workers=compression_workers)
+        os.replace(part_path, output_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        cleanup_file_state(file_state)
+    return output_path
+
+
+def _deid_member_batch(zin, zout, batch, batch_dir, process_batch, compression_workers=1):
+    src_dir = os.path.join(batch_dir, 'origin')
+    dst_dir = os.path.join(batch_dir, 'deid')
+    os.makedirs(src_dir)
+    os.makedirs(dst_dir)
+    # zip member name: path of the extracted file relative to src_dir, which may differ from the member name if it is
+    # not a valid local path
+    extracted = dict()
+    for zip_item in batch:
+        if not zip_item.is_dir():
+            extracted[zip_item.filename] = os.path.relpath(zin.extract(zip_item, src_dir), src_dir)
+
+    process_batch(src_dir, dst_dir, [rel_path.replace(os.sep, '/') for rel_path in extracted.values()])
+
+    # members that the profile did not output, or left unchanged, are copied as they were
+    members = list()
+    for zip_item in batch:
+        file_path = None
+        if not zip_item.is_dir():
+            deid_path = os.path.join(dst_dir, extracted[zip_item.filename])
+            if os.path.isfile(deid_path) and not is_member_unchanged(deid_path, zip_item):
+                file_path = deid_path
+        members.append((zip_item, file_path))
+    write_members(zin, zout, members, compression_workers=compression_workers)
+
+
+def deid_archive(zip_path, profile_path, output_directory=None, date_increment=None, streaming=False,
+                 max_batch_bytes=DEFAULT_BATCH_BYTES, n_jobs=1, compression=DEFAULT_COMPRESSION, compresslevel=None,
+                 compression_workers=1):
+    """
+    De-identifies the DICOM members of a zip
+
+    Args:
+        zip_path (str): Path to the zip to de-identify
+        profile_path (str): Path to the de-id profile to apply
+        output_directory (str): Directory to which to save output zip, if None, will overwrite zip_path
+        date_increment (str): Date offset to apply to the profile
+        streaming (bool): if True, de-identify the members in batches of at most max_batch_bytes rather than extracting
+            the whole archive, see deid_archive_streaming
+        max_batch_bytes (int): the maximum uncompressed size of the members extracted at once when streaming
+        n_jobs (int): the number of processes among which to split the members, see process_files_parallel. The
+            output is the same as with a single process
+        compression (str): the compression of the de-identified members, see recreate_zip
+        compresslevel (int): the compression level, the default of the compression if None
+        compression_workers (int): the number of threads that deflate de-identified members
+
+    Returns:
+        (str): A path to the resultant zip
+    """
+    validate_compression(compression, compresslevel)
+    if streaming:
+        return deid_archive_streaming(zip_path, profile_path, output_directory=output_directory,
+                                      date_increment=date_increment, max_batch_bytes=max_batch_bytes, n_jobs=n_jobs,
+                                      compression=compression, compresslevel=compresslevel,
+                                      compression_workers=compression_workers)
+    # spool space for the extracted files, reserved before they are extracted. The de-identified copies and the new
+    # zip are reserved by nested calls
+    with SPOOL.reserve(get_zip_size(zip_path)) as temp_dir:
         file_list = extract_files(zip_path=zip_path, output_directory=temp_dir)
         deid_file_list = deidentify_files(
             input_directory=temp_dir, 
             profile_path=profile_path,
-            date_increment=date_increment
+            date_increment=date_increment,
+            n_jobs=n_jobs
         )
-        output_zip_path = recreate_zip(dest_zip=zip_path, file_directory=temp_dir, output_directory=output_directory)
+        output_zip_path = recreate_zip(dest_zip=zip_path, file_directory=temp_dir, output_directory=output_directory,
+                                       changed_files=deid_file_list or list(), compression=compression,
+                                       compresslevel=compresslevel, compression_workers=compression_workers)
     return output_zip_path
 
 
-def deidentify_path(input_file_path, profile_path, output_directory=None, date_increment=None):
+def deidentify_path(input_file_path, profile_path, output_directory=None, date_increment=None, streaming=False,
+                    max_batch_bytes=DEFAULT_BATCH_BYTES, n_jobs=1, compression=DEFAULT_COMPRESSION,
+                    compresslevel=None, compression_workers=1):
     if output_directory and not os.path.exists(output_directory):
         log.info(f'{output_directory} does not exist, creating...')
         os.makedirs(output_directory)
@@ -273,7 +640,14 @@ def deidentify_path(input_file_path, profile_path, output_directory=None, date_i
         deid_outpath = deid_archive(
             zip_path=input_file_path,
             profile_path=profile_path,
-            output_directory=output_directory
+            output_directory=output_directory,
+            date_increment=date_increment,
+            streaming=streaming,
+            max_batch_bytes=max_batch_bytes,
+            n_jobs=n_jobs,
+            compression=compression,
+            compresslevel=compresslevel,
+            compression_workers=compression_workers
         )
         return deid_outpath
     elif os.path.isfile(input_file_path):
@@ -292,7 +666,8 @@ def deidentify_path(input_file_path, profile_path, output_directory=None, date_i
             input_directory=input_file_path,
             profile_path=profile_path,
             output_directory=output_directory, 
-            date_increment=date_increment
+            date_increment=date_increment,
+            n_jobs=n_jobs
         )
         return deid_file_list
         
@@ -306,6 +681,17 @@ if __name__ == '__main__':
     parser.add_argument('deid_profile', help='de-identification profile to apply')
     parser.add_argument('--output_directory', help='path to which to save de-identified files')
     parser.add_argument('--date_increment', help='days to offset template fields where specified')
+    parser.add_argument('--streaming', action='store_true',
+                        help='de-identify archive members in batches rather than extracting the whole archive')
+    parser.add_argument('--max_batch_mb', type=int, default=DEFAULT_BATCH_BYTES // 2 ** 20,
+                        help='maximum uncompressed MB of archive members extracted at once when streaming')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='number of processes among which to split the files of an archive or directory')
+    parser.add_argument('--zip_compression', choices=list(COMPRESSION_TYPES.keys()), default=DEFAULT_COMPRESSION,
+                        help='compression of the de-identified members of an archive, unchanged members keep theirs')
+    parser.add_argument('--zip_compresslevel', type=int, help='compression level of de-identified archive members')
+    parser.add_argument('--zip_compression_workers', type=int, default=1,
+                        help='number of threads that deflate de-identified archive members')
 
     args = parser.parse_args()
 
@@ -313,5 +699,11 @@ if __name__ == '__main__':
         input_file_path=args.input_file_path,
         profile_path=args.deid_profile,
         output_directory=args.output_directory,
-        date_increment=args.date_increment
+        date_increment=args.date_increment,
+        streaming=args.streaming,
+        max_batch_bytes=args.max_batch_mb * 2 ** 20,
+        n_jobs=args.n_jobs,
+        compression=args.zip_compression,
+        compresslevel=args.zip_compresslevel,
+        compression_workers=args.zip_compression_workers
     )
\ No newline at end of file
@@ -2,6 +2,8 @@
 
 import argparse
 import copy
+import hashlib
+import json
 import logging
 from pathlib import Path
 import tempfile
@@ -55,6 +57,126 @@ def _add_zip_member_validation(deid_template):
     return deid_template
 
 
+def _find_profile_element_path(d, target, path=()):
+    # the keys and list indexes leading from the template to the element that find_profile_element returns
+    tps = target.split('.')
+    if len(tps) == 1:
+        return path, target, False
+    if tps[0] in ('fields', 'groups'):
+        return path + (tps[0],), '.'.join(tps[1:]), True
+    key = int(tps[0]) if isinstance(d, list) else tps[0]
+    return _find_profile_element_path(d[key], '.'.join(tps[1:]), path + (key,))
+
+
+def _get_element(d, path):
+    for key in path:
+        d = d[key]
+    return d
+
+
+def _raise(exc):
+    raise exc
+
+
+class SubjectTemplateMap:
+    """Produces the de-identification template of each subject of a mapping csv in memory.
+
+    The template element that each csv column updates, and the type to which its values are converted, are resolved
+    once, and rows are indexed by subject code, so that the template of a subject is produced without scanning the csv,
+    searching the template or deep-copying it: only the elements that the columns update are copied, the others are
+    shared with the base template. The templates are those that update_deid_profile returns for the subject's row.
+    """
+    def __init__(self, df, deid_template, subject_code_col=DEFAULT_SUBJECT_CODE_COL):
+        """
+        Args:
+            df (pandas.DataFrame): Dataframe representation of some mapping info
+            deid_template (dict): Dictionary representation of the deid profile
+            subject_code_col (str): Subject code column name
+        """
+        # columns are resolved against the template as update_deid_profile finds them, before the defaults it adds
+        deid_template = copy.deepcopy(deid_template)
+        self.base_template = _add_zip_member_validation(copy.deepcopy(deid_template))
+        self.base_template.setdefault('only-config-profiles', True)
+        self.columns = [column for column in df.columns if column != subject_code_col]
+        # column: function(template, value, copied) that sets the value in template, copying the elements on its way
+        self._setters = dict()
+        for column in self.columns:
+            setter = self._compile_setter(deid_template, column)
+            if setter is None:
+                logger.info(f'{column} did not match anything in template')
+            else:
+                self._setters[column] = setter
+
+        self._rows = dict()
+        self._duplicate_codes = set()
+        for row in df.to_dict('records'):
+            subject_code = row.pop(subject_code_col)
+            if subject_code in self._rows:
+                self._duplicate_codes.add(subject_code)
+            self._rows[subject_code] = row
+
+    @staticmethod
+    def _compile_setter(deid_template, column):
+        try:
+            path, key_or_fieldinfo, is_fields = _find_profile_element_path(deid_template, column)
+            element = _get_element(deid_template, path)
+            if is_fields:  # fields value is a list
+                field_name, field_action = key_or_fieldinfo.split('.')
+                targets = [(path + (index,), field_action, type(field.get(field_action)))
+                           for index, field in enumerate(element) if field.get('name') == field_name]
+            else:
+                # used for dumping to yml consistently with template values
+                targets = [(path, key_or_fieldinfo, type(element[key_or_fieldinfo]))]
+        except KeyError:
+            return None
+        except Exception as exc:
+            # as when updating the template, the error is raised for each subject
+            return lambda template, value, copied, exc=exc: _raise(exc)
+
+        def _set(template, value, copied):
+            for target_path, target_key, r_type in targets:
+                _copy_path(template, target_path, copied)[target_key] = r_type(value)
+        return _set
+
+    def get_template(self, subject_code):
+        """
+        Returns the de-identification template of a subject. The returned template shares the elements that the csv
+            does not update with the base template and with those of other subjects, and must not be modified in place
+        Args:
+            subject_code (str): value of the subject code column of the subject's row
+
+        Raises:
+            ValueError: when subject_code is not in the csv, or is in more than one row
+
+        Returns:
+            dict: the subject's template
+        """
+        if subject_code not in self._rows:
+            raise ValueError(f'{subject_code} not found in csv')
+        if subject_code in self._duplicate_codes:
+            raise ValueError(f'{subject_code} is in more than one row of csv')
+        row = self._rows[subject_code]
+        template = dict(self.base_template)
+        copied = set()
+        for column, setter in self._setters.items():
+            setter(template, row[column], copied)
+        return template
+
+
+def _copy_path(template, path, copied):
+    # copies each element on path that has not been copied yet (copied holds the ids of the copies) and returns the
+    # copy of the last
+    element = template
+    for key in path:
+        child = element[key]
+        if id(child) not in copied:
+            child = copy.copy(child)
+            copied.add(id(child))
+            element[key] = child
+        element = child
+    return element
+
+
 def update_deid_profile(deid_template, updates):
     """Return the updated deid profile
 
@@ -192,6 +314,20 @@ def load_deid_profile(template_dict):
     return deid_profile, export_config
 
 
+def get_template_hash(template_dict):
+    """
+    Returns a hash of the de-identification template, which changes whenever the effective profile changes
+
+    Args:
+        template_dict(dict): a dictionary loaded from the de-identification template file
+
+    Returns:
+        str: the sha1 hexdigest of the template serialized as json with sorted keys
+    """
+    template_str = json.dumps(template_dict, sort_keys=True, default=str)
+    return hashlib.sha1(template_str.encode()).hexdigest()
+
+
 def get_updated_template(df,
                          deid_template,
                          subject_code=None,
@@ -242,14 +378,14 @@ def process_csv(csv_path, deid_template_path, subject_code_col=DEFAULT_SUBJECT_C
         deid_template = load(fid, Loader=Loader)
 
     df = pd.read_csv(csv_path, dtype=str)
+    subject_templates = SubjectTemplateMap(df, deid_template, subject_code_col=subject_code_col)
 
     deids_paths = {}
     for subject_code in df[subject_code_col]:
         dest_template_path = Path(output_dir) / f'{subject_code}.yml'
-        deids_paths[subject_code] = get_updated_template(df, deid_template,
-                                                         subject_code=subject_code,
-                                                         subject_code_col=subject_code_col,
-                                                         dest_template_path=dest_template_path)
+        with open(dest_template_path, 'w+') as fid:
+            dump(subject_templates.get_template(subject_code), fid, default_flow_style=False)
+        deids_paths[subject_code] = dest_template_path
     return deids_paths
 
 
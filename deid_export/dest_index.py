@@ -0,0 +1,171 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# parent container type of each indexed container type
+PARENT_TYPES = {
+    'subject': 'project',
+    'session': 'subject',
+    'acquisition': 'session',
+}
+
+
+def _get_origin_id_hash(container):
+    info = container.get('info') or dict()
+    return info.get('export', dict()).get('origin_id')
+
+
+class DestinationIndex:
+    """An in-memory index of the containers in the destination project.
+
+    Containers are keyed by (container type, parent id, label, hashed origin id). Subjects are keyed by code alone
+    (with a hashed origin id of None) since subject codes are unique within a project. The index is built with one
+    finder call per container type and containers created during the export are added to it, so that
+    find_or_create_* lookups do not need to query the API. Finder results do not include info, so the sessions and
+    acquisitions with a given parent and label are loaded the first time that label is looked up, to read their
+    hashed origin ids. Indexed containers are returned as they were found or created; callers that need their current
+    state reload them (e.g. through CONTAINER_CACHE).
+
+    If the index is not authoritative (i.e. other processes may be creating containers in the destination project), a
+    lookup that misses the index falls back to the provided finder query before a container is created.
+    """
+    def __init__(self, fw_client, project_id, authoritative=True):
+        """
+        Args:
+            fw_client (flywheel.Client): an instance of the flywheel client
+            project_id (str): the id of the destination project
+            authoritative (bool): whether every container created in the destination project during the export is
+                added to this index
+        """
+        self.fw_client = fw_client
+        self.project_id = project_id
+        self.authoritative = authoritative
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self._index = dict()
+        # (container type, parent id, label): containers whose hashed origin ids have not been loaded yet
+        self._unresolved = dict()
+        self._lock = threading.Lock()
+        # held while unresolved containers are loaded
+        self._resolve_lock = threading.Lock()
+        self.build()
+
+    def __getstate__(self):
+        # flywheel.Client and locks cannot be pickled, process workers build their own index
+        raise TypeError('DestinationIndex cannot be pickled')
+
+    def build(self, container_types=('subject', 'session', 'acquisition')):
+        """(Re)loads the containers of container_types in the destination project into the index
+
+        Args:
+            container_types (tuple): the container types to load
+        """
+        for container_type in container_types:
+            finder = getattr(self.fw_client, f'{container_type}s')
+            parent_type = PARENT_TYPES[container_type]
+            self.api_calls += 1
+            for container in finder.iter_find(f'parents.project={self.project_id}'):
+                parent_id = container.get('parents', dict()).get(parent_type)
+                if container_type == 'subject':
+                    self.add(container_type, parent_id, container.get('code'), None, container)
+                else:
+                    label_key = (container_type, parent_id, str(container.get('label')))
+                    with self._lock:
+                        self._unresolved.setdefault(label_key, list()).append(container)
+        unresolved_count = sum(len(containers) for containers in self._unresolved.values())
+        log.debug(f'Indexed {len(self._index) + unresolved_count} containers in destination project {self.project_id}')
+
+    def _resolve(self, container_type, parent_id, label):
+        """Loads the unresolved containers with the given parent and label and indexes them by hashed origin id"""
+        label_key = (container_type, parent_id, str(label))
+        if label_key not in self._unresolved:
+            return
+        with self._resolve_lock:
+            # the key is removed only once its containers are indexed, so a concurrent lookup waits for them here
+            for container in self._unresolved.get(label_key, list()):
+                loaded = self.fw_client.get(container.id)
+                with self._lock:
+                    self.api_calls += 1
+                self.add(container_type, parent_id, label, _get_origin_id_hash(loaded), container)
+            with self._lock:
+                self._unresolved.pop(label_key, None)
+
+    @staticmethod
+    def _get_key(container_type, parent_id, label, origin_id_hash=None):
+        return container_type, parent_id, str(label), origin_id_hash
+
+    def add(self, container_type, parent_id, label, origin_id_hash, container):
+        """Adds a container to the index
+
+        Args:
+            container_type (str): subject, session or acquisition
+            parent_id (str): the id of the parent container
+            label (str): the label (or code for subjects) of the container
+            origin_id_hash (str): the hashed id of the origin container (info.export.origin_id), None for subjects
+            container (flywheel container): the container
+        """
+        key = self._get_key(container_type, parent_id, label, origin_id_hash)
+        with self._lock:
+            # keep the first match, consistent with find_first
+            self._index.setdefault(key, container)
+
+    def find_indexed(self, container_type, parent_id, label, origin_id_hash=None):
+        """Returns the indexed container matching the key, as it was found or created, without querying on a miss
+
+        Args:
+            container_type (str): subject, session or acquisition
+            parent_id (str): the id of the parent container
+            label (str): the label (or code for subjects) of the container
+            origin_id_hash (str): the hashed id of the origin container (info.export.origin_id), None for subjects
+
+        Returns:
+            flywheel container or None: the matching container
+        """
+        self._resolve(container_type, parent_id, label)
+        return self._index.get(self._get_key(container_type, parent_id, label, origin_id_hash))
+
+    def find_id(self, container_type, parent_id, label, origin_id_hash=None):
+        """Returns the id of the indexed container matching the key without querying on a miss (see find_indexed)"""
+        container = self.find_indexed(container_type, parent_id, label, origin_id_hash)
+        return container.id if container is not None else None
+
+    def find(self, container_type, parent_id, label, origin_id_hash=None, finder=None, query=None):
+        """Returns the indexed container matching the key, or None
+
+        Args:
+            container_type (str): subject, session or acquisition
+            parent_id (str): the id of the parent container
+            label (str): the label (or code for subjects) of the container
+            origin_id_hash (str): the hashed id of the origin container (info.export.origin_id), None for subjects
+            finder (flywheel.Finder): the finder to query on a miss if the index is not authoritative
+            query (str): the filter to pass to finder.find_first
+
+        Returns:
+            flywheel container or None: the matching container, as it was found or created
+        """
+        self._resolve(container_type, parent_id, label)
+        key = self._get_key(container_type, parent_id, label, origin_id_hash)
+        container = self._index.get(key)
+        if container is not None:
+            with self._lock:
+                self.hits += 1
+            return container
+
+        with self._lock:
+            self.misses += 1
+        if not self.authoritative and finder is not None:
+            container = finder.find_first(query)
+            if container:
+                self.add(container_type, parent_id, label, origin_id_hash, container)
+            return container
+        return None
+
+    def get_counts(self):
+        """Returns a dictionary of index hits, misses and API calls made to build the index and load origin ids"""
+        return {
+            'dest_index_hits': self.hits,
+            'dest_index_misses': self.misses,
+            'dest_index_api_calls': self.api_calls
+        }
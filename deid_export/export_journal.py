@@ -0,0 +1,180 @@
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# the file status keys recorded by the journal, the leading columns of the export status csv
+STATUS_KEYS = ['origin_filename', 'origin_parent', 'origin_parent_type', 'export_filename', 'export_file_id',
+               'export_parent', 'state', 'errors']
+
+# the states of files that do not need to be exported again, 'unchanged' is set by delta exports
+EXPORTED_STATES = ('exported', 'unchanged')
+
+# pending transitions are committed in one transaction once there are this many, or this many seconds after the last
+# commit, so that the journal does not commit and sync the database for every transition
+DEFAULT_COMMIT_EVERY = 100
+DEFAULT_COMMIT_SECONDS = 5
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS file_state (
+    origin_parent TEXT NOT NULL,
+    origin_filename TEXT NOT NULL,
+    export_parent TEXT NOT NULL,
+    origin_parent_type TEXT,
+    export_filename TEXT,
+    export_file_id TEXT,
+    state TEXT,
+    errors TEXT,
+    updated REAL,
+    PRIMARY KEY (origin_parent, origin_filename, export_parent)
+);
+CREATE TABLE IF NOT EXISTS file_transition (
+    origin_parent TEXT NOT NULL,
+    origin_filename TEXT NOT NULL,
+    export_parent TEXT NOT NULL,
+    state TEXT,
+    created REAL
+);
+'''
+
+
+class ExportJournal:
+    """A durable SQLite journal of FileExporter state transitions.
+
+    Each file is keyed by (origin parent id, origin filename, destination parent id). The latest state and status of
+    each file is kept in the file_state table and every transition is appended to the file_transition table. When an
+    export is resumed, files journaled as exported are skipped and their journaled status is reported instead.
+
+    Transitions are buffered and committed in batches, when the journal is flushed, read from or closed. The pending
+    transitions of an interrupted export are lost, so those files are not journaled as exported and are exported
+    again on resume.
+
+    The connection is opened lazily so that a journal can be pickled to process-backend workers, each of which opens
+    its own connection to the same file.
+    """
+    def __init__(self, path, commit_every=DEFAULT_COMMIT_EVERY, commit_seconds=DEFAULT_COMMIT_SECONDS):
+        """
+        Args:
+            path (str): the path of the SQLite database file, created if it does not exist
+            commit_every (int): the number of pending transitions at which they are committed
+            commit_seconds (float): the number of seconds after the last commit at which pending transitions are
+                committed
+        """
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self._conn = None
+        self._lock = threading.Lock()
+        # (file_state values, file_transition values) of the transitions not yet committed, oldest first
+        self._pending = list()
+        # (origin parent, origin filename, export parent): the latest pending file_state values
+        self._pending_state = dict()
+        self._last_commit = time.monotonic()
+
+    def __getstate__(self):
+        # workers open their own connection, commit first so that they see every transition recorded so far
+        self.flush()
+        return {'path': self.path, 'commit_every': self.commit_every, 'commit_seconds': self.commit_seconds}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], commit_every=state.get('commit_every', DEFAULT_COMMIT_EVERY),
+                      commit_seconds=state.get('commit_seconds', DEFAULT_COMMIT_SECONDS))
+
+    def _get_connection(self):
+        if self._conn is None:
+            # The default rollback journal is used rather than WAL so that every committed transition is in the
+            # database file itself, even while process workers still hold open connections
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def record(self, status_dict):
+        """Records the state of a file
+
+        Args:
+            status_dict (dict): the file status, with the keys of STATUS_KEYS
+        """
+        values = [status_dict.get(key) for key in STATUS_KEYS]
+        key = (status_dict.get('origin_parent'), status_dict.get('origin_filename'), status_dict.get('export_parent'))
+        now = time.time()
+        with self._lock:
+            self._pending.append((values + [now], list(key) + [status_dict.get('state'), now]))
+            self._pending_state[key] = values
+            if (len(self._pending) >= self.commit_every
+                    or time.monotonic() - self._last_commit >= self.commit_seconds):
+                self._commit()
+
+    def _commit(self):
+        if self._pending:
+            conn = self._get_connection()
+            with conn:
+                conn.executemany(
+                    f'INSERT OR REPLACE INTO file_state ({", ".join(STATUS_KEYS)}, updated) '
+                    f'VALUES ({", ".join("?" * len(STATUS_KEYS))}, ?)',
+                    [state_values for state_values, _ in self._pending]
+                )
+                conn.executemany(
+                    'INSERT INTO file_transition (origin_parent, origin_filename, export_parent, state, created) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    [transition_values for _, transition_values in self._pending]
+                )
+            self._pending = list()
+            self._pending_state = dict()
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """Commits the pending transitions"""
+        with self._lock:
+            self._commit()
+
+    def get_status(self, origin_parent, origin_filename, export_parent):
+        """Returns the journaled status of a file
+
+        Args:
+            origin_parent (str): the id of the origin parent container
+            origin_filename (str): the name of the origin file
+            export_parent (str): the id of the destination parent container
+
+        Returns:
+            dict or None: the journaled status of the file with the keys of STATUS_KEYS, or None if not journaled
+        """
+        with self._lock:
+            values = self._pending_state.get((origin_parent, origin_filename, export_parent))
+            if values is not None:
+                return dict(zip(STATUS_KEYS, values))
+            row = self._get_connection().execute(
+                f'SELECT {", ".join(STATUS_KEYS)} FROM file_state '
+                'WHERE origin_parent = ? AND origin_filename = ? AND export_parent = ?',
+                [origin_parent, origin_filename, export_parent]
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(STATUS_KEYS, row))
+
+    def get_exported_status(self, origin_parent, origin_filename, export_parent):
+        """Returns the journaled status of a file if it was exported (or found unchanged), otherwise None"""
+        status_dict = self.get_status(origin_parent, origin_filename, export_parent)
+        if status_dict and status_dict['state'] in EXPORTED_STATES:
+            return status_dict
+        return None
+
+    def get_transitions(self, origin_parent, origin_filename, export_parent):
+        """Returns the list of states recorded for a file, oldest first"""
+        with self._lock:
+            self._commit()
+            rows = self._get_connection().execute(
+                'SELECT state FROM file_transition '
+                'WHERE origin_parent = ? AND origin_filename = ? AND export_parent = ? ORDER BY rowid',
+                [origin_parent, origin_filename, export_parent]
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        """Commits the pending transitions and closes the connection"""
+        with self._lock:
+            self._commit()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
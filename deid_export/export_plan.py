@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import re
+import time
+
+from flywheel_migration.util import get_safe_filename
+
+log = logging.getLogger(__name__)
+
+# the columns of the export plan csv, in order
+PLAN_COLUMNS = ['container_type', 'origin_id', 'origin_label', 'dest_id', 'create_container', 'file_count',
+                'total_bytes', 'unpredictable_filenames', 'collisions', 'collision_filenames', 'existing_files',
+                'existing_filenames', 'errors']
+
+
+def get_matching_file_profile(deid_profile, file_obj):
+    """
+    Returns the file profile of deid_profile that will process file_obj, using the same rules as matches_file
+    Args:
+        deid_profile(flywheel_migration.deidentify.DeIdProfile): the de-identification profile
+        file_obj(flywheel.FileEntry or dict): the flywheel file object
+
+    Returns:
+        flywheel_migration.deidentify.FileProfile or None: the matching file profile
+    """
+    if file_obj.get('type') == 'dicom' and deid_profile.get_file_profile('dicom'):
+        return deid_profile.get_file_profile('dicom')
+    for profile in deid_profile.file_profiles:
+        if profile.name != 'dicom' and profile.matches_file(file_obj.get('name')):
+            return profile
+    return None
+
+
+def predict_export_filename(file_profile, filename):
+    """
+    Predicts the name of the de-identified file from the profile's filenames rules without downloading it.
+
+    Output names that use file header values or filename groups altered by de-identification actions cannot be
+        predicted from the filename alone.
+    Args:
+        file_profile (flywheel_migration.deidentify.FileProfile): the file profile that will process the file
+        filename (str): the name of the origin file
+
+    Returns:
+        str or None: the predicted filename, None if it cannot be predicted
+    """
+    path = get_safe_filename(filename)
+    dest_path = None
+    if file_profile.filenames:
+        prefix = getattr(file_profile, 'filename_field_prefix', '_fwmtk')
+        for i, filename_rule in enumerate(file_profile.filenames):
+            format_kws = dict()
+            if 'input-regex' in filename_rule:
+                match = re.match(filename_rule['input-regex'], path)
+                if not match:
+                    continue
+                format_kws.update(match.groupdict())
+            for key in re.findall(r'\{([^}]+)\}', filename_rule['output']):
+                # header values and groups with de-identification actions are only known after processing
+                if key not in format_kws or f'{prefix}_filename{i}_{key}' in file_profile.field_map:
+                    return None
+            dest_path = filename_rule['output'].format(**format_kws)
+            break
+        if dest_path is None:
+            # the file will be ignored by the profile
+            return None
+    else:
+        dest_path = os.path.basename(path)
+    if getattr(file_profile, 'sanitize_filename', False):
+        dest_path = get_safe_filename(dest_path)
+    return dest_path
+
+
+def load_throughput_history(history_path):
+    """
+    Loads the list of previous export runs ({'files': int, 'bytes': int, 'seconds': float}) from history_path
+    Args:
+        history_path (str): path to the json throughput history
+
+    Returns:
+        list: list of run dictionaries, empty if history_path does not exist
+    """
+    if not history_path or not os.path.isfile(history_path):
+        return list()
+    with open(history_path, 'r') as f_data:
+        return json.load(f_data)
+
+
+def record_throughput(history_path, file_count, byte_count, seconds, max_runs=20):
+    """
+    Appends the throughput of an export run to history_path, keeping the most recent max_runs runs
+    Args:
+        history_path (str): path to the json throughput history
+        file_count (int): the number of files exported
+        byte_count (int): the number of origin bytes exported
+        seconds (float): the duration of the export
+        max_runs (int): the number of runs to keep
+    """
+    if not file_count or seconds <= 0:
+        return
+    history = load_throughput_history(history_path)
+    history.append({'files': file_count, 'bytes': byte_count, 'seconds': seconds, 'recorded': time.time()})
+    with open(history_path, 'w') as f_data:
+        json.dump(history[-max_runs:], f_data)
+
+
+def estimate_duration(history, file_count, byte_count):
+    """
+    Estimates the duration of an export from the throughput of previous runs, by bytes if previous runs recorded
+        bytes, otherwise by file count
+    Args:
+        history (list): list of run dictionaries from load_throughput_history
+        file_count (int): the number of files to export
+        byte_count (int): the number of bytes to export
+
+    Returns:
+        float or None: the estimated number of seconds, None if there is no history
+    """
+    seconds = sum(run['seconds'] for run in history)
+    if not history or seconds <= 0:
+        return None
+    history_bytes = sum(run.get('bytes') or 0 for run in history)
+    if history_bytes and byte_count:
+        return byte_count / (history_bytes / seconds)
+    return file_count / (sum(run['files'] for run in history) / seconds)
+
+
+def get_collisions(predicted_filenames):
+    """Returns the sorted list of predicted filenames that occur more than once, ignoring unpredictable names"""
+    seen = set()
+    collisions = set()
+    for filename in predicted_filenames:
+        if filename is None:
+            continue
+        if filename in seen:
+            collisions.add(filename)
+        seen.add(filename)
+    return sorted(collisions)
+
+
+def get_existing_filenames(predicted_filenames, dest_filenames):
+    """Returns the sorted list of predicted filenames that are already the names of files in the destination"""
+    return sorted(set(predicted_filenames).intersection(dest_filenames))
+
+
+def log_export_plan(plan_df, history=None, logger=None, overwrite=False):
+    """
+    Logs the totals of an export plan and the estimated duration of the export
+    Args:
+        plan_df (pandas.DataFrame): the export plan with PLAN_COLUMNS
+        history (list): list of previous run dictionaries from load_throughput_history
+        logger (logging.Logger): the logger to use, defaults to this module's logger
+        overwrite (bool): whether the export overwrites existing files in the destination
+    """
+    logger = logger or log
+    file_count = int(plan_df['file_count'].sum())
+    total_bytes = int(plan_df['total_bytes'].sum())
+    logger.info(f'Export plan: {file_count} files ({total_bytes} bytes) in {len(plan_df)} containers')
+    created_df = plan_df[plan_df['create_container'].astype(bool)]
+    for container_type, count in created_df['container_type'].value_counts().items():
+        logger.info(f'Export plan: {count} {container_type} containers will be created')
+    logger.info(f'Export plan: {int(plan_df["unpredictable_filenames"].sum())} export filenames depend on file '
+                f'contents and cannot be predicted')
+    collision_count = int(plan_df['collisions'].sum())
+    if collision_count:
+        logger.warning(f'Export plan: {collision_count} files will not be exported because their export filenames '
+                       f'collide with another file in the same container')
+    existing_count = int(plan_df['existing_files'].sum())
+    if existing_count and overwrite:
+        logger.info(f'Export plan: {existing_count} files will replace files with the same name in the destination')
+    elif existing_count:
+        logger.warning(f'Export plan: {existing_count} files will not be exported because a file with their export '
+                       f'filename exists in the destination container and overwrite is off')
+    estimate = estimate_duration(history or list(), file_count, total_bytes)
+    if estimate is None:
+        logger.info('Export plan: no throughput history is available to estimate the export duration')
+    else:
+        logger.info(f'Export plan: estimated duration is {estimate / 60:.1f} minutes')
@@ -0,0 +1,98 @@
+import logging
+import math
+import threading
+
+log = logging.getLogger(__name__)
+
+
+# the percentiles reported for sampled values
+SAMPLE_PERCENTILES = (50, 95)
+
+
+def get_percentile(sorted_values, percentile):
+    """Returns the nearest-rank percentile of a non-empty sorted list"""
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class ExportSummary:
+    """A thread-safe collection of counters, high-water marks and sampled values (e.g. per-file stage timings, which
+    are reported as percentiles) that is reported at the end of an export.
+
+    Summaries are picklable so that they can be returned from process-backend workers and merged by the parent.
+    """
+    def __init__(self):
+        self.counters = dict()
+        self.maxima = dict()
+        self.samples = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def increment(self, key, count=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def update_max(self, key, value):
+        with self._lock:
+            if key not in self.maxima or value > self.maxima[key]:
+                self.maxima[key] = value
+
+    def add_sample(self, key, value):
+        with self._lock:
+            self.samples.setdefault(key, list()).append(value)
+
+    def get_percentiles(self):
+        """Returns a dictionary of the p50, p95 and max of each sampled value, keyed as <key>_p50 etc."""
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self.samples.items() if values}
+        percentile_dict = dict()
+        for key, values in samples.items():
+            for percentile in SAMPLE_PERCENTILES:
+                percentile_dict[f'{key}_p{percentile}'] = get_percentile(values, percentile)
+            percentile_dict[f'{key}_max'] = values[-1]
+        return percentile_dict
+
+    def merge(self, other):
+        """Adds the counters and high-water marks of other (an ExportSummary) to this summary
+
+        Args:
+            other (ExportSummary): the summary to merge into this one
+
+        Returns:
+            ExportSummary: self
+        """
+        if other is None:
+            return self
+        for key, count in other.counters.items():
+            self.increment(key, count)
+        for key, value in other.maxima.items():
+            self.update_max(key, value)
+        for key, values in other.samples.items():
+            with self._lock:
+                self.samples.setdefault(key, list()).extend(values)
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            summary_dict = dict(self.counters)
+            summary_dict.update({f'max_{key}': value for key, value in self.maxima.items()})
+        summary_dict.update(self.get_percentiles())
+        return summary_dict
+
+    def log_summary(self, logger=None, title='Export summary'):
+        if logger is None:
+            logger = log
+        summary_dict = self.to_dict()
+        if not summary_dict:
+            return
+        logger.info(f'{title}:')
+        for key in sorted(summary_dict.keys()):
+            logger.info(f'    {key}: {summary_dict[key]}')
@@ -3,21 +3,37 @@ import datetime
 import logging
 import os
 import re
+import shutil
 import sys
-import tempfile
 import time
+import zipfile
 
 import flywheel
 from flywheel_migration import deidentify
 from flywheel_migration.util import get_safe_filename
 
 from deid_export.retry import retry
-from deid_export.deid_file import deidentify_file
+from deid_export.container_cache import CONTAINER_CACHE
+from deid_export.deid_file import MEMORY_FS_PROFILES, deidentify_bytes, deidentify_file, get_zip_size
+from deid_export.export_plan import get_matching_file_profile
 from deid_export import deid_template
 from deid_export.metadata_export import get_container_metadata
+from deid_export.profiling import profile_file
+from deid_export.spool import FILE_SPOOL_FACTOR, SPOOL
 
 log = logging.getLogger(__name__)
 
+# info.export fields compared by delta exports to decide whether a file has changed since it was exported
+DELTA_EXPORT_KEYS = ('origin_hash', 'origin_modified', 'profile_hash')
+
+# the export stages that are timed for each file, and whether the bytes they process are recorded
+EXPORT_STAGES = (('download', True), ('deid', True), ('upload', True), ('metadata', False))
+# status keys of the wall time (seconds) and bytes of each stage
+STAGE_STATUS_KEYS = [
+    key for stage, has_bytes in EXPORT_STAGES
+    for key in ([f'{stage}_seconds', f'{stage}_bytes'] if has_bytes else [f'{stage}_seconds'])
+]
+
 
 def search_job_log_str(regex_string, job_log_str):
     if not job_log_str:
@@ -162,58 +178,142 @@ class FileExporter:
     """A class for representing the export status of a file"""
     @retry(max_retry=2)
     def __init__(self, fw_client, origin_parent, origin_filename, dest_parent, overwrite=False, log_level='INFO',
-                 config=None):
+                 config=None, journal=None, profile_hash=None, in_memory_max_bytes=0):
         self.fw_client = fw_client
+        self.journal = journal
+        self.profile_hash = profile_hash
         self.origin_parent = origin_parent
         self.dest_parent = dest_parent
         self.origin_filename = origin_filename
         self.config = dict()
         self.log = logging.getLogger(f'{self.origin_parent.id}_{self.origin_filename}_exporter')
         self.log.setLevel(log_level)
-        self.state = 'initialized'
+        # the initial state is not a transition, so it is not journaled
+        self._state = 'initialized'
         self.overwrite = overwrite
         self.filename = ''
         self.deid_path = ''
+        # the spool directory holding the downloaded and de-identified copies of the file
+        self.spool_dir = None
+        # files up to this size are de-identified in memory where their file profile allows it
+        self.in_memory_max_bytes = in_memory_max_bytes
+        # the de-identified file, if it was de-identified in memory
+        self.deid_content = None
         self.deid_job = DeidUtilityJob()
         self.errors = list()
         self.metadata_dict = None
+        self.dest = None
+        # wall time and bytes of each export stage, with the keys of STAGE_STATUS_KEYS
+        self.stage_stats = dict()
         self.origin = origin_parent.get_file(origin_filename)
         if not self.origin:
             self.error_handler(
                 f'{self.origin_filename} does not exist in {self.origin_parent.container_type} {self.origin_parent.id}'
             )
-        self.dest = None
         self.initial_state = self.state
         if isinstance(config, dict):
             self.config = config
 
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        changed = state != self._state
+        self._state = state
+        if changed and self.journal is not None:
+            self.journal.record(self._get_status_dict())
+
+    def record_stage(self, stage, seconds, byte_count=None):
+        """Adds the wall time (and bytes processed, if known) of an export stage to stage_stats, accumulating over
+        retries
+
+        Args:
+            stage (str): the stage name, one of EXPORT_STAGES
+            seconds (float): the wall time of the stage
+            byte_count (int): the number of bytes processed by the stage
+        """
+        self.stage_stats[f'{stage}_seconds'] = self.stage_stats.get(f'{stage}_seconds', 0) + seconds
+        if byte_count is not None:
+            self.stage_stats[f'{stage}_bytes'] = self.stage_stats.get(f'{stage}_bytes', 0) + byte_count
+
     def error_handler(self, log_str):
+        # record the error before the state so that it is journaled with the transition
+        self.errors.append(log_str)
         self.state = 'error'
         self.log.error(log_str)
-        self.errors.append(log_str)
 
     def get_metadata_dict(self):
         conf_dict = dict()
         if isinstance(self.config, dict):
             conf_dict = self.config.get('file', dict())
         self.metadata_dict = get_container_metadata(self.origin, conf_dict)
+        # record what the file was exported from so that delta exports can tell whether it has changed
+        export_dict = self.metadata_dict.setdefault('info', dict()).setdefault('export', dict())
+        export_dict['origin_hash'] = self.origin.get('hash')
+        origin_modified = self.origin.get('modified')
+        export_dict['origin_modified'] = str(origin_modified) if origin_modified else None
+        export_dict['profile_hash'] = self.profile_hash
 
         return self.metadata_dict
 
+    def find_exported_file(self):
+        """Returns the file in dest_parent that was exported from the origin file, or None"""
+        origin_id = self.get_metadata_dict()['info']['export']['origin_id']
+        for dest_file in self.dest_parent.get('files') or list():
+            dest_export_dict = (dest_file.get('info') or dict()).get('export') or dict()
+            if dest_export_dict.get('origin_id') == origin_id:
+                return dest_file
+        return None
+
+    def skip_if_unchanged(self):
+        """
+        Sets state to 'unchanged' if dest_parent has a file exported from the same origin file content with the same
+            de-identification profile, in which case the file does not need to be downloaded, de-identified or uploaded
+
+        Returns:
+            bool: whether the file is unchanged
+        """
+        if self.state == 'error':
+            return False
+        self.dest_parent = CONTAINER_CACHE.reload(self.dest_parent)
+        dest_file = self.find_exported_file()
+        if not dest_file:
+            return False
+        local_export_dict = self.metadata_dict['info']['export']
+        dest_export_dict = dest_file['info']['export']
+        # without a profile hash and either an origin hash or timestamp there is nothing to compare
+        if not local_export_dict['profile_hash'] or not (
+                local_export_dict['origin_hash'] or local_export_dict['origin_modified']):
+            return False
+        for key in DELTA_EXPORT_KEYS:
+            if local_export_dict[key] and dest_export_dict.get(key) != local_export_dict[key]:
+                return False
+        self.filename = dest_file.name
+        self.dest = dest_file
+        self.state = 'unchanged'
+        return True
+
     def update_metadata(self):
 
         if not self.metadata_dict:
             self.get_metadata_dict()
 
         if self.dest:
+            start = time.monotonic()
             metadata_dict = self.metadata_dict.copy()
-            if metadata_dict.get('info'):
-                info_dict = metadata_dict.pop('info')
-                self.log.debug(f'updating info for file {self.filename}')
-                self.dest_parent.update_file_info(self.filename, info_dict)
-                self.log.debug(f'updated info for file {self.filename}')
-            if metadata_dict:
-                self.dest_parent.update_file(self.filename, metadata_dict)
+            try:
+                if metadata_dict.get('info'):
+                    info_dict = metadata_dict.pop('info')
+                    self.log.debug(f'updating info for file {self.filename}')
+                    self.dest_parent.update_file_info(self.filename, info_dict)
+                    self.log.debug(f'updated info for file {self.filename}')
+                if metadata_dict:
+                    self.dest_parent.update_file(self.filename, metadata_dict)
+            finally:
+                CONTAINER_CACHE.invalidate(self.dest_parent.id)
+                self.record_stage('metadata', time.monotonic() - start)
         else:
             self.error_handler(f'could not update metadata for {self.filename}: {self.origin.id} - file was not found!')
 
@@ -226,8 +326,8 @@ class FileExporter:
     def reload(self):
         if self.state != 'error':
             try:
-                self.origin_parent = self.origin_parent.reload()
-                self.dest_parent = self.dest_parent.reload()
+                self.origin_parent = CONTAINER_CACHE.reload(self.origin_parent)
+                self.dest_parent = CONTAINER_CACHE.reload(self.dest_parent)
                 if self.filename:
                     self.dest = self.dest_parent.get_file(self.filename)
 
@@ -300,35 +400,173 @@ class FileExporter:
             self.deid_job.cancel(self.fw_client)
             self.state = 'cancelled'
 
-    def deidentify(self, deid_profile):
-        with tempfile.TemporaryDirectory() as temp_dir1:
-            # Download the file
+    def reserve_spool(self):
+        """Reserves spool space for the downloaded and de-identified copies of the file, waiting if the spool is full.
+        The reservation is not held by the calling thread, since the file may be de-identified and uploaded by others
 
-            local_file_path = os.path.join(temp_dir1, get_safe_filename(self.origin_filename))
-            self.log.debug(f'Downloading {self.origin.name} to {local_file_path}')
-            self.origin.download(local_file_path)
+        Returns:
+            str: the spool directory of the file
+        """
+        if not self.spool_dir:
+            self.spool_dir = SPOOL.acquire(FILE_SPOOL_FACTOR * (self.origin.get('size') or 0), hold=False)
+        return self.spool_dir
 
-            # De-identify
-            self.log.debug(
-                f'Applying de-identfication template to {local_file_path}'
-                f' to {os.path.basename(local_file_path)}'
-            )
-            temp_dir = tempfile.mkdtemp()
+    def get_download_path(self, directory=None):
+        """Returns the path to which to download the origin file
+
+        Args:
+            directory (str): the directory to which to download the file, the file's spool directory if not provided
+
+        Returns:
+            str: the path to which to download the file
+        """
+        if not directory:
+            directory = os.path.join(self.reserve_spool(), 'origin')
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, get_safe_filename(self.origin_filename))
+
+    def download(self, directory=None):
+        """Downloads the origin file to directory
+
+        Args:
+            directory (str): the directory to which to download the file, the file's spool directory if not provided
+
+        Returns:
+            str: the path to the downloaded file
+        """
+        local_file_path = self.get_download_path(directory)
+        self.log.debug(f'Downloading {self.origin.name} to {local_file_path}')
+        start = time.monotonic()
+        self.origin.download(local_file_path)
+        self.record_stage('download', time.monotonic() - start, os.path.getsize(local_file_path))
+        return local_file_path
+
+    def can_deidentify_in_memory(self, deid_profile):
+        """Returns whether the origin file is no larger than in_memory_max_bytes and is handled by a file profile that
+        can de-identify it in memory"""
+        if not self.in_memory_max_bytes or not self.origin:
+            return False
+        size = self.origin.get('size')
+        if size is None or size > self.in_memory_max_bytes:
+            return False
+        file_profile = get_matching_file_profile(deid_profile, self.origin)
+        return file_profile is not None and file_profile.name in MEMORY_FS_PROFILES
+
+    def read(self):
+        """Downloads the origin file into memory
+
+        Returns:
+            bytes: the content of the file
+        """
+        self.log.debug(f'Downloading {self.origin.name} into memory')
+        start = time.monotonic()
+        content = self.origin.read()
+        self.record_stage('download', time.monotonic() - start, len(content))
+        return content
+
+    def deidentify_in_memory(self, deid_profile, origin_content):
+        """De-identifies the origin file from its content without writing to disk, keeping the de-identified file in
+        deid_content
+
+        Args:
+            deid_profile(DeIdProfile): the de-identification profile to use to process the file
+            origin_content (bytes): the content of the origin file
+        """
+        start = time.monotonic()
+        try:
+            with profile_file(self.origin_filename):
+                filename, deid_content = deidentify_bytes(deid_profile=deid_profile,
+                                                          filename=get_safe_filename(self.origin_filename),
+                                                          content=origin_content)
+        except Exception as e:
+            self.record_stage('deid', time.monotonic() - start)
+            self.error_handler(
+                f'an exception was raised when de-identifying {self.origin_filename}:')
+            self.log.exception(e)
+            return None
+        self.record_stage('deid', time.monotonic() - start, len(deid_content) if deid_content is not None else None)
+        if deid_content is None:
+            self.error_handler(f'{self.origin_filename} de-identification failed.')
+        else:
+            self.filename = filename
+            self.deid_content = deid_content
+            self.get_metadata_dict()
+            self.state = 'processed'
+
+    def deidentify(self, deid_profile, local_file_path=None, origin_content=None):
+        """De-identifies the origin file to the file's spool directory, downloading it first unless local_file_path is
+        provided. The spool copy of the origin file is removed once it has been de-identified, and the spool directory
+        is released if de-identification fails.
+
+        Files that can_deidentify_in_memory are downloaded and de-identified in memory instead.
+
+        Args:
+            deid_profile(DeIdProfile): the de-identification profile to use to process the file
+            local_file_path (str): an optional path to the already-downloaded origin file
+            origin_content (bytes): the optional already-downloaded content of the origin file, which is de-identified
+                in memory
+        """
+        if not local_file_path and origin_content is None and self.can_deidentify_in_memory(deid_profile):
+            origin_content = self.read()
+        if origin_content is not None:
+            return self.deidentify_in_memory(deid_profile, origin_content)
+        if not local_file_path:
             try:
+                local_file_path = self.download()
+            except BaseException:
+                self.cleanup()
+                raise
+
+        # De-identify
+        self.log.debug(
+            f'Applying de-identfication template to {local_file_path}'
+            f' to {os.path.basename(local_file_path)}'
+        )
+        output_directory = os.path.join(self.reserve_spool(), 'deid')
+        shutil.rmtree(output_directory, ignore_errors=True)
+        os.makedirs(output_directory)
+        start = time.monotonic()
+        try:
+            # the reservation made before the download is sized from the file, but the members of an archive are
+            # extracted to de-identify them
+            if zipfile.is_zipfile(local_file_path):
+                SPOOL.extend(self.spool_dir, get_zip_size(local_file_path))
+            # spool space reserved while de-identifying is nested in the file's space
+            with profile_file(self.origin_filename), SPOOL.hold(self.spool_dir):
                 deid_path = deidentify_file(deid_profile=deid_profile, file_path=local_file_path,
-                                            output_directory=temp_dir)
-            except Exception as e:
-                self.error_handler(
-                    f'an exception was raised when de-identifying {self.origin_filename}:')
-                self.log.exception(e)
-                return None
-            if not os.path.exists(deid_path):
-                self.error_handler(f'{self.origin_filename} de-identification failed.')
-            else:
-                self.filename = os.path.basename(deid_path)
-                self.deid_path = deid_path
-                self.get_metadata_dict()
-                self.state = 'processed'
+                                            output_directory=output_directory)
+        except Exception as e:
+            self.record_stage('deid', time.monotonic() - start)
+            self.error_handler(
+                f'an exception was raised when de-identifying {self.origin_filename}:')
+            self.log.exception(e)
+            self.cleanup()
+            return None
+        finally:
+            if self.spool_dir:
+                shutil.rmtree(os.path.join(self.spool_dir, 'origin'), ignore_errors=True)
+        self.record_stage('deid', time.monotonic() - start,
+                          os.path.getsize(deid_path) if os.path.exists(deid_path) else None)
+        if not os.path.exists(deid_path):
+            self.error_handler(f'{self.origin_filename} de-identification failed.')
+            self.cleanup()
+        else:
+            self.filename = os.path.basename(deid_path)
+            self.deid_path = deid_path
+            self.get_metadata_dict()
+            self.state = 'processed'
+
+    def get_upload_file(self):
+        """Returns the de-identified file to upload and its size
+
+        Returns:
+            tuple: (str or flywheel.FileSpec, int) the path of the de-identified file, or a FileSpec of its content if
+                it was de-identified in memory, and its size in bytes
+        """
+        if self.deid_content is not None:
+            # files de-identified in memory are uploaded from memory
+            return flywheel.FileSpec(self.filename, contents=self.deid_content), len(self.deid_content)
+        return self.deid_path, os.path.getsize(self.deid_path)
 
     @retry(2)
     def upload(self):
@@ -361,7 +599,7 @@ class FileExporter:
                         f'overwrite is set to False')
 
             return upload
-        if not os.path.exists(self.deid_path):
+        if self.deid_content is None and not os.path.exists(self.deid_path):
             self.error_handler(
                 f'{self.filename} cannot be uploaded to {self.dest_parent.id} - local path does not exist')
         if self.state == 'processed':
@@ -372,19 +610,29 @@ class FileExporter:
                     )
                     self.dest_parent.delete_file(self.filename)
 
-                self.dest_parent.upload_file(self.deid_path)
+                upload_file, upload_bytes = self.get_upload_file()
+                start = time.monotonic()
+                try:
+                    self.dest_parent.upload_file(upload_file)
+                finally:
+                    CONTAINER_CACHE.invalidate(self.dest_parent.id)
+                    self.record_stage('upload', time.monotonic() - start, upload_bytes)
                 self.state = 'upload_attempted'
         else:
             self.log.warning('Cannot upload %s. State %s is not processed.', self.filename, self.state)
 
     def cleanup(self):
-        if os.path.exists(self.deid_path):
+        """Removes the local copies of the file, releasing their spool space"""
+        self.deid_content = None
+        if self.spool_dir:
+            SPOOL.release(self.spool_dir)
+            self.spool_dir = None
+        elif self.deid_path and os.path.exists(self.deid_path):
             os.remove(self.deid_path)
 
-    def get_status_dict(self):
-        self.reload()
+    def _get_status_dict(self):
         status_dict = {
-            'origin_filename': self.origin.name,
+            'origin_filename': self.origin_filename,
             'origin_parent': self.origin_parent.id,
             'origin_parent_type': self.origin_parent.container_type,
             'export_filename': self.filename,
@@ -395,7 +643,13 @@ class FileExporter:
         }
         if self.dest:
             status_dict['export_file_id'] = self.dest.id
+        for key in STAGE_STATUS_KEYS:
+            status_dict[key] = self.stage_stats.get(key)
         return status_dict
 
+    def get_status_dict(self):
+        self.reload()
+        return self._get_status_dict()
+
 
 
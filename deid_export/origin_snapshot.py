@@ -0,0 +1,173 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+CHILD_CONTAINER_TYPES = {
+    'project': ['subject', 'session', 'acquisition'],
+    'subject': ['session', 'acquisition'],
+    'session': ['acquisition'],
+}
+
+# the finder filter key used to find children of each container type
+PARENT_FILTER_KEYS = {
+    'project': 'parents.project',
+    'subject': 'parents.subject',
+    'session': 'parents.session',
+}
+
+
+def _get_parent_id(container, parent_type):
+    parents = container.get('parents') or dict()
+    return parents.get(parent_type)
+
+
+class OriginSnapshot:
+    """An in-memory snapshot of the origin container hierarchy.
+
+    The subjects, sessions and acquisitions below the root container are enumerated with one finder call per
+    container type when the snapshot is created. Finder results do not include info, so each container is loaded
+    in full the first time it is requested with get() and then served from memory for the rest of the export.
+    The origin hierarchy is not modified by the export, so the snapshot does not need to be refreshed during an
+    export. Between exports (e.g. polls of a watch), refresh_sessions() reloads the sessions that were modified.
+    """
+    def __init__(self, fw_client, root_container):
+        """
+        Args:
+            fw_client (flywheel.Client): an instance of the flywheel client
+            root_container (flywheel.Project, flywheel.Subject or flywheel.Session): the container to snapshot
+        """
+        self.fw_client = fw_client
+        self.root_id = root_container.id
+        self.root_type = root_container.container_type
+        self._lock = threading.Lock()
+        # the root container is expected to be fully loaded already
+        self._containers = {root_container.id: root_container}
+        self._children = dict()
+        # container id: parent id, for the enumerated containers
+        self._parent_ids = dict()
+        self.api_calls = 0
+        self._enumerate()
+
+    def __getstate__(self):
+        # flywheel.Client and locks cannot be pickled, process workers build their own snapshot
+        raise TypeError('OriginSnapshot cannot be pickled')
+
+    def _enumerate(self):
+        if self.root_type not in CHILD_CONTAINER_TYPES:
+            raise ValueError(f'Cannot snapshot container type {self.root_type}. Must be session, subject, or project')
+        filter_str = f'{PARENT_FILTER_KEYS[self.root_type]}={self.root_id}'
+        for child_type in CHILD_CONTAINER_TYPES[self.root_type]:
+            finder = getattr(self.fw_client, f'{child_type}s')
+            self.api_calls += 1
+            parent_type = {'subject': 'project', 'session': 'subject', 'acquisition': 'session'}[child_type]
+            for child in finder.iter_find(filter_str):
+                self._add_child(_get_parent_id(child, parent_type), child)
+        log.debug(f'Enumerated {self.root_type} {self.root_id} with {self.api_calls} finder calls')
+
+    def _add_child(self, parent_id, child):
+        self._children.setdefault(parent_id, list()).append(child)
+        self._parent_ids[child.id] = parent_id
+
+    def _remove_child(self, child_id):
+        parent_id = self._parent_ids.pop(child_id, None)
+        siblings = self._children.get(parent_id, list())
+        self._children[parent_id] = [sibling for sibling in siblings if sibling.id != child_id]
+        self._containers.pop(child_id, None)
+
+    def refresh_sessions(self, session_ids):
+        """Reloads the root container and the sessions session_ids (which may be new), along with their subjects and
+        acquisitions, so that the snapshot reflects their current state without enumerating the whole hierarchy again
+
+        Args:
+            session_ids (iterable): the ids of the sessions to reload
+        """
+        with self._lock:
+            self._containers[self.root_id] = self.fw_client.get(self.root_id)
+            self.api_calls += 1
+            refreshed_subject_ids = set()
+            for session_id in session_ids:
+                if session_id != self.root_id:
+                    session = self.fw_client.get(session_id)
+                    self.api_calls += 1
+                    subject_id = _get_parent_id(session, 'subject')
+                    self._remove_child(session_id)
+                    self._add_child(subject_id, session)
+                    self._containers[session_id] = session
+                    if self.root_type == 'project' and subject_id not in refreshed_subject_ids:
+                        # the subject may be new, or its code may have changed
+                        subject = self.fw_client.get(subject_id)
+                        self.api_calls += 1
+                        self._remove_child(subject_id)
+                        self._add_child(self.root_id, subject)
+                        self._containers[subject_id] = subject
+                        refreshed_subject_ids.add(subject_id)
+                for acquisition in self._get_children(session_id):
+                    self._remove_child(acquisition.id)
+                self._children.pop(session_id, None)
+                for acquisition in self.fw_client.acquisitions.iter_find(f'parents.session={session_id}'):
+                    self._add_child(session_id, acquisition)
+                self.api_calls += 1
+
+    def get(self, container_id):
+        """Returns the fully-loaded container with id container_id, loading it on first request
+
+        Args:
+            container_id (str): the id of the container
+
+        Returns:
+            flywheel container: the container
+        """
+        container = self._containers.get(container_id)
+        if container is None:
+            # Loaded outside the lock so that threads do not wait on each other's requests
+            loaded = self.fw_client.get(container_id)
+            with self._lock:
+                self.api_calls += 1
+                container = self._containers.setdefault(container_id, loaded)
+        return container
+
+    def _get_children(self, parent_id):
+        return list(self._children.get(parent_id, list()))
+
+    def subjects(self, project_id=None):
+        """Returns the subjects of project_id (or of the snapshot root project) as returned by the finder"""
+        return self._get_children(project_id or self.root_id)
+
+    def sessions(self, subject_id):
+        """Returns the sessions of subject_id as returned by the finder"""
+        return self._get_children(subject_id)
+
+    def acquisitions(self, session_id):
+        """Returns the acquisitions of session_id as returned by the finder"""
+        return self._get_children(session_id)
+
+
+def load_container(container, snapshot=None):
+    """Returns the fully-loaded origin container from snapshot if provided, otherwise reloads container
+
+    Args:
+        container (flywheel container): the container to load
+        snapshot (OriginSnapshot): an optional snapshot of the origin hierarchy
+
+    Returns:
+        flywheel container: the loaded container
+    """
+    if snapshot is not None:
+        return snapshot.get(container.id)
+    return container.reload()
+
+
+def load_acquisitions(session, snapshot=None):
+    """Returns the fully-loaded acquisitions of the origin session, from snapshot if provided
+
+    Args:
+        session (flywheel.Session): the origin session
+        snapshot (OriginSnapshot): an optional snapshot of the origin hierarchy
+
+    Returns:
+        list: list of flywheel.Acquisition
+    """
+    if snapshot is not None:
+        return [snapshot.get(acquisition.id) for acquisition in snapshot.acquisitions(session.id)]
+    return [acquisition.reload() for acquisition in session.acquisitions()]
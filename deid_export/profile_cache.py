@@ -0,0 +1,156 @@
+import collections
+import contextlib
+import copy
+import hashlib
+import logging
+import threading
+
+from flywheel_migration import deidentify
+
+from deid_export import deid_template
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 32
+
+
+def get_content_hash(file_path):
+    """Returns the sha1 hexdigest of the content of the file at file_path"""
+    with open(file_path, 'rb') as f_data:
+        return hashlib.sha1(f_data.read()).hexdigest()
+
+
+def reset_profile(deid_profile):
+    """Clears the state that a DeIdProfile keeps from the files it processes: the first record of each file profile,
+    which zip profiles (and those of their members) read fields from when naming archives"""
+    for file_profile in deid_profile.file_profiles:
+        for profile in [file_profile] + list(getattr(file_profile, 'file_profiles', None) or list()):
+            if hasattr(profile, 'record'):
+                profile.record = None
+
+
+class ProfileCache:
+    """A thread-safe LRU cache of parsed de-identification templates and compiled DeIdProfiles.
+
+    Templates are keyed by the content hash of their file, so that per-subject templates written to new paths with the
+    same content are parsed once, and compiled profiles by the hash of the effective template (see
+    deid_template.get_template_hash). A DeIdProfile keeps state from the files it processes, so each compiled profile
+    is used by one caller at a time: acquire() takes an idle profile or compiles a new one and release() resets it and
+    returns it to the cache. When there are more than max_entries templates (or effective templates), the least
+    recently used is evicted.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            max_entries (int): the maximum number of parsed templates and of effective templates with compiled profiles
+        """
+        self.max_entries = max_entries
+        self.template_hits = 0
+        self.template_misses = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (content hash, parse function): parsed template
+        self._templates = collections.OrderedDict()
+        # effective template hash: list of idle (DeIdProfile, export config)
+        self._profiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, entries):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_template(self, template_path, parse_func):
+        """
+        Returns a copy of the template at template_path as parsed by parse_func, which is only called the first time a
+            template content is seen
+        Args:
+            template_path (str): the path of the template file
+            parse_func (callable): parse_func(template_path) returns the template dictionary
+
+        Returns:
+            dict: the template dictionary, which the caller may modify
+        """
+        key = (get_content_hash(template_path), getattr(parse_func, '__qualname__', repr(parse_func)))
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.template_hits += 1
+        if template is None:
+            template = parse_func(template_path)
+            with self._lock:
+                self.template_misses += 1
+                self._templates[key] = template
+                self._evict(self._templates)
+        # DeIdProfile.load_config modifies the config it is passed
+        return copy.deepcopy(template)
+
+    def acquire(self, template_dict):
+        """
+        Returns a compiled DeIdProfile for template_dict, to be returned with release() once the caller is done with it
+        Args:
+            template_dict (dict): the effective de-identification template
+
+        Returns:
+            tuple: (flywheel_migration.deidentify.DeIdProfile, dict, str) the profile, the export config and the
+                template hash to pass to release()
+        """
+        profile_hash = deid_template.get_template_hash(template_dict)
+        with self._lock:
+            idle = self._profiles.get(profile_hash)
+            if idle is not None:
+                self._profiles.move_to_end(profile_hash)
+                if idle:
+                    self.hits += 1
+                    deid_profile, export_config = idle.pop()
+                    return deid_profile, export_config, profile_hash
+            self.misses += 1
+        deid_profile, export_config = deid_template.load_deid_profile(copy.deepcopy(template_dict))
+        return deid_profile, export_config, profile_hash
+
+    def release(self, profile_hash, deid_profile, export_config):
+        """Resets a profile returned by acquire() and returns it to the cache"""
+        reset_profile(deid_profile)
+        with self._lock:
+            self._profiles.setdefault(profile_hash, list()).append((deid_profile, export_config))
+            self._profiles.move_to_end(profile_hash)
+            self._evict(self._profiles)
+
+    @contextlib.contextmanager
+    def checkout(self, template_dict):
+        """A context manager that yields (DeIdProfile, export config) for template_dict and releases the profile on
+        exit"""
+        deid_profile, export_config, profile_hash = self.acquire(template_dict)
+        try:
+            yield deid_profile, export_config
+        finally:
+            self.release(profile_hash, deid_profile, export_config)
+
+    def clear(self):
+        """Removes all templates and profiles from the cache"""
+        with self._lock:
+            self._templates.clear()
+            self._profiles.clear()
+
+    def get_counts(self):
+        """Returns a dictionary of template and compiled profile cache hits, misses and evictions"""
+        return {
+            'template_cache_hits': self.template_hits,
+            'template_cache_misses': self.template_misses,
+            'profile_cache_hits': self.hits,
+            'profile_cache_misses': self.misses,
+            'profile_cache_evictions': self.evictions
+        }
+
+
+def validate_profile(deid_profile, template_path):
+    """Raises flywheel_migration.deidentify.ValidationError if deid_profile, loaded from template_path, is invalid"""
+    errors = deid_profile.validate()
+    if errors:
+        raise deidentify.ValidationError(template_path, errors)
+
+
+# Shared by all session exports and de-identification helpers in a process
+PROFILE_CACHE = ProfileCache()
@@ -0,0 +1,228 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import heapq
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+PROFILE_MODES = ('run', 'files')
+DEFAULT_TOP_N = 10
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# the number of functions listed in text reports
+REPORT_LINES = 40
+
+# the profiler of the export running in this process, consulted by profile_file
+_ACTIVE_PROFILER = None
+
+
+class StackSampler:
+    """Periodically samples the Python stacks of all threads and counts identical stacks, for flamegraphs.
+
+    Unlike cProfile, which only sees the thread that enabled it, sampling covers export worker threads too.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        Args:
+            interval (float): the number of seconds between samples
+        """
+        self.interval = interval
+        self.stack_counts = collections.Counter()
+        self.sample_count = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='stack_sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Records the current stack of every thread other than the sampler's"""
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        sampler_ident = threading.get_ident()
+        for thread_ident, frame in sys._current_frames().items():
+            if thread_ident == sampler_ident:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_ident, str(thread_ident)))
+            self.stack_counts[';'.join(reversed(stack))] += 1
+        self.sample_count += 1
+
+    def write_collapsed(self, path):
+        """Writes the sampled stacks in the collapsed format read by flamegraph.pl and speedscope"""
+        with open(path, 'w') as f_data:
+            for stack, count in sorted(self.stack_counts.items()):
+                f_data.write(f'{stack} {count}\n')
+
+
+def _format_stats(profile_or_stats, sort_key='cumulative', lines=REPORT_LINES):
+    stream = io.StringIO()
+    stats = pstats.Stats(profile_or_stats, stream=stream)
+    stats.sort_stats(sort_key).print_stats(lines)
+    return stream.getvalue()
+
+
+class ExportProfiler:
+    """Profiles an export and writes the results to output_dir.
+
+    In 'run' mode the thread that runs the export is profiled with cProfile for the whole run. In 'files' mode the
+    de-identification of each file is profiled separately and the profiles of the top_n slowest files are kept. In both
+    modes the stacks of all threads are sampled for a flamegraph. The following are written:
+        export_profile.collapsed: the sampled stacks of all threads
+        export_profile.pstats, export_profile.txt: the run profile ('run' mode)
+        export_profile_file_<rank>.pstats, export_profile_files.txt: the slowest file profiles ('files' mode)
+    """
+    def __init__(self, mode, output_dir, top_n=DEFAULT_TOP_N, sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        """
+        Args:
+            mode (str): 'run' or 'files'
+            output_dir (str): the directory to which to write profiles
+            top_n (int): the number of slowest file profiles to keep in 'files' mode
+            sample_interval (float): the number of seconds between stack samples
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f'Unknown profile mode {mode}. Must be one of {", ".join(PROFILE_MODES)}')
+        self.mode = mode
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.sampler = StackSampler(interval=sample_interval)
+        self._run_profile = None
+        # min-heap of (seconds, sequence, filename, profile) holding the slowest files
+        self._file_profiles = list()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._start_time = None
+
+    def __enter__(self):
+        global _ACTIVE_PROFILER
+        _ACTIVE_PROFILER = self
+        self._start_time = time.monotonic()
+        self.sampler.start()
+        if self.mode == 'run':
+            self._run_profile = cProfile.Profile()
+            self._run_profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _ACTIVE_PROFILER
+        if self._run_profile is not None:
+            self._run_profile.disable()
+        self.sampler.stop()
+        _ACTIVE_PROFILER = None
+        try:
+            self.write()
+        except Exception as e:
+            # a failure to write profiles must not mask the result of the export
+            log.error(f'Failed to write profiles to {self.output_dir}: {e}', exc_info=True)
+        return False
+
+    @contextlib.contextmanager
+    def profile_file(self, filename):
+        """A context manager that profiles the processing of filename, keeping the profile if it is among the top_n
+        slowest"""
+        if self.mode != 'files':
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler can be active at a time on Python 3.12+, concurrent files are timed by sampling only
+            profile = None
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            if profile is not None:
+                profile.disable()
+                self._add_file_profile(seconds, filename, profile)
+
+    def _add_file_profile(self, seconds, filename, profile):
+        with self._lock:
+            item = (seconds, next(self._sequence), filename, profile)
+            if len(self._file_profiles) < self.top_n:
+                heapq.heappush(self._file_profiles, item)
+            else:
+                heapq.heappushpop(self._file_profiles, item)
+
+    def get_slowest_files(self):
+        """Returns the list of (seconds, filename, profile) of the slowest profiled files, slowest first"""
+        with self._lock:
+            items = sorted(self._file_profiles, reverse=True)
+        return [(seconds, filename, profile) for seconds, _, filename, profile in items]
+
+    def write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        collapsed_path = os.path.join(self.output_dir, 'export_profile.collapsed')
+        self.sampler.write_collapsed(collapsed_path)
+        log.info(f'Wrote {self.sampler.sample_count} stack samples to {collapsed_path}')
+        if self._run_profile is not None:
+            self._run_profile.dump_stats(os.path.join(self.output_dir, 'export_profile.pstats'))
+            with open(os.path.join(self.output_dir, 'export_profile.txt'), 'w') as f_data:
+                f_data.write(f'Profiled export run of {time.monotonic() - self._start_time:.1f} seconds\n')
+                f_data.write(_format_stats(self._run_profile))
+            log.info(f'Wrote export profile to {self.output_dir}')
+        if self.mode == 'files':
+            slowest_files = self.get_slowest_files()
+            with open(os.path.join(self.output_dir, 'export_profile_files.txt'), 'w') as f_data:
+                for rank, (seconds, filename, profile) in enumerate(slowest_files, start=1):
+                    profile.dump_stats(os.path.join(self.output_dir, f'export_profile_file_{rank}.pstats'))
+                    f_data.write(f'{rank}. {filename}: {seconds:.3f} seconds\n')
+                    f_data.write(_format_stats(profile, lines=REPORT_LINES // 2))
+            log.info(f'Wrote profiles of the {len(slowest_files)} slowest files to {self.output_dir}')
+
+
+@contextlib.contextmanager
+def profile_file(filename):
+    """Profiles the processing of filename if a profiler in 'files' mode is active in this process, otherwise does
+    nothing"""
+    profiler = _ACTIVE_PROFILER
+    if profiler is None:
+        yield
+    else:
+        with profiler.profile_file(filename):
+            yield
+
+
+def profile_option(func):
+    """
+    A decorator that adds profile, profile_top_n and profile_output_dir keyword arguments to an export function. If
+        profile is 'run' or 'files', the call is run under an ExportProfiler that writes to profile_output_dir (by
+        default, the directory of the csv_output_path argument or the working directory)
+    """
+    @functools.wraps(func)
+    def wrapper(*args, profile=None, profile_top_n=DEFAULT_TOP_N, profile_output_dir=None, **kwargs):
+        if not profile or profile == 'none':
+            return func(*args, **kwargs)
+        if not profile_output_dir:
+            csv_output_path = kwargs.get('csv_output_path')
+            profile_output_dir = os.path.dirname(os.path.abspath(csv_output_path)) if csv_output_path else os.getcwd()
+        if kwargs.get('backend') == 'process' and (kwargs.get('max_workers') or 1) > 1:
+            log.warning('Profiles only include this process, not the sessions exported by process workers')
+        with ExportProfiler(profile, profile_output_dir, top_n=profile_top_n):
+            return func(*args, **kwargs)
+    return wrapper
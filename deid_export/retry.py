@@ -1,9 +1,83 @@
 import logging
 import functools
+import random
 import sys
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
+# HTTP statuses that may succeed if the request is repeated
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# exceptions that indicate a programming or data error that will not succeed on a retry
+FATAL_EXCEPTION_TYPES = (AttributeError, KeyError, NameError, TypeError, ValueError)
+
+# retry counts keyed by the qualified name of each decorated function
+_RETRY_COUNTS = dict()
+_RETRY_COUNTS_LOCK = threading.Lock()
+
+
+def get_status_code(exc):
+    """Returns the integer HTTP status of an exception raised by the SDK (flywheel.ApiException.status may be a
+    string), or None if it does not have one"""
+    try:
+        return int(getattr(exc, 'status', None))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc):
+    """
+    The default retry predicate. Exceptions with an HTTP status (e.g. flywheel.ApiException) are retried if the status
+        is a timeout, throttling or server error, and not if it is a client error such as 403 or 404. Other
+        exceptions (e.g. connection errors) are retried unless they are programming or data errors.
+    Args:
+        exc (Exception): the exception raised by the decorated function
+
+    Returns:
+        bool: whether the call should be retried
+    """
+    status = get_status_code(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    return not isinstance(exc, FATAL_EXCEPTION_TYPES)
+
+
+def get_retry_counts():
+    """Returns a dictionary of the number of retries, and of calls that failed after retrying or on a fatal error,
+    for each decorated function called in this process"""
+    with _RETRY_COUNTS_LOCK:
+        counts = dict()
+        for name, func_counts in _RETRY_COUNTS.items():
+            counts[f'retries.{name}'] = func_counts['retries']
+            counts[f'retry_failures.{name}'] = func_counts['failures']
+        return counts
+
+
+def _increment_retry_count(name, key):
+    with _RETRY_COUNTS_LOCK:
+        func_counts = _RETRY_COUNTS.setdefault(name, {'retries': 0, 'failures': 0})
+        func_counts[key] += 1
+
+
+def get_backoff_delay(attempt, backoff, max_backoff, jitter=True):
+    """
+    Returns the number of seconds to wait before retry number attempt (starting at 0)
+    Args:
+        attempt (int): the number of retries already made
+        backoff (float): the delay before the first retry, doubled for each subsequent retry
+        max_backoff (float): the maximum delay
+        jitter (bool): if True, the delay is drawn uniformly from 0 to the exponential delay ("full jitter") so that
+            calls that failed together do not retry together
+
+    Returns:
+        float: the delay in seconds
+    """
+    delay = min(max_backoff, backoff * 2 ** attempt)
+    if jitter:
+        delay = random.uniform(0, delay)
+    return delay
+
 
 class RetryException(Exception):
     u_str = "Exception ({}) raised after {} tries."
@@ -19,34 +93,56 @@ class RetryException(Exception):
         return self.__unicode__()
 
 
-def retry(max_retry=5):
+def retry(max_retry=5, backoff=0.5, max_backoff=30, jitter=True, retry_on=is_retryable, deadline=None):
     """
     Args:
         func: The function that needs to be retry
         max_retry (int): Maximum retry of `func` function, default is `5`
+        backoff (float): the number of seconds to wait before the first retry, doubled for each subsequent retry
+        max_backoff (float): the maximum number of seconds to wait between retries
+        jitter (bool): whether to randomize the wait between retries
+        retry_on (callable): a predicate that takes the raised exception and returns whether to retry
+        deadline (float): the number of seconds after the first call after which no further retries are made
 
     Returns:
         func: the function to be retry
 
     Raises:
-        RetryException: if retries exceeded than max_retry
+        Exception: the exception raised by the last call if retries are exhausted, the deadline is reached, or the
+            exception is not retryable
     """
     def decorator_wrapper(func):
+        name = func.__qualname__
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            caught_exception = None
+            start = time.monotonic()
             for i in range(max_retry):
                 try:
                     return func(*args, **kwargs)
                 except Exception as ex:
-                    log.debug(f'Failed to call {func.__name__}, in retry({i + 1}/{max_retry})')
-                    caught_exception = ex
-
-            else:
-                raise caught_exception
+                    if not retry_on(ex):
+                        log.debug(f'Failed to call {func.__name__} with a non-retryable error: {ex}')
+                        _increment_retry_count(name, 'failures')
+                        raise
+                    if i + 1 >= max_retry:
+                        _increment_retry_count(name, 'failures')
+                        raise
+                    delay = get_backoff_delay(i, backoff, max_backoff, jitter=jitter)
+                    if deadline is not None and time.monotonic() - start + delay > deadline:
+                        log.debug(f'Failed to call {func.__name__}, retry deadline of {deadline}s reached')
+                        _increment_retry_count(name, 'failures')
+                        raise
+                    log.debug(f'Failed to call {func.__name__}, in retry({i + 1}/{max_retry}) after {delay:.2f}s')
+                    _increment_retry_count(name, 'retries')
+                    _sleep(delay)
         return wrapper
     return decorator_wrapper
 
+
+# module-level so that tests can avoid waiting
+_sleep = time.sleep
+
 """@retry(max_retry=2)
 def failing_function():
     raise Exception("Planned Failure")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Deterministic partitioning of an export across shards, and merging of the shards' status csvs.
+
+Subjects are assigned to shards by a stable hash of their id so that independent jobs (e.g. gear runs on different
+nodes) can each export one shard of a project without coordinating. Project files are exported by shard 0.
+"""
+import argparse
+import hashlib
+import logging
+import os
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# the shard that exports the files attached to the project
+PROJECT_FILES_SHARD = 0
+
+
+def validate_shard(shard_index, shard_count):
+    """Raises ValueError if shard_index is not a valid shard of shard_count shards"""
+    if shard_count < 1:
+        raise ValueError(f'shard_count must be at least 1, got {shard_count}')
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'shard_index must be between 0 and {shard_count - 1}, got {shard_index}')
+
+
+def get_shard_index(subject_id, shard_count):
+    """
+    Returns the shard to which a subject is assigned. Unlike hash(), sha1 does not vary between processes.
+    Args:
+        subject_id (str): the id of the origin subject
+        shard_count (int): the number of shards
+
+    Returns:
+        int: the shard index, between 0 and shard_count - 1
+    """
+    digest = hashlib.sha1(str(subject_id).encode()).hexdigest()
+    return int(digest, 16) % shard_count
+
+
+def in_shard(subject_id, shard_index=0, shard_count=1):
+    """Returns True if the subject with subject_id is exported by shard shard_index"""
+    return shard_count <= 1 or get_shard_index(subject_id, shard_count) == shard_index
+
+
+def get_shard_path(path, shard_index, shard_count):
+    """
+    Returns the path of a shard's output file, e.g. export.csv becomes export_shard-1-of-4.csv. path is returned
+        unchanged when there is a single shard.
+    """
+    if not path or shard_count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}_shard-{shard_index}-of-{shard_count}{ext}'
+
+
+def merge_status_csvs(csv_paths, output_path=None):
+    """
+    Combines the status csvs written by the shards of an export into a single status csv
+    Args:
+        csv_paths (list): the paths of the shard status csvs. A missing csv (e.g. of a shard that had no subjects) is
+            logged and skipped
+        output_path (str): the path to which to write the merged csv, not written if None
+
+    Returns:
+        tuple: (pandas.DataFrame, dict) the merged status DataFrame and the number of file export errors of each
+            shard csv, keyed by path
+    """
+    shard_dfs = list()
+    error_counts = dict()
+    for csv_path in csv_paths:
+        if not os.path.isfile(csv_path):
+            log.warning(f'Shard status csv {csv_path} does not exist')
+            continue
+        shard_df = pd.read_csv(csv_path)
+        error_counts[csv_path] = int((shard_df['state'] == 'error').sum()) if 'state' in shard_df else 0
+        shard_dfs.append(shard_df)
+
+    if shard_dfs:
+        # columns are kept in the order of the first csv, with any columns only present in later csvs appended
+        columns = list(dict.fromkeys(column for shard_df in shard_dfs for column in shard_df.columns))
+        merged_df = pd.concat(shard_dfs, ignore_index=True, sort=False).reindex(columns=columns)
+    else:
+        merged_df = pd.DataFrame()
+
+    key_columns = ['origin_parent', 'origin_filename']
+    if set(key_columns).issubset(merged_df.columns):
+        duplicate_count = int(merged_df.duplicated(subset=key_columns).sum())
+        if duplicate_count:
+            log.warning(f'{duplicate_count} files appear in more than one shard status csv, were the shards run with '
+                        f'the same shard_count?')
+
+    if output_path:
+        merged_df.to_csv(output_path, index=False)
+    log.info(f'Merged {len(shard_dfs)} shard status csvs with {len(merged_df)} files and '
+             f'{sum(error_counts.values())} file export errors')
+    for csv_path, error_count in error_counts.items():
+        if error_count:
+            log.info(f'{csv_path}: {error_count} file export errors')
+    return merged_df, error_counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the status csvs of a sharded export')
+    parser.add_argument('output_path', help='path to which to write the merged status csv')
+    parser.add_argument('csv_paths', nargs='+', help='paths of the shard status csvs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _, shard_error_counts = merge_status_csvs(args.csv_paths, args.output_path)
+    raise SystemExit(1 if sum(shard_error_counts.values()) else 0)
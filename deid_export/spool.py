@@ -0,0 +1,336 @@
+import atexit
+import collections
+import contextlib
+import functools
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# spool roots are named with this prefix and the pid of the process that created them
+SPOOL_PREFIX = 'deid_export_spool_'
+# the space reserved for a file export, as a multiple of the origin file size: the downloaded file and its
+# de-identified copy
+FILE_SPOOL_FACTOR = 2
+
+
+class SpoolError(Exception):
+    """Raised when a reservation could only be granted by waiting for space that will never be released"""
+
+
+def _pid_is_running(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows, so other processes' spools are assumed to be in use
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def get_path_size(path, file_list=None):
+    """
+    Returns the total size of the files at path
+    Args:
+        path (str): a file or directory
+        file_list (list): optional paths, relative to the directory path, of the files to include
+
+    Returns:
+        int: the number of bytes
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    if file_list is not None:
+        file_paths = [os.path.join(path, file_path) for file_path in file_list]
+    else:
+        file_paths = [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(path)
+                      for filename in filenames]
+    return sum(os.path.getsize(file_path) for file_path in file_paths if os.path.isfile(file_path))
+
+
+class SpoolManager:
+    """Hands out temporary directories for downloads, extracted archives and de-identified files while keeping the
+    bytes reserved for them within a budget.
+
+    A reservation that would exceed the budget waits, in the order of the requests, until enough space is released.
+    A reservation larger than the budget is granted once nothing else is reserved. A thread holds a reservation from
+    acquire() until it is released, or within a hold() block. Reservations requested by a thread that holds one (e.g.
+    de-identifying the files extracted from an archive) are nested: they count against the budget too, but wait ahead
+    of the other requests, are granted once everything else that is reserved is held by their own thread, and raise
+    SpoolError if every other reservation is held by threads that are themselves waiting for nested space, since none
+    of them could be released. Directories are removed when they are released, and any that remain are removed by
+    cleanup(), which also runs at exit.
+    """
+    def __init__(self, max_bytes=0, base_dir=None):
+        """
+        Args:
+            max_bytes (int): the byte budget, 0 for no limit
+            base_dir (str): the directory in which to create the spool root, the system temporary directory if None
+        """
+        self.max_bytes = max_bytes
+        self.base_dir = base_dir
+        self.reserved_bytes = 0
+        self.max_reserved_bytes = 0
+        self.reservations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.stale_dirs_removed = 0
+        self._root = None
+        self._root_pid = None
+        # reserved directory path: (reserved bytes, ident of the thread holding it or None)
+        self._paths = dict()
+        # thread ident: reserved directory paths the thread holds
+        self._held = dict()
+        # idents of the threads waiting for nested reservations
+        self._nested_waiting = set()
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+
+    def configure(self, max_bytes=0, base_dir=None):
+        """
+        Sets the byte budget and the directory in which the spool root is created, and removes spool roots left in
+            base_dir by processes that are no longer running
+        Args:
+            max_bytes (int): the byte budget, 0 for no limit
+            base_dir (str): the directory in which to create the spool root, the system temporary directory if None
+        """
+        with self._condition:
+            self.max_bytes = max_bytes or 0
+            self.max_reserved_bytes = self.reserved_bytes
+            if base_dir != self.base_dir and not self._paths:
+                self._remove_root()
+                self.base_dir = base_dir
+            self._condition.notify_all()
+        self.remove_stale_dirs()
+
+    def _get_root(self):
+        if self._root is None or self._root_pid != os.getpid() or not os.path.isdir(self._root):
+            base_dir = self.base_dir or tempfile.gettempdir()
+            os.makedirs(base_dir, exist_ok=True)
+            self._root = tempfile.mkdtemp(prefix=f'{SPOOL_PREFIX}{os.getpid()}_', dir=base_dir)
+            self._root_pid = os.getpid()
+        return self._root
+
+    def _remove_root(self):
+        if self._root is not None and self._root_pid == os.getpid():
+            shutil.rmtree(self._root, ignore_errors=True)
+        self._root = None
+
+    def _fits(self, byte_count, own_bytes):
+        return (not self.max_bytes or self.reserved_bytes == own_bytes or
+                self.reserved_bytes + byte_count <= self.max_bytes)
+
+    def _can_reserve(self, ticket, byte_count, own_bytes):
+        # nested reservations wait ahead of the queue, since the space they wait for is released by the threads that
+        # request them
+        return self._queue[0] is ticket and not self._nested_waiting and self._fits(byte_count, own_bytes)
+
+    def _is_deadlocked(self, own_paths):
+        # whether every other reservation is held by a thread waiting for nested space, so none can be released
+        holders = {path: thread_id for thread_id, held_paths in self._held.items() for path in held_paths}
+        return all(holders.get(path, holder) in self._nested_waiting
+                   for path, (path_bytes, holder) in self._paths.items() if path_bytes and path not in own_paths)
+
+    def _wait_for_space(self, byte_count, thread_id, own_paths=()):
+        # waits until byte_count more bytes are within the budget, where own_paths are reservations of the request
+        # that are not held by the calling thread (e.g. one being extended)
+        own_paths = set(self._held.get(thread_id, ())).union(own_paths)
+        own_bytes = sum(self._paths[path][0] for path in own_paths if path in self._paths)
+        start = time.monotonic()
+        waited = False
+        if thread_id in self._held:
+            try:
+                while not self._fits(byte_count, own_bytes):
+                    if self._is_deadlocked(own_paths):
+                        raise SpoolError(f'Cannot reserve {byte_count} bytes of spool space: {self.reserved_bytes} '
+                                         f'of {self.max_bytes} bytes are reserved by threads waiting for spool space')
+                    if not waited:
+                        log.debug(f'Waiting for {byte_count} bytes of nested spool space, {self.reserved_bytes} of '
+                                  f'{self.max_bytes} bytes are reserved')
+                    waited = True
+                    self._nested_waiting.add(thread_id)
+                    self._condition.wait()
+            finally:
+                if waited:
+                    self._nested_waiting.discard(thread_id)
+                    self._condition.notify_all()
+        else:
+            ticket = object()
+            self._queue.append(ticket)
+            try:
+                while not self._can_reserve(ticket, byte_count, own_bytes):
+                    if not waited:
+                        log.debug(f'Waiting for {byte_count} bytes of spool space, {self.reserved_bytes} of '
+                                  f'{self.max_bytes} bytes are reserved')
+                    waited = True
+                    self._condition.wait()
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+        if waited:
+            self.waits += 1
+            self.wait_seconds += time.monotonic() - start
+
+    def _add_reserved_bytes(self, byte_count):
+        self.reserved_bytes += byte_count
+        self.max_reserved_bytes = max(self.max_reserved_bytes, self.reserved_bytes)
+
+    def acquire(self, byte_count=0, hold=True):
+        """
+        Reserves byte_count bytes, waiting until they are within the budget, and returns a new empty directory for them
+        Args:
+            byte_count (int): the number of bytes that will be written to the directory
+            hold (bool): whether the calling thread holds the reservation until it is released. Reservations that are
+                handed to other threads (e.g. a file's spool directory) are acquired with hold=False and held with
+                hold() by the thread that writes to them
+
+        Returns:
+            str: the path of the reserved directory, to be passed to release()
+        """
+        byte_count = max(0, int(byte_count or 0))
+        thread_id = threading.get_ident()
+        with self._condition:
+            self._wait_for_space(byte_count, thread_id)
+            path = tempfile.mkdtemp(dir=self._get_root())
+            self._paths[path] = (byte_count, thread_id if hold else None)
+            if hold:
+                self._held.setdefault(thread_id, list()).append(path)
+            self._add_reserved_bytes(byte_count)
+            self.reservations += 1
+        return path
+
+    def extend(self, path, byte_count):
+        """
+        Reserves byte_count more bytes for a directory returned by acquire() (e.g. for the members of a downloaded
+            archive, which are only known once it has been downloaded), waiting as acquire() does
+        Args:
+            path (str): the reserved directory
+            byte_count (int): the number of bytes to add to its reservation
+        """
+        byte_count = max(0, int(byte_count or 0))
+        with self._condition:
+            if path not in self._paths or not byte_count:
+                return
+            self._wait_for_space(byte_count, threading.get_ident(), own_paths=(path,))
+            path_bytes, thread_id = self._paths[path]
+            self._paths[path] = (path_bytes + byte_count, thread_id)
+            self._add_reserved_bytes(byte_count)
+
+    def release(self, path):
+        """Removes a directory returned by acquire() and releases its reserved bytes"""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._condition:
+            byte_count, thread_id = self._paths.pop(path, (None, None))
+            if thread_id is not None:
+                self._unhold(thread_id, path)
+            if byte_count is not None:
+                self.reserved_bytes -= byte_count
+                self._condition.notify_all()
+
+    def _unhold(self, thread_id, path):
+        held_paths = self._held.get(thread_id, list())
+        if path in held_paths:
+            held_paths.remove(path)
+        if not held_paths:
+            self._held.pop(thread_id, None)
+
+    @contextlib.contextmanager
+    def reserve(self, byte_count=0):
+        """
+        A context manager that yields a directory with byte_count bytes reserved and releases it on exit, including
+            when an exception is raised
+        """
+        path = self.acquire(byte_count)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    @contextlib.contextmanager
+    def hold(self, path):
+        """
+        A context manager within which the calling thread holds the reservation of path (e.g. one acquired by another
+            thread with hold=False), so that the reservations it makes within the block are nested
+        """
+        thread_id = threading.get_ident()
+        with self._condition:
+            self._held.setdefault(thread_id, list()).append(path)
+        try:
+            yield path
+        finally:
+            with self._condition:
+                self._unhold(thread_id, path)
+                self._condition.notify_all()
+
+    def cleanup(self):
+        """Removes every directory of the spool and releases all reservations"""
+        with self._condition:
+            self._remove_root()
+            self._paths.clear()
+            self._held.clear()
+            self.reserved_bytes = 0
+            self._condition.notify_all()
+
+    def remove_stale_dirs(self):
+        """Removes the spool roots in the base directory of processes that are no longer running (e.g. killed ones)"""
+        base_dir = self.base_dir or tempfile.gettempdir()
+        if not os.path.isdir(base_dir):
+            return
+        for name in os.listdir(base_dir):
+            if not name.startswith(SPOOL_PREFIX):
+                continue
+            pid_str = name[len(SPOOL_PREFIX):].split('_', 1)[0]
+            if not pid_str.isdigit() or int(pid_str) == os.getpid() or _pid_is_running(int(pid_str)):
+                continue
+            log.info(f'Removing spool directory {name} of process {pid_str}, which is no longer running')
+            shutil.rmtree(os.path.join(base_dir, name), ignore_errors=True)
+            with self._condition:
+                self.stale_dirs_removed += 1
+
+    def get_counts(self):
+        """Returns a dictionary of spool reservations, waits for space and stale directories removed"""
+        return {
+            'spool_reservations': self.reservations,
+            'spool_waits': self.waits,
+            'spool_wait_seconds': self.wait_seconds,
+            'spool_stale_dirs_removed': self.stale_dirs_removed
+        }
+
+
+# Shared by all FileExporter instances and de-identification helpers in a process
+SPOOL = SpoolManager()
+atexit.register(SPOOL.cleanup)
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def exit_on_sigterm():
+    """Raises SystemExit when the process is sent SIGTERM (e.g. when a job is cancelled), so that finally blocks and
+    exit handlers remove the spool. Only has an effect in the main thread."""
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _raise_system_exit)
+
+
+def spool_option(func):
+    """
+    A decorator that adds spool_max_bytes and spool_dir keyword arguments to an export function. The process spool is
+        configured with them for the call and every spool directory is removed when the call returns or raises
+    """
+    @functools.wraps(func)
+    def wrapper(*args, spool_max_bytes=0, spool_dir=None, **kwargs):
+        SPOOL.configure(max_bytes=spool_max_bytes, base_dir=spool_dir)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            SPOOL.cleanup()
+    return wrapper
@@ -0,0 +1,171 @@
+"""Writing of de-identified archives: members left unchanged by de-identification are copied compressed, as they are in
+the original archive, and the others are written with the configured compression (optionally deflated in parallel).
+"""
+import collections
+import concurrent.futures
+import copy
+import os
+import struct
+import zipfile
+import zlib
+
+# the output compressions of recreated archives
+COMPRESSION_TYPES = {'stored': zipfile.ZIP_STORED, 'deflate': zipfile.ZIP_DEFLATED}
+DEFAULT_COMPRESSION = 'stored'
+
+# general purpose flag bit set when the sizes and CRC follow the member data rather than being in its local header
+_DATA_DESCRIPTOR_FLAG = 0x08
+# header id of the zip64 extra field, which zipfile adds again as needed
+_ZIP64_EXTRA_ID = 0x0001
+_COPY_BUFFER_SIZE = 2 ** 20
+
+
+def validate_compression(compression, compresslevel=None):
+    """Raises ValueError if compression is not one of COMPRESSION_TYPES or compresslevel is not a valid level for it"""
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError(f'Unknown compression {compression}. Must be one of {list(COMPRESSION_TYPES.keys())}')
+    if compresslevel is not None and compression == 'deflate' and not 0 <= compresslevel <= 9:
+        raise ValueError(f'deflate compresslevel must be between 0 and 9, got {compresslevel}')
+
+
+def open_output_zip(path, compression=DEFAULT_COMPRESSION, compresslevel=None):
+    """Returns a zipfile.ZipFile open for writing to path with the compression of COMPRESSION_TYPES named compression"""
+    validate_compression(compression, compresslevel)
+    return zipfile.ZipFile(path, 'w', compression=COMPRESSION_TYPES[compression], compresslevel=compresslevel)
+
+
+def get_file_crc(file_path):
+    """Returns the CRC-32 of the file at file_path, as stored in zip headers"""
+    crc = 0
+    with open(file_path, 'rb') as f_data:
+        for chunk in iter(lambda: f_data.read(_COPY_BUFFER_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_member_unchanged(file_path, zip_item):
+    """Returns True if the file at file_path has the size and CRC-32 of the archive member zip_item"""
+    try:
+        if zip_item.is_dir() or os.path.getsize(file_path) != zip_item.file_size:
+            return False
+    except OSError:
+        return False
+    return get_file_crc(file_path) == zip_item.CRC
+
+
+def _write_raw_member(zout, zinfo, chunks):
+    # mirrors the bookkeeping of zipfile.ZipFile.open(mode='w'), with the sizes and CRC known up front
+    with zout._lock:
+        if zout._writing:
+            raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+        if zout._seekable:
+            zout.fp.seek(zout.start_dir)
+        zinfo.header_offset = zout.fp.tell()
+        zout._writecheck(zinfo)
+        zout._didModify = True
+        zout.fp.write(zinfo.FileHeader())
+        for chunk in chunks:
+            zout.fp.write(chunk)
+        zout.filelist.append(zinfo)
+        zout.NameToInfo[zinfo.filename] = zinfo
+        zout.start_dir = zout.fp.tell()
+
+
+def _iter_member_data(zin, zip_item):
+    with zin._lock:
+        zin.fp.seek(zip_item.header_offset)
+        file_header = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    data_offset = (zip_item.header_offset + zipfile.sizeFileHeader + file_header[zipfile._FH_FILENAME_LENGTH] +
+                   file_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+    remaining = zip_item.compress_size
+    while remaining:
+        with zin._lock:
+            zin.fp.seek(data_offset)
+            chunk = zin.fp.read(min(remaining, _COPY_BUFFER_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile(f'Truncated data for member {zip_item.filename}')
+        data_offset += len(chunk)
+        remaining -= len(chunk)
+        yield chunk
+
+
+def copy_member(zin, zout, zip_item):
+    """
+    Copies the member zip_item of zin to zout without decompressing it, keeping its compression, CRC and timestamp
+    Args:
+        zin (zipfile.ZipFile): the archive open for reading
+        zout (zipfile.ZipFile): the archive open for writing
+        zip_item (zipfile.ZipInfo): the member of zin to copy
+    """
+    zinfo = copy.copy(zip_item)
+    zinfo.flag_bits &= ~_DATA_DESCRIPTOR_FLAG
+    zinfo.extra = zipfile._strip_extra(zinfo.extra, (_ZIP64_EXTRA_ID,))
+    _write_raw_member(zout, zinfo, _iter_member_data(zin, zip_item))
+
+
+def _deflate_file(file_path, arcname, compresslevel):
+    zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel,
+                                  zlib.DEFLATED, -15)
+    chunks = list()
+    crc = 0
+    with open(file_path, 'rb') as f_data:
+        for chunk in iter(lambda: f_data.read(_COPY_BUFFER_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    zinfo.CRC = crc
+    zinfo.file_size = os.path.getsize(file_path)
+    zinfo.compress_size = sum(len(chunk) for chunk in chunks)
+    return zinfo, chunks
+
+
+def write_members(zin, zout, members, compression_workers=1):
+    """
+    Writes members to zout in order. A member without a file is copied from zin without decompressing it, the others
+        are written from their file with the compression of zout. When zout deflates and compression_workers > 1,
+        files are deflated by that many threads (zlib releases the GIL) and up to twice as many compressed files are
+        held in memory while they wait for their turn to be written.
+    Args:
+        zin (zipfile.ZipFile): the original archive
+        zout (zipfile.ZipFile): the archive being written, as returned by open_output_zip
+        members (iterable): (zipfile.ZipInfo, str) tuples of each member of zin and the path of the file with which to
+            replace it, or None to copy it
+        compression_workers (int): the number of threads that deflate files
+    """
+    parallel = compression_workers > 1 and zout.compression == zipfile.ZIP_DEFLATED
+    if not parallel:
+        for zip_item, file_path in members:
+            if file_path is None:
+                copy_member(zin, zout, zip_item)
+            else:
+                zout.write(file_path, zip_item.filename)
+        return
+
+    pending = collections.deque()
+
+    def _write_next():
+        zip_item, future = pending.popleft()
+        if future is None:
+            copy_member(zin, zout, zip_item)
+        else:
+            _write_raw_member(zout, *future.result())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=compression_workers,
+                                               thread_name_prefix='zip_deflate') as executor:
+        try:
+            for zip_item, file_path in members:
+                if file_path is None or zip_item.is_dir():
+                    future = None
+                else:
+                    future = executor.submit(_deflate_file, file_path, zip_item.filename, zout.compresslevel)
+                pending.append((zip_item, future))
+                while len(pending) > 2 * compression_workers:
+                    _write_next()
+            while pending:
+                _write_next()
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
@@ -1,8 +1,11 @@
 import logging
 import os
+import shutil
 
 import flywheel
 from deid_export import container_export
+from deid_export.sharding import get_shard_path
+from deid_export.spool import exit_on_sigterm
 
 log = logging.getLogger(__name__)
 log.setLevel('INFO')
@@ -67,7 +70,17 @@ def parse_args_from_context(gear_context):
         return None
 
     template_path = gear_context.get_input('deid_template')['location']['path']
-    csv_output_path = os.path.join(gear_context.output_dir, f'{origin.id}_export.csv')
+    shard_index = gear_context.config.get('shard_index', 0)
+    shard_count = gear_context.config.get('shard_count', 1)
+    # each shard's outputs are named for the shard so that the outputs of a project's shards can be merged
+    csv_output_path = get_shard_path(os.path.join(gear_context.output_dir, f'{origin.id}_export.csv'), shard_index,
+                                     shard_count)
+    journal_path = get_shard_path(os.path.join(gear_context.output_dir, f'{origin.id}_export_journal.sqlite'),
+                                  shard_index, shard_count)
+    plan_output_path = get_shard_path(os.path.join(gear_context.output_dir, f'{origin.id}_export_plan.csv'),
+                                      shard_index, shard_count)
+    throughput_history_path = get_shard_path(
+        os.path.join(gear_context.output_dir, f'{origin.id}_export_throughput.json'), shard_index, shard_count)
     overwrite_files = gear_context.config.get('overwrite_files')
 
     export_container_args = {
@@ -77,7 +90,25 @@ def parse_args_from_context(gear_context):
         'template_path': template_path,
         'csv_output_path': csv_output_path,
         'overwrite': overwrite_files,
-        'subject_csv_path': None
+        'subject_csv_path': None,
+        'max_workers': gear_context.config.get('max_workers', 1),
+        'backend': gear_context.config.get('worker_backend', 'thread'),
+        'max_upload_workers': gear_context.config.get('max_upload_workers', 1),
+        'pipeline_depth': gear_context.config.get('pipeline_depth', 0),
+        'max_api_concurrency': gear_context.config.get('max_api_concurrency', 32),
+        'delta': gear_context.config.get('delta_export', False),
+        'journal_path': journal_path,
+        'resume': False,
+        'plan': gear_context.config.get('plan_only', False),
+        'plan_output_path': plan_output_path,
+        'throughput_history_path': throughput_history_path,
+        'profile': gear_context.config.get('profile_mode', 'none'),
+        'profile_top_n': gear_context.config.get('profile_top_n', 10),
+        'profile_output_dir': gear_context.output_dir,
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'spool_max_bytes': gear_context.config.get('spool_max_mb', 0) * 2 ** 20,
+        'in_memory_max_bytes': gear_context.config.get('in_memory_max_kb', 0) * 2 ** 10
     }
 
     # Check for subject_csv
@@ -85,6 +116,20 @@ def parse_args_from_context(gear_context):
         subject_csv_path = gear_context.get_input('subject_csv')['location']['path']
         if os.path.exists(subject_csv_path):
             export_container_args['subject_csv_path'] = subject_csv_path
+
+    # Resume from the journal of a previous run, which is copied so that this run's journal output includes it
+    if gear_context.get_input('export_journal'):
+        previous_journal_path = gear_context.get_input('export_journal')['location']['path']
+        if os.path.exists(previous_journal_path):
+            shutil.copyfile(previous_journal_path, journal_path)
+            export_container_args['resume'] = True
+
+    # The throughput history of previous runs is copied so that plans can estimate the export duration from it and
+    # exports append their throughput to this run's history output
+    if gear_context.get_input('throughput_history'):
+        previous_history_path = gear_context.get_input('throughput_history')['location']['path']
+        if os.path.exists(previous_history_path):
+            shutil.copyfile(previous_history_path, throughput_history_path)
     return export_container_args
 
 
@@ -95,6 +140,9 @@ def main(gear_context):
         return 1
     else:
         error_count = container_export.export_container(**export_args)
+        if export_args.get('plan'):
+            # collisions in the plan are reported in the plan csv rather than failing the job
+            return 0 if os.path.isfile(export_args.get('plan_output_path')) else 1
         if os.path.isfile(export_args.get('csv_output_path')) and error_count == 0:
             return 0
         else:
@@ -102,6 +150,8 @@ def main(gear_context):
 
 
 if __name__ == '__main__':
+    # a cancelled job is sent SIGTERM, which should still remove the local copies of files
+    exit_on_sigterm()
     with flywheel.GearContext() as gear_context:
         exit_status = main(gear_context)
     log.info(f'exit_status is {exit_status}')
@@ -121,7 +121,13 @@ def main(gear_context):
     deid_filepath = deid_file.deidentify_path(
         input_file_path=file_path,
         profile_path=profile_path,
-        output_directory=gear_context.output_dir
+        output_directory=gear_context.output_dir,
+        streaming=gear_context.config.get('streaming', False),
+        max_batch_bytes=gear_context.config.get('max_batch_mb', deid_file.DEFAULT_BATCH_BYTES // 2 ** 20) * 2 ** 20,
+        n_jobs=gear_context.config.get('n_jobs', 1),
+        compression=gear_context.config.get('zip_compression', deid_file.DEFAULT_COMPRESSION),
+        compresslevel=gear_context.config.get('zip_compresslevel'),
+        compression_workers=gear_context.config.get('zip_compression_workers', 1)
     )
     if deid_filepath:
         write_deid_file_metadata(gear_context, 'input_file', deid_filepath)
@@ -0,0 +1,177 @@
+"""Benchmarks the de-identification paths of deid_export.deid_file on a generated corpus.
+
+Each path is run on the files of the corpus that it handles and its MB/s and files/s are reported (for series zips,
+files are the DICOM members of the archives). For example:
+
+    python tests/benchmarks/bench_deid.py --preset medium --repeat 3
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from corpus import CORPUS_PRESETS, generate_corpus  # noqa: E402
+from deid_export import deid_template  # noqa: E402
+from deid_export.deid_file import deid_archive, deidentify_file, deidentify_files, deidentify_path  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data',
+                                    'example-3-deid-profile.yaml')
+
+
+def _count_members(paths):
+    member_count = 0
+    for path in paths:
+        with zipfile.ZipFile(path) as zipf:
+            member_count += sum(1 for info in zipf.infolist() if not info.is_dir())
+    return member_count
+
+
+def time_deid_path(name, func, paths, file_count=None, repeat=1):
+    """
+    Times func, which de-identifies paths into the output directory it is passed, keeping the fastest of repeat runs
+    Args:
+        name (str): the name of the benchmark
+        func (callable): func(output_dir) de-identifies paths to output_dir
+        paths (list): the input paths, whose total size is the number of bytes processed
+        file_count (int): the number of files processed, len(paths) if not provided
+        repeat (int): the number of runs
+
+    Returns:
+        dict: the benchmark result
+    """
+    byte_count = sum(os.path.getsize(path) for path in paths)
+    file_count = len(paths) if file_count is None else file_count
+    seconds = None
+    for _ in range(repeat):
+        output_dir = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            func(output_dir)
+            run_seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        seconds = run_seconds if seconds is None else min(seconds, run_seconds)
+    return {
+        'benchmark': name,
+        'files': file_count,
+        'bytes': byte_count,
+        'seconds': round(seconds, 4),
+        'mb_per_sec': round(byte_count / 2 ** 20 / seconds, 2) if seconds else None,
+        'files_per_sec': round(file_count / seconds, 2) if seconds else None,
+    }
+
+
+def run_deid_benchmarks(corpus, profile_path=DEFAULT_PROFILE_PATH, repeat=1, n_jobs=2):
+    """
+    Benchmarks each de-identification path on the files of corpus
+    Args:
+        corpus (dict): the paths of each kind of file, as returned by corpus.generate_corpus
+        profile_path (str): the de-identification template to apply
+        repeat (int): the number of runs of each benchmark, of which the fastest is reported
+        n_jobs (int): the number of processes of the parallel archive benchmark, which is skipped if 1, and of
+            threads of the deflate archive benchmark
+
+    Returns:
+        list: list of benchmark result dictionaries
+    """
+    with open(profile_path, 'r') as f_data:
+        template_dict = deid_template.update_deid_profile(yaml.safe_load(f_data), dict())
+    deid_profile, _ = deid_template.load_deid_profile(template_dict)
+    results = list()
+
+    # the path used by FileExporter, one DeIdProfile.process_file call per file
+    for kind, paths in corpus.items():
+        if not paths:
+            continue
+
+        def _deidentify_each(output_dir, paths=paths):
+            for path in paths:
+                deidentify_file(deid_profile, path, output_dir)
+
+        file_count = _count_members(paths) if kind == 'zip' else None
+        results.append(time_deid_path(f'deidentify_file/{kind}', _deidentify_each, paths, file_count=file_count,
+                                      repeat=repeat))
+
+    dicom_paths = corpus.get('dicom') or list()
+    if dicom_paths:
+        def _deidentify_path_each(output_dir):
+            for path in dicom_paths:
+                deidentify_path(path, profile_path, output_directory=output_dir)
+
+        results.append(time_deid_path('deidentify_path/dicom', _deidentify_path_each, dicom_paths, repeat=repeat))
+
+        dicom_dir = os.path.dirname(dicom_paths[0])
+        results.append(time_deid_path(
+            'deidentify_files/dicom',
+            lambda output_dir: deidentify_files(profile_path, dicom_dir, output_directory=output_dir),
+            dicom_paths, repeat=repeat
+        ))
+
+    for zip_path in corpus.get('zip') or list():
+        member_count = _count_members([zip_path])
+        results.append(time_deid_path(
+            f'deid_archive/{member_count}_members',
+            lambda output_dir, zip_path=zip_path: deid_archive(zip_path, profile_path, output_directory=output_dir),
+            [zip_path], file_count=member_count, repeat=repeat
+        ))
+        results.append(time_deid_path(
+            f'deid_archive_streaming/{member_count}_members',
+            lambda output_dir, zip_path=zip_path: deid_archive(zip_path, profile_path, output_directory=output_dir,
+                                                               streaming=True),
+            [zip_path], file_count=member_count, repeat=repeat
+        ))
+        results.append(time_deid_path(
+            f'deid_archive/{member_count}_members/deflate_{n_jobs}_threads',
+            lambda output_dir, zip_path=zip_path: deid_archive(zip_path, profile_path, output_directory=output_dir,
+                                                               compression='deflate', compression_workers=n_jobs),
+            [zip_path], file_count=member_count, repeat=repeat
+        ))
+        if n_jobs > 1:
+            results.append(time_deid_path(
+                f'deid_archive/{member_count}_members/{n_jobs}_jobs',
+                lambda output_dir, zip_path=zip_path: deid_archive(zip_path, profile_path, output_directory=output_dir,
+                                                                   n_jobs=n_jobs),
+                [zip_path], file_count=member_count, repeat=repeat
+            ))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=list(CORPUS_PRESETS.keys()), default='small')
+    parser.add_argument('--corpus_dir', help='directory of the corpus, generated in a temporary directory if not '
+                                             'provided and reused if it already exists')
+    parser.add_argument('--profile_path', default=DEFAULT_PROFILE_PATH, help='de-identification template to apply')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each benchmark, the fastest is kept')
+    parser.add_argument('--n_jobs', type=int, default=2, help='number of processes of the parallel archive benchmark')
+    parser.add_argument('--output', help='path of a json file to which to write the results')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus_dir = args.corpus_dir or temp_dir
+        corpus = generate_corpus(corpus_dir, seed=args.seed, **CORPUS_PRESETS[args.preset])
+        results = run_deid_benchmarks(corpus, profile_path=args.profile_path, repeat=args.repeat, n_jobs=args.n_jobs)
+    for result in results:
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as f_data:
+            json.dump(results, f_data, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
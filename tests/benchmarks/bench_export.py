@@ -0,0 +1,158 @@
+"""Benchmarks export_container against FakeFlywheelClient.
+
+Synthetic projects of different shapes are exported and the files/sec, API calls per file and peak RSS of each run
+are reported. For example:
+
+    python tests/benchmarks/bench_export.py --shape many_files --latency 0.02 --max_workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from fake_flywheel import FakeFlywheelClient, build_project  # noqa: E402
+from deid_export.container_export import export_container  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+# project shapes, as keyword arguments for build_project
+SHAPES = {
+    'many_subjects': {'subjects': 100, 'sessions_per_subject': 1, 'acquisitions_per_session': 1,
+                      'files_per_acquisition': 2},
+    'many_files': {'subjects': 2, 'sessions_per_subject': 1, 'acquisitions_per_session': 2,
+                   'files_per_acquisition': 100},
+    'deep': {'subjects': 10, 'sessions_per_subject': 4, 'acquisitions_per_session': 4, 'files_per_acquisition': 2},
+    'tiny': {'subjects': 2, 'sessions_per_subject': 1, 'acquisitions_per_session': 1, 'files_per_acquisition': 2},
+}
+
+TEMPLATE = '''dicom:
+  filenames:
+    - output: '{SOPInstanceUID}.dcm'
+      input-regex: '.*.dcm'
+  fields:
+    - name: PatientID
+      replace-with: 'FLYWHEEL'
+    - name: PatientName
+      remove: true
+'''
+
+
+def get_peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak_rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_export_benchmark(shape='tiny', latency=0.0, latency_jitter=0.0, error_rate=0.0, error_operations=None,
+                         pixel_bytes=128, work_dir=None, **export_kwargs):
+    """
+    Builds a synthetic project of shape on a FakeFlywheelClient and exports it to a new project
+    Args:
+        shape (str or dict): a key of SHAPES or keyword arguments for build_project
+        latency (float): the number of seconds each request takes
+        latency_jitter (float): a random number of seconds up to which is added to each request
+        error_rate (float): the fraction of requests that fail with a 503
+        error_operations (set): the fake client operations into which errors are injected, all if None
+        pixel_bytes (int): the approximate size of each file's pixel data
+        work_dir (str): the directory for the template and status csv, a temporary directory if not provided
+        **export_kwargs: additional keyword arguments for export_container (e.g. max_workers, max_upload_workers)
+
+    Returns:
+        dict: the benchmark results
+    """
+    shape_kwargs = SHAPES[shape] if isinstance(shape, str) else shape
+    client = FakeFlywheelClient(latency=latency, latency_jitter=latency_jitter, error_rate=error_rate,
+                                error_operations=error_operations)
+    origin_id = build_project(client, label='origin', pixel_bytes=pixel_bytes, **shape_kwargs)
+    dest_id = client.create_container('project', client.find('project', f'_id={origin_id}')[0].parents.group,
+                                      label='destination')
+    # requests made to set up the site are not part of the benchmark
+    calls_before = client.api_client.calls
+    errors_before = client.api_client.errors
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = work_dir or temp_dir
+        template_path = os.path.join(work_dir, 'deid_template.yaml')
+        with open(template_path, 'w') as f_data:
+            f_data.write(TEMPLATE)
+        csv_output_path = os.path.join(work_dir, 'export.csv')
+        if os.path.exists(csv_output_path):
+            os.remove(csv_output_path)
+        start = time.monotonic()
+        failure = None
+        try:
+            error_count = export_container(client, origin_id, dest_id, template_path,
+                                           csv_output_path=csv_output_path, **export_kwargs)
+        except Exception as e:
+            # e.g. an injected error in a request that the exporter does not retry
+            log.error(f'Export failed: {e}', exc_info=True)
+            error_count = None
+            failure = str(e)
+        seconds = time.monotonic() - start
+        status_df = pd.read_csv(csv_output_path) if os.path.exists(csv_output_path) else pd.DataFrame()
+
+    file_count = len(status_df)
+    api_calls = client.api_client.calls - calls_before
+    return {
+        'shape': shape if isinstance(shape, str) else 'custom',
+        'files': file_count,
+        'exported': int((status_df['state'] == 'exported').sum()) if file_count else 0,
+        'errors': int(error_count) if error_count is not None else None,
+        'failure': failure,
+        'seconds': round(seconds, 3),
+        'files_per_sec': round(file_count / seconds, 2) if seconds else None,
+        'api_calls': api_calls,
+        'api_calls_per_file': round(api_calls / file_count, 2) if file_count else None,
+        'injected_errors': client.api_client.errors - errors_before,
+        'max_requests_in_flight': client.api_client.max_in_flight,
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', choices=list(SHAPES.keys()), action='append',
+                        help='project shape to benchmark, may be repeated (default: all but tiny)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--latency_jitter', type=float, default=0.0, help='random seconds added per request')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests that fail with 503')
+    parser.add_argument('--error_operation', action='append', dest='error_operations',
+                        help='fake client operation into which to inject errors (e.g. upload_file), may be repeated '
+                             '(default: all)')
+    parser.add_argument('--pixel_bytes', type=int, default=128, help='approximate pixel data size of each file')
+    parser.add_argument('--max_workers', type=int, default=1)
+    parser.add_argument('--max_upload_workers', type=int, default=1)
+    parser.add_argument('--pipeline_depth', type=int, default=0)
+    parser.add_argument('--max_api_concurrency', type=int, default=32)
+    parser.add_argument('--output', help='path of a json file to which to write the results')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = list()
+    for shape in args.shape or [shape for shape in SHAPES if shape != 'tiny']:
+        result = run_export_benchmark(shape=shape, latency=args.latency, latency_jitter=args.latency_jitter,
+                                      error_rate=args.error_rate, error_operations=args.error_operations,
+                                      pixel_bytes=args.pixel_bytes,
+                                      max_workers=args.max_workers, max_upload_workers=args.max_upload_workers,
+                                      pipeline_depth=args.pipeline_depth,
+                                      max_api_concurrency=args.max_api_concurrency)
+        results.append(result)
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as f_data:
+            json.dump(results, f_data, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
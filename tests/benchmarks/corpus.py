@@ -0,0 +1,255 @@
+"""Generates reproducible corpora of synthetic files for de-identification benchmarks.
+
+A corpus contains single DICOM files, DICOM series zips and jpg/png/tiff/xml files with the fields that
+tests/data/example-3-deid-profile.yaml de-identifies. The same seed always produces the same bytes. For example:
+
+    python tests/benchmarks/corpus.py /tmp/corpus --preset medium
+"""
+import argparse
+import inspect
+import io
+import json
+import os
+import random
+import zipfile
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+try:
+    from pydicom.dataset import FileMetaDataset
+except ImportError:
+    # pydicom 1.x (as pinned in Pipfile.lock) holds the file meta information in a plain Dataset
+    FileMetaDataset = Dataset
+
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+# corpus sizes, as keyword arguments for generate_corpus
+CORPUS_PRESETS = {
+    'tiny': {'dicom_files': 2, 'series_sizes': (10,), 'other_files': 1, 'pixel_bytes': 512,
+             'series_pixel_bytes': 512, 'image_size': 32},
+    'small': {'dicom_files': 20, 'series_sizes': (10, 100), 'other_files': 5, 'pixel_bytes': 8192,
+              'series_pixel_bytes': 2048, 'image_size': 128},
+    'medium': {'dicom_files': 100, 'series_sizes': (10, 100, 1000), 'other_files': 20, 'pixel_bytes': 131072,
+               'series_pixel_bytes': 8192, 'image_size': 512},
+    'large': {'dicom_files': 200, 'series_sizes': (100, 1000, 5000), 'other_files': 50, 'pixel_bytes': 524288,
+              'series_pixel_bytes': 32768, 'image_size': 1024},
+}
+
+# EXIF tags de-identified by the example-3 jpg profile
+EXIF_DATETIME = 0x0132
+EXIF_ARTIST = 0x013B
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_DATETIME_DIGITIZED = 0x9004
+EXIF_CAMERA_OWNER_NAME = 0xA430
+# TIFF tags de-identified by the example-3 tiff profile
+TIFF_MODEL = 272
+TIFF_SOFTWARE = 305
+TIFF_DATETIME = 306
+
+XML_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Patient>
+  <Patient_Name>{name}</Patient_Name>
+  <Patient_Date_Of_Birth>1970-01-01</Patient_Date_Of_Birth>
+  <SUBJECT_ID>{subject_id}</SUBJECT_ID>
+  <Visit>
+    <Scan>
+      <ScanTime>2020-01-01 08:30:00</ScanTime>
+      <Notes>{notes}</Notes>
+    </Scan>
+  </Visit>
+</Patient>
+'''
+
+
+def _get_pixel_bytes(rng, byte_count):
+    # random pixels do not compress, so the size of zips and images tracks pixel_bytes
+    if byte_count <= 0:
+        return b''
+    return rng.getrandbits(8 * byte_count).to_bytes(byte_count, 'little')
+
+
+def _dicom_to_bytes(dataset):
+    buffer = io.BytesIO()
+    if 'enforce_file_format' in inspect.signature(pydicom.dcmwrite).parameters:
+        pydicom.dcmwrite(buffer, dataset, enforce_file_format=True)
+    else:
+        # pydicom < 3 writes the transfer syntax given by the dataset's encoding attributes
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        pydicom.dcmwrite(buffer, dataset, write_like_original=False)
+    return buffer.getvalue()
+
+
+def make_dicom_bytes(patient_id, series_number=1, instance_number=1, pixel_bytes=128, seed=None,
+                     series_instance_uid=None):
+    """
+    Returns the bytes of a synthetic MR DICOM file
+    Args:
+        patient_id (str): the PatientID (and PatientName) of the file
+        series_number (int): the SeriesNumber of the file
+        instance_number (int): the InstanceNumber of the file
+        pixel_bytes (int): the approximate size of the pixel data
+        seed (str): if provided, UIDs and pixel data are derived from seed so that the file is reproducible
+        series_instance_uid (str): the SeriesInstanceUID, shared by the members of a series
+
+    Returns:
+        bytes: the DICOM file
+    """
+    rng = random.Random(seed)
+    sop_instance_uid = generate_uid(entropy_srcs=[str(seed)]) if seed is not None else generate_uid()
+    rows = max(1, int((pixel_bytes / 2) ** 0.5))
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = file_meta
+    dataset.SOPClassUID = MR_IMAGE_STORAGE
+    dataset.SOPInstanceUID = sop_instance_uid
+    dataset.SeriesInstanceUID = series_instance_uid or generate_uid(entropy_srcs=[f'{seed}/series'])
+    dataset.PatientID = patient_id
+    dataset.PatientName = patient_id
+    dataset.PatientBirthDate = '19700101'
+    dataset.StudyDate = '20200101'
+    dataset.Modality = 'MR'
+    dataset.SeriesDescription = 'localizer'
+    dataset.SeriesNumber = series_number
+    dataset.InstanceNumber = instance_number
+    dataset.Rows = rows
+    dataset.Columns = rows
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.SamplesPerPixel = 1
+    dataset.PixelRepresentation = 0
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelData = _get_pixel_bytes(rng, rows * rows * 2)
+    return _dicom_to_bytes(dataset)
+
+
+def make_series_zip_bytes(patient_id, member_count, pixel_bytes=128, seed=None):
+    """Returns the bytes of a zip of member_count DICOM files of one series"""
+    series_instance_uid = generate_uid(entropy_srcs=[f'{seed}/series'])
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for index in range(member_count):
+            member = make_dicom_bytes(patient_id, instance_number=index + 1, pixel_bytes=pixel_bytes,
+                                      seed=f'{seed}/{index}', series_instance_uid=series_instance_uid)
+            # fixed timestamps keep the archive reproducible
+            zipf.writestr(zipfile.ZipInfo(f'series/{index:05d}.dcm', date_time=(2020, 1, 1, 0, 0, 0)), member)
+    return buffer.getvalue()
+
+
+def _make_image(rng, image_size):
+    return Image.frombytes('RGB', (image_size, image_size), _get_pixel_bytes(rng, image_size * image_size * 3))
+
+
+def make_jpg_bytes(image_size=32, seed=None):
+    """Returns the bytes of a jpg with the EXIF fields de-identified by the example-3 profile"""
+    rng = random.Random(seed)
+    exif = Image.Exif()
+    exif[EXIF_DATETIME] = '2020:01:01 08:30:00'
+    exif[EXIF_ARTIST] = 'Jane Doe'
+    # Pillow < 8.2 (e.g. the version pinned in Pipfile.lock) cannot write the EXIF sub-IFD
+    if hasattr(exif, 'get_ifd'):
+        exif_ifd = exif.get_ifd(EXIF_IFD)
+        exif_ifd[EXIF_DATETIME_ORIGINAL] = '2020:01:01 08:30:00'
+        exif_ifd[EXIF_DATETIME_DIGITIZED] = '2020:01:01 08:30:00'
+        exif_ifd[EXIF_CAMERA_OWNER_NAME] = 'Jane Doe'
+    buffer = io.BytesIO()
+    _make_image(rng, image_size).save(buffer, format='JPEG', exif=exif.tobytes(), quality=90)
+    return buffer.getvalue()
+
+
+def make_png_bytes(image_size=32, seed=None):
+    """Returns the bytes of a png with the tEXt chunk removed by the example-3 profile"""
+    rng = random.Random(seed)
+    png_info = PngInfo()
+    png_info.add_text('Author', 'Jane Doe')
+    buffer = io.BytesIO()
+    _make_image(rng, image_size).save(buffer, format='PNG', pnginfo=png_info, compress_level=1)
+    return buffer.getvalue()
+
+
+def make_tiff_bytes(image_size=32, seed=None):
+    """Returns the bytes of a tiff with the tags de-identified by the example-3 profile"""
+    rng = random.Random(seed)
+    tiff_info = {TIFF_DATETIME: '2020:01:01 08:30:00', TIFF_SOFTWARE: 'scanner 1.0', TIFF_MODEL: 'model 1'}
+    buffer = io.BytesIO()
+    _make_image(rng, image_size).save(buffer, format='TIFF', tiffinfo=tiff_info)
+    return buffer.getvalue()
+
+
+def make_xml_bytes(seed=None, notes_bytes=64):
+    """Returns the bytes of an xml file with the elements de-identified by the example-3 profile"""
+    rng = random.Random(seed)
+    notes = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(notes_bytes))
+    return XML_TEMPLATE.format(name='Jane Doe', subject_id=f'subject-{rng.randrange(10 ** 6):06d}',
+                               notes=notes).encode()
+
+
+def _write(path, content):
+    with open(path, 'wb') as f_data:
+        f_data.write(content)
+    return path
+
+
+def generate_corpus(output_dir, dicom_files=2, series_sizes=(10,), other_files=1, pixel_bytes=512,
+                    series_pixel_bytes=512, image_size=32, seed=0):
+    """
+    Writes a corpus of synthetic files to output_dir
+    Args:
+        output_dir (str): the directory to which to write the corpus, created if it does not exist
+        dicom_files (int): the number of single DICOM files, written to output_dir/dicom
+        series_sizes (tuple): the number of members of each DICOM series zip, written to output_dir/zip
+        other_files (int): the number of each of jpg, png, tiff and xml files, written to output_dir/<type>
+        pixel_bytes (int): the approximate size of the pixel data of each single DICOM file
+        series_pixel_bytes (int): the approximate size of the pixel data of each DICOM file in a series zip
+        image_size (int): the width and height of each image
+        seed (int): the seed from which every file is derived
+
+    Returns:
+        dict: the lists of paths of each kind of file, keyed by dicom, zip, jpg, png, tiff and xml
+    """
+    corpus = {kind: list() for kind in ('dicom', 'zip', 'jpg', 'png', 'tiff', 'xml')}
+    for kind in corpus:
+        os.makedirs(os.path.join(output_dir, kind), exist_ok=True)
+
+    for index in range(dicom_files):
+        content = make_dicom_bytes(f'patient-{index:05d}', pixel_bytes=pixel_bytes, seed=f'{seed}/dicom/{index}')
+        corpus['dicom'].append(_write(os.path.join(output_dir, 'dicom', f'image-{index:05d}.dcm'), content))
+    for index, member_count in enumerate(series_sizes):
+        content = make_series_zip_bytes(f'patient-{index:05d}', member_count, pixel_bytes=series_pixel_bytes,
+                                        seed=f'{seed}/zip/{index}')
+        corpus['zip'].append(_write(os.path.join(output_dir, 'zip', f'series-{member_count:05d}.dcm.zip'), content))
+    for index in range(other_files):
+        file_seed = f'{seed}/{index}'
+        corpus['jpg'].append(_write(os.path.join(output_dir, 'jpg', f'photo-{index:05d}.jpg'),
+                                    make_jpg_bytes(image_size, seed=f'{file_seed}/jpg')))
+        corpus['png'].append(_write(os.path.join(output_dir, 'png', f'image-{index:05d}.png'),
+                                    make_png_bytes(image_size, seed=f'{file_seed}/png')))
+        corpus['tiff'].append(_write(os.path.join(output_dir, 'tiff', f'scan-{index:05d}.tiff'),
+                                     make_tiff_bytes(image_size, seed=f'{file_seed}/tiff')))
+        corpus['xml'].append(_write(os.path.join(output_dir, 'xml', f'record-{index:05d}.xml'),
+                                    make_xml_bytes(seed=f'{file_seed}/xml')))
+    return corpus
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output_dir', help='directory to which to write the corpus')
+    parser.add_argument('--preset', choices=list(CORPUS_PRESETS.keys()), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    corpus = generate_corpus(args.output_dir, seed=args.seed, **CORPUS_PRESETS[args.preset])
+    print(json.dumps({kind: len(paths) for kind, paths in corpus.items()}))
+    return corpus
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+"""An in-memory stand-in for the subset of the Flywheel SDK used by the exporter, for benchmarks and end-to-end tests.
+
+Every request goes through FakeFlywheelClient.api_client.call_api, as in the SDK, so that the adaptive concurrency
+limiter can be installed on the fake client. Requests can be given a latency and a rate of injected errors.
+"""
+import copy
+import datetime
+import hashlib
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+import flywheel
+
+CHILD_TYPES = {'group': 'project', 'project': 'subject', 'subject': 'session', 'session': 'acquisition'}
+PARENT_TYPES = {child_type: parent_type for parent_type, child_type in CHILD_TYPES.items()}
+# the container types whose parents are recorded, in hierarchy order
+HIERARCHY = ('group', 'project', 'subject', 'session', 'acquisition')
+# the keyword arguments accepted by the SDK's get_all_* endpoints, which finders pass their keyword arguments to
+FINDER_PARAMS = {'exhaustive', 'filter', 'sort', 'limit', 'skip', 'page', 'after_id'}
+
+
+class FakeObject(dict):
+    """A dictionary with attribute access, like SDK models"""
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+
+class FakeFile(FakeObject):
+
+    def download(self, dest_path):
+        self.__dict__['_client'].download_file(self.__dict__['_parent_id'], self['name'], dest_path)
+
+    def read(self):
+        return self.__dict__['_client'].read_file(self.__dict__['_parent_id'], self['name'])
+
+
+class FakeFinder:
+    """A finder of the child containers of a container or of the whole site (e.g. fw_client.sessions)"""
+    def __init__(self, client, container_type, parent_id=None):
+        self.client = client
+        self.container_type = container_type
+        self.parent_id = parent_id
+
+    def _get_filter(self, filter_str):
+        if self.parent_id is None:
+            return filter_str
+        parent_filter = f'parents.{PARENT_TYPES[self.container_type]}={self.parent_id}'
+        return f'{parent_filter},{filter_str}' if filter_str else parent_filter
+
+    def _find(self, filters, kwargs, limit=None):
+        for key in kwargs:
+            if key not in FINDER_PARAMS:
+                # as raised by the SDK's get_all_* endpoints
+                raise TypeError(f"Got an unexpected keyword argument '{key}' to method get_all_{self.container_type}s")
+        filter_str = ','.join(filters) if filters else kwargs.get('filter')
+        return self.client.find(self.container_type, self._get_filter(filter_str), limit=limit)
+
+    def __call__(self):
+        return self.find()
+
+    def find(self, *filters, **kwargs):
+        return self._find(filters, kwargs, limit=kwargs.get('limit'))
+
+    def iter_find(self, *filters, **kwargs):
+        return iter(self._find(filters, kwargs))
+
+    def find_first(self, *filters, **kwargs):
+        results = self._find(filters, kwargs, limit=1)
+        return results[0] if results else None
+
+
+class FakeContainer(FakeObject):
+    """A container returned by FakeFlywheelClient, with the SDK's container methods"""
+    @property
+    def _client(self):
+        return self.__dict__['_client']
+
+    def reload(self):
+        return self._client.get(self['id'])
+
+    def get_file(self, name):
+        return next((file_obj for file_obj in self.get('files') or list() if file_obj.name == name), None)
+
+    def update(self, *args, **kwargs):
+        # the SDK's update modifies the container on the site rather than this copy
+        update_dict = dict(*args, **kwargs)
+        self._client.update_container(self['id'], update_dict)
+
+    def _add_child(self, child_type, **kwargs):
+        return self._client.add_container(child_type, self['id'], **kwargs)
+
+    def add_subject(self, **kwargs):
+        return self._add_child('subject', **kwargs)
+
+    def add_session(self, **kwargs):
+        return self._add_child('session', **kwargs)
+
+    def add_acquisition(self, **kwargs):
+        return self._add_child('acquisition', **kwargs)
+
+    def upload_file(self, file_path):
+        return self._client.upload_file(self['id'], file_path)
+
+    def update_file_info(self, name, info):
+        return self._client.update_file(self['id'], name, {'info': info})
+
+    def update_file(self, name, update_dict):
+        return self._client.update_file(self['id'], name, update_dict)
+
+    def delete_file(self, name):
+        return self._client.delete_file(self['id'], name)
+
+    def __getattr__(self, item):
+        if item in ('subjects', 'sessions', 'acquisitions'):
+            return FakeFinder(self._client, item[:-1], parent_id=self['id'])
+        return super().__getattr__(item)
+
+
+class FakeApiClient:
+    """Counts, delays and injects errors into requests made by FakeFlywheelClient"""
+    def __init__(self, latency=0.0, latency_jitter=0.0, error_rate=0.0, error_status=503, error_operations=None,
+                 seed=0):
+        """
+        Args:
+            latency (float): the number of seconds each request takes
+            latency_jitter (float): a random number of seconds up to which is added to the latency of each request
+            error_rate (float): the fraction of requests that raise flywheel.ApiException
+            error_status (int): the status of injected errors
+            error_operations (set): the operations (e.g. 'upload_file', 'get') into which errors are injected, all
+                operations if None
+            seed (int): the seed of the random number generator for jitter and errors
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_operations = error_operations
+        self.calls = 0
+        self.errors = 0
+        self.call_counts = dict()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call_api(self, operation, func, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.call_counts[operation] = self.call_counts.get(operation, 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency + self._random.uniform(0, self.latency_jitter)
+            fail = self._random.random() < self.error_rate and (
+                self.error_operations is None or operation in self.error_operations)
+            if fail:
+                self.errors += 1
+        try:
+            if delay:
+                time.sleep(delay)
+            if fail:
+                raise flywheel.ApiException(status=self.error_status, reason=f'injected error in {operation}')
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def _get_path(record, dotted_key):
+    value = record
+    for key in dotted_key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get('id' if key == '_id' else key)
+    return value
+
+
+def _matches(record, filter_str):
+    for condition in filter(None, (condition.strip() for condition in (filter_str or '').split(','))):
+        key, operator, value = re.match(r'^([^=<>]+)(=|>|<)(.*)$', condition).groups()
+        value = value.strip('"')
+        record_value = _get_path(record, key)
+        if isinstance(record_value, datetime.datetime):
+            record_value = _format_timestamp(record_value)
+        if record_value is None:
+            return False
+        if operator == '=' and str(record_value).strip('"') != value:
+            return False
+        if operator == '>' and not str(record_value) > value:
+            return False
+        if operator == '<' and not str(record_value) < value:
+            return False
+    return True
+
+
+class FakeFlywheelClient:
+    """An in-memory Flywheel site with the client methods used by the exporter"""
+    def __init__(self, **kwargs):
+        """
+        Args:
+            **kwargs: the latency and error injection arguments of FakeApiClient
+        """
+        self.api_client = FakeApiClient(**kwargs)
+        self._records = dict()
+        self._file_contents = dict()
+        self._jobs = dict()
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def _call(self, operation, func, *args, **kwargs):
+        return self.api_client.call_api(operation, func, *args, **kwargs)
+
+    def _new_id(self):
+        return f'{next(self._ids):024x}'
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    # Site setup, not counted as requests
+
+    def create_container(self, container_type, parent_id=None, **kwargs):
+        """Creates a container without making a request, returning its id"""
+        with self._lock:
+            container_id = self._new_id()
+            parents = dict()
+            if parent_id is not None:
+                parent = self._records[parent_id]
+                parents = dict(parent['parents'])
+                parents[parent['container_type']] = parent_id
+            record = {'id': container_id, 'container_type': container_type, 'parents': parents, 'info': dict(),
+                      'files': list(), 'created': self._now(), 'modified': self._now()}
+            if container_type == 'subject' and 'code' in kwargs:
+                kwargs.setdefault('label', kwargs['code'])
+            record.update(copy.deepcopy(kwargs))
+            self._records[container_id] = record
+            return container_id
+
+    def create_file(self, container_id, name, content, file_type=None, info=None):
+        """Adds a file to a container without making a request"""
+        with self._lock:
+            record = self._records[container_id]
+            record['files'] = [file_obj for file_obj in record['files'] if file_obj['name'] != name]
+            file_id = self._new_id()
+            record['files'].append({
+                'id': file_id, 'file_id': file_id, 'name': name, 'type': file_type, 'size': len(content),
+                'hash': hashlib.sha384(content).hexdigest(), 'info': copy.deepcopy(info or dict()),
+                'modified': self._now(), 'created': self._now()
+            })
+            record['modified'] = self._now()
+            self._file_contents[(container_id, name)] = content
+
+    def get_file_content(self, container_id, name):
+        return self._file_contents[(container_id, name)]
+
+    # Container requests
+
+    def _load(self, container_id, include_info=True):
+        with self._lock:
+            record = self._records.get(container_id)
+            if record is None:
+                raise flywheel.ApiException(status=404, reason=f'container {container_id} not found')
+            record = copy.deepcopy(record)
+        files = list()
+        for file_dict in record.pop('files'):
+            file_obj = FakeFile(file_dict)
+            file_obj.__dict__.update(_client=self, _parent_id=container_id)
+            if not include_info:
+                file_obj.pop('info')
+            files.append(file_obj)
+        if not include_info:
+            record.pop('info')
+        container = self._make_container(record, files=files, parents=FakeObject(record['parents']))
+        if record['container_type'] == 'session':
+            # as in the SDK, sessions reference their project by id and include a subject that can be reloaded
+            container['project'] = record['parents']['project']
+            container['subject'] = self._make_container(id=record['parents']['subject'], container_type='subject')
+        return container
+
+    def _make_container(self, *args, **kwargs):
+        container = FakeContainer(*args, **kwargs)
+        container.__dict__['_client'] = self
+        return container
+
+    def get(self, container_id):
+        return self._call('get', self._load, container_id)
+
+    def get_project(self, project_id):
+        return self.get(project_id)
+
+    def get_subject(self, subject_id):
+        return self.get(subject_id)
+
+    def get_session(self, session_id):
+        return self.get(session_id)
+
+    def get_acquisition(self, acquisition_id):
+        return self.get(acquisition_id)
+
+    def _lookup(self, path):
+        if path.startswith('gears/'):
+            return FakeGear(self, path.split('/', 1)[1])
+        labels = path.split('/')
+        container_id = None
+        for container_type, label in zip(HIERARCHY, labels):
+            with self._lock:
+                container_id = next((record_id for record_id, record in self._records.items()
+                                     if record['container_type'] == container_type
+                                     and record.get('label') == label
+                                     and (container_id is None
+                                          or record['parents'].get(PARENT_TYPES[container_type]) == container_id)),
+                                    None)
+            if container_id is None:
+                raise flywheel.ApiException(status=404, reason=f'{path} not found')
+        return self._load(container_id)
+
+    def lookup(self, path):
+        return self._call('lookup', self._lookup, path)
+
+    def _find(self, container_type, filter_str, limit=None):
+        with self._lock:
+            container_ids = [record_id for record_id, record in self._records.items()
+                             if record['container_type'] == container_type and _matches(record, filter_str)]
+        if limit is not None:
+            container_ids = container_ids[:limit]
+        # as in the SDK, finder results do not include info
+        return [self._load(container_id, include_info=False) for container_id in container_ids]
+
+    def find(self, container_type, filter_str=None, limit=None):
+        return self._call(f'find_{container_type}s', self._find, container_type, filter_str, limit=limit)
+
+    @property
+    def subjects(self):
+        return FakeFinder(self, 'subject')
+
+    @property
+    def sessions(self):
+        return FakeFinder(self, 'session')
+
+    @property
+    def acquisitions(self):
+        return FakeFinder(self, 'acquisition')
+
+    def _add_container(self, container_type, parent_id, **kwargs):
+        return self._load(self.create_container(container_type, parent_id, **kwargs))
+
+    def add_container(self, container_type, parent_id, **kwargs):
+        return self._call(f'add_{container_type}', self._add_container, container_type, parent_id, **kwargs)
+
+    def _update_container(self, container_id, update_dict):
+        with self._lock:
+            record = self._records[container_id]
+            for key, value in copy.deepcopy(update_dict).items():
+                if key == 'info':
+                    record['info'].update(value)
+                else:
+                    record[key] = value
+            record['modified'] = self._now()
+
+    def update_container(self, container_id, update_dict):
+        return self._call('update_container', self._update_container, container_id, update_dict)
+
+    # File requests
+
+    def _download_file(self, container_id, name, dest_path):
+        with open(dest_path, 'wb') as f_data:
+            f_data.write(self.get_file_content(container_id, name))
+
+    def download_file(self, container_id, name, dest_path):
+        return self._call('download_file', self._download_file, container_id, name, dest_path)
+
+    def read_file(self, container_id, name):
+        return self._call('read_file', self.get_file_content, container_id, name)
+
+    def _upload_file(self, container_id, file):
+        if isinstance(file, flywheel.FileSpec):
+            self.create_file(container_id, file.name, file.contents)
+            return
+        with open(file, 'rb') as f_data:
+            content = f_data.read()
+        self.create_file(container_id, os.path.basename(file), content)
+
+    def upload_file(self, container_id, file):
+        """Uploads a file, given as a path or a flywheel.FileSpec"""
+        return self._call('upload_file', self._upload_file, container_id, file)
+
+    def _update_file(self, container_id, name, update_dict):
+        with self._lock:
+            record = self._records[container_id]
+            file_dict = next((file_dict for file_dict in record['files'] if file_dict['name'] == name), None)
+            if file_dict is None:
+                raise flywheel.ApiException(status=404, reason=f'file {name} not found')
+            for key, value in copy.deepcopy(update_dict).items():
+                if key == 'info':
+                    file_dict['info'].update(value)
+                else:
+                    file_dict[key] = value
+            file_dict['modified'] = record['modified'] = self._now()
+
+    def update_file(self, container_id, name, update_dict):
+        return self._call('update_file', self._update_file, container_id, name, update_dict)
+
+    def _delete_file(self, container_id, name):
+        with self._lock:
+            record = self._records[container_id]
+            record['files'] = [file_dict for file_dict in record['files'] if file_dict['name'] != name]
+            self._file_contents.pop((container_id, name), None)
+
+    def delete_file(self, container_id, name):
+        return self._call('delete_file', self._delete_file, container_id, name)
+
+    # Job requests, jobs complete as soon as they are submitted
+
+    def _run_job(self, gear_name, **kwargs):
+        job_id = self._new_id()
+        with self._lock:
+            self._jobs[job_id] = {'id': job_id, 'gear_name': gear_name, 'state': 'complete', 'inputs': kwargs}
+        return job_id
+
+    def run_job(self, gear_name, **kwargs):
+        return self._call('run_job', self._run_job, gear_name, **kwargs)
+
+    def get_job_detail(self, job_id):
+        return self._call('get_job_detail', lambda: FakeObject(copy.deepcopy(self._jobs[job_id])))
+
+    def get_job_logs(self, job_id):
+        return self._call('get_job_logs', lambda: FakeObject(logs=[{'msg': 'Job complete.'}]))
+
+    def modify_job(self, job_id, update_dict):
+        def _modify_job():
+            with self._lock:
+                self._jobs[job_id].update(update_dict)
+        return self._call('modify_job', _modify_job)
+
+
+class FakeGear:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def run(self, **kwargs):
+        return self.client.run_job(self.name, **kwargs)
+
+
+def build_project(client, group='benchmark', label='origin', subjects=1, sessions_per_subject=1,
+                  acquisitions_per_session=1, files_per_acquisition=1, pixel_bytes=128):
+    """
+    Creates a project of synthetic DICOM files on a FakeFlywheelClient
+    Args:
+        client (FakeFlywheelClient): the fake site
+        group (str): the label of the group in which to create the project
+        label (str): the label of the project
+        subjects (int): the number of subjects
+        sessions_per_subject (int): the number of sessions of each subject
+        acquisitions_per_session (int): the number of acquisitions of each session
+        files_per_acquisition (int): the number of DICOM files in each acquisition
+        pixel_bytes (int): the approximate size of each file's pixel data
+
+    Returns:
+        str: the id of the project
+    """
+    # imported here so that the fake client itself does not depend on the corpus generator (or pydicom)
+    from corpus import make_dicom_bytes
+
+    group_id = client.create_container('group', label=group)
+    project_id = client.create_container('project', group_id, label=label)
+    for subject_index in range(subjects):
+        code = f'subject-{subject_index:05d}'
+        subject_id = client.create_container('subject', project_id, code=code)
+        for session_index in range(sessions_per_subject):
+            session_id = client.create_container('session', subject_id, label=f'session-{session_index:03d}')
+            for acquisition_index in range(acquisitions_per_session):
+                acquisition_id = client.create_container('acquisition', session_id,
+                                                         label=f'acquisition-{acquisition_index:03d}')
+                for file_index in range(files_per_acquisition):
+                    seed = f'{label}/{code}/{session_index}/{acquisition_index}/{file_index}'
+                    content = make_dicom_bytes(code, series_number=acquisition_index + 1,
+                                               pixel_bytes=pixel_bytes, seed=seed)
+                    client.create_file(acquisition_id, f'image-{file_index:05d}.dcm', content, file_type='dicom')
+    return project_id
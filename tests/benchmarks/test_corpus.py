@@ -0,0 +1,181 @@
+import io
+import os
+import zipfile
+
+import pydicom
+import pytest
+
+from bench_deid import DEFAULT_PROFILE_PATH, run_deid_benchmarks
+from corpus import CORPUS_PRESETS, generate_corpus, make_series_zip_bytes
+from deid_export.deid_file import deid_archive
+from deid_export.spool import SPOOL
+
+
+def _read_corpus(corpus):
+    contents = dict()
+    for paths in corpus.values():
+        for path in paths:
+            with open(path, 'rb') as f_data:
+                contents[os.path.basename(path)] = f_data.read()
+    return contents
+
+
+def test_corpus_is_reproducible(tmpdir):
+    corpus_a = generate_corpus(str(tmpdir.join('a')), seed=3, **CORPUS_PRESETS['tiny'])
+    corpus_b = generate_corpus(str(tmpdir.join('b')), seed=3, **CORPUS_PRESETS['tiny'])
+    corpus_c = generate_corpus(str(tmpdir.join('c')), seed=4, **CORPUS_PRESETS['tiny'])
+    assert {kind: len(paths) for kind, paths in corpus_a.items()} == {
+        'dicom': 2, 'zip': 1, 'jpg': 1, 'png': 1, 'tiff': 1, 'xml': 1
+    }
+    assert _read_corpus(corpus_a) == _read_corpus(corpus_b)
+    assert _read_corpus(corpus_a) != _read_corpus(corpus_c)
+
+
+def test_series_zip_members_share_a_series():
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('patient', 3, seed='s'))) as zipf:
+        datasets = [pydicom.dcmread(io.BytesIO(zipf.read(name))) for name in zipf.namelist()]
+    assert len({dataset.SeriesInstanceUID for dataset in datasets}) == 1
+    assert len({dataset.SOPInstanceUID for dataset in datasets}) == 3
+    assert [dataset.InstanceNumber for dataset in datasets] == [1, 2, 3]
+
+
+def _read_members(zip_path):
+    with zipfile.ZipFile(zip_path) as zipf:
+        return zipf.comment, [(name, pydicom.dcmread(io.BytesIO(zipf.read(name)))) for name in zipf.namelist()]
+
+
+def _read_member_bytes(zip_path):
+    # compared as bytes, since datasets read by older pydicom versions are not equal to each other
+    with zipfile.ZipFile(zip_path) as zipf:
+        return zipf.comment, [(name, zipf.read(name)) for name in zipf.namelist()]
+
+
+def test_streaming_deid_archive_matches_extracted(tmpdir):
+    zip_path = str(tmpdir.join('series.zip'))
+    with open(zip_path, 'wb') as f_data:
+        f_data.write(make_series_zip_bytes('patient', 5, pixel_bytes=1024, seed='s'))
+    with zipfile.ZipFile(zip_path, 'a') as zipf:
+        zipf.comment = b'series comment'
+    extracted_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('extracted')))
+    # batches smaller than a member, so that each member is a batch
+    streamed_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('streamed')),
+                                 streaming=True, max_batch_bytes=1)
+
+    extracted_comment, extracted_members = _read_members(extracted_path)
+    streamed_comment, streamed_members = _read_members(streamed_path)
+    assert streamed_comment == extracted_comment == b'series comment'
+    assert [name for name, _ in streamed_members] == [f'series/{index:05d}.dcm' for index in range(5)]
+    assert _read_member_bytes(streamed_path) == _read_member_bytes(extracted_path)
+    assert {dataset.PatientID for _, dataset in streamed_members} == {'FLYWHEEL'}
+    assert not os.path.exists(f'{streamed_path}.part')
+    assert SPOOL.reserved_bytes == 0
+
+
+def test_streaming_deid_archive_excludes_reused_sop_uids_across_batches(tmpdir):
+    zip_path = str(tmpdir.join('series.zip'))
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('patient', 1, seed='s'))) as zipf:
+        member = zipf.read('series/00000.dcm')
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        zipf.writestr('a.dcm', member)
+        zipf.writestr('b.dcm', member)
+    streamed_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('streamed')),
+                                 streaming=True, max_batch_bytes=1)
+    _, streamed_members = _read_members(streamed_path)
+    # as when extracting the whole archive, the member re-using the SOPInstanceUID is not de-identified
+    assert [dataset.PatientID for _, dataset in streamed_members] == ['FLYWHEEL', 'patient']
+
+
+def test_parallel_deid_archive_matches_serial(tmpdir):
+    zip_path = str(tmpdir.join('series.zip'))
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('patient', 6, seed='s'))) as zipf:
+        members = [(name, zipf.read(name)) for name in zipf.namelist()]
+    # the last member re-uses the SOPInstanceUID of the first, which is in another worker's chunk
+    members.append(('series/duplicate.dcm', members[0][1]))
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for name, member in members:
+            zipf.writestr(name, member)
+
+    serial_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('serial')))
+    parallel_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('parallel')),
+                                 n_jobs=3)
+    # streaming processes the members in archive order rather than in the order of the extracted directory
+    streamed_kwargs = {'streaming': True, 'max_batch_bytes': 4 * len(members[0][1])}
+    streamed_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('streamed')),
+                                 **streamed_kwargs)
+    streamed_parallel_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH,
+                                          output_directory=str(tmpdir.mkdir('streamed_parallel')), n_jobs=2,
+                                          **streamed_kwargs)
+
+    _, serial_members = _read_members(serial_path)
+    assert [dataset.PatientID for _, dataset in serial_members].count('patient') == 1
+    assert _read_member_bytes(parallel_path) == _read_member_bytes(serial_path)
+    assert _read_member_bytes(streamed_parallel_path) == _read_member_bytes(streamed_path)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_parallel_deid_archive_validates_members_across_chunks(tmpdir, caplog, streaming):
+    zip_path = str(tmpdir.join('series.zip'))
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('patient', 5, seed='s'))) as zipf:
+        members = [(name, zipf.read(name)) for name in sorted(zipf.namelist())]
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('other', 1, seed='o'))) as zipf:
+        other_member = zipf.read(zipf.namelist()[0])
+    # a member of another series starts the second worker's chunk, and the last member re-uses the SOPInstanceUID of
+    # a member of the first chunk
+    members.insert(4, ('series/00003b.dcm', other_member))
+    members.append(('series/duplicate.dcm', members[1][1]))
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for name, member in members:
+            zipf.writestr(name, member)
+
+    def _deid_archive(output_name, **kwargs):
+        caplog.clear()
+        output_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir(output_name)),
+                                   streaming=streaming, max_batch_bytes=4 * len(members[0][1]), **kwargs)
+        messages = sorted(record.getMessage() for record in caplog.records
+                          if record.levelname in ('WARNING', 'ERROR') and 'DICOM' in record.getMessage())
+        return output_path, messages
+
+    serial_path, serial_messages = _deid_archive('serial')
+    parallel_path, parallel_messages = _deid_archive('parallel', n_jobs=2)
+    _, serial_members = _read_members(serial_path)
+    assert [dataset.PatientID for _, dataset in serial_members].count('patient') == 1
+    assert any('different SeriesInstanceUID' in message for message in serial_messages)
+    assert _read_member_bytes(parallel_path) == _read_member_bytes(serial_path)
+    # the series and SOP instance UIDs of the members are validated against those of the members of other chunks
+    assert parallel_messages == serial_messages
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_deid_archive_copies_unchanged_members(tmpdir, streaming):
+    zip_path = str(tmpdir.join('series.zip'))
+    with zipfile.ZipFile(io.BytesIO(make_series_zip_bytes('patient', 2, seed='s'))) as zipf:
+        members = [(name, zipf.read(name)) for name in zipf.namelist()]
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for name, member in members:
+            zipf.writestr(name, member)
+        # not a DICOM file, so left as it is by the profile
+        zipf.writestr('notes.txt', b'notes' * 100, compress_type=zipfile.ZIP_DEFLATED)
+
+    output_path = deid_archive(zip_path, DEFAULT_PROFILE_PATH, output_directory=str(tmpdir.mkdir('output')),
+                               streaming=streaming, compression='deflate', compression_workers=2)
+    with zipfile.ZipFile(zip_path) as zin, zipfile.ZipFile(output_path) as zout:
+        assert zout.testzip() is None
+        assert zout.namelist() == zin.namelist()
+        assert [info.compress_type for info in zout.infolist()] == [zipfile.ZIP_DEFLATED] * 3
+        # the unchanged member is copied as it is, rather than recompressed
+        assert zout.getinfo('notes.txt').date_time == zin.getinfo('notes.txt').date_time
+        assert zout.read('notes.txt') == b'notes' * 100
+        assert pydicom.dcmread(io.BytesIO(zout.read(members[0][0]))).PatientID == 'FLYWHEEL'
+
+
+def test_deid_benchmarks_run_on_tiny_corpus(tmpdir):
+    corpus = generate_corpus(str(tmpdir), **CORPUS_PRESETS['tiny'])
+    results = {result['benchmark']: result for result in run_deid_benchmarks(corpus)}
+    assert results['deidentify_file/dicom']['files'] == 2
+    assert results['deidentify_file/zip']['files'] == 10
+    assert results['deid_archive/10_members']['files'] == 10
+    assert results['deid_archive_streaming/10_members']['files'] == 10
+    assert results['deid_archive/10_members/2_jobs']['files'] == 10
+    assert results['deid_archive/10_members/deflate_2_threads']['files'] == 10
+    assert {'deidentify_path/dicom', 'deidentify_files/dicom', 'deidentify_file/xml'} <= set(results)
+    assert all(result['mb_per_sec'] > 0 for result in results.values())
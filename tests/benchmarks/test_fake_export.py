@@ -0,0 +1,276 @@
+import io
+
+import flywheel
+import pydicom
+import pytest
+
+from bench_export import SHAPES, run_export_benchmark
+from corpus import make_dicom_bytes, make_xml_bytes
+from fake_flywheel import FakeFlywheelClient, build_project
+
+
+def test_fake_client_finders_and_errors():
+    client = FakeFlywheelClient(error_rate=1.0, error_operations={'upload_file'})
+    project_id = build_project(client, subjects=2, files_per_acquisition=1)
+    project = client.get(project_id)
+    subjects = list(client.subjects.iter_find(f'parents.project={project_id}'))
+    assert [subject.code for subject in subjects] == ['subject-00000', 'subject-00001']
+    assert 'info' not in subjects[0]
+    # as in the SDK, finders only accept the keyword arguments of the get_all_* endpoints
+    with pytest.raises(TypeError):
+        list(client.sessions.iter_find(f'parents.project={project_id}', include_all_info=True))
+    assert project.subjects.find_first('code=subject-00001').id == subjects[1].id
+    session = client.sessions.find_first(f'parents.subject={subjects[0].id}')
+    assert session.project == project_id
+    assert session.subject.reload().code == 'subject-00000'
+    acquisition = session.acquisitions()[0]
+    with pytest.raises(flywheel.ApiException):
+        acquisition.upload_file(__file__)
+    assert client.api_client.errors == 1
+
+
+def test_export_benchmark_exports_deidentified_files(tmpdir):
+    result = run_export_benchmark(shape='tiny', work_dir=str(tmpdir), max_workers=2)
+    file_count = SHAPES['tiny']['subjects'] * SHAPES['tiny']['files_per_acquisition']
+    assert result['failure'] is None
+    assert result['files'] == result['exported'] == file_count
+    assert result['api_calls_per_file'] > 0
+    assert result['peak_rss_mb'] > 0
+
+
+def test_export_to_fake_client(tmpdir):
+    from deid_export.container_export import export_container
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1, files_per_acquisition=2)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    assert export_container(client, origin_id, dest_id, template_path,
+                            csv_output_path=str(tmpdir.join('export.csv'))) == 0
+    dest_acquisition = client.acquisitions.find_first(f'parents.project={dest_id}')
+    assert len(dest_acquisition.files) == 2
+    for file_obj in dest_acquisition.files:
+        dataset = pydicom.dcmread(io.BytesIO(client.get_file_content(dest_acquisition.id, file_obj.name)))
+        assert dataset.PatientID == 'FLYWHEEL'
+
+
+def test_asyncio_backend_exports_to_fake_client(tmpdir):
+    from deid_export.container_export import export_container
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=2, sessions_per_subject=2, files_per_acquisition=2)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    assert export_container(client, origin_id, dest_id, template_path, backend='asyncio', max_workers=2,
+                            csv_output_path=str(tmpdir.join('export.csv'))) == 0
+    assert len(client.sessions.find(f'parents.project={dest_id}')) == 4
+    for dest_acquisition in client.acquisitions.find(f'parents.project={dest_id}'):
+        assert len(dest_acquisition.files) == 2
+        for file_obj in dest_acquisition.files:
+            dataset = pydicom.dcmread(io.BytesIO(client.get_file_content(dest_acquisition.id, file_obj.name)))
+            assert dataset.PatientID == 'FLYWHEEL'
+            assert client.get(dest_acquisition.id).get_file(file_obj.name).info['export']['origin_id']
+
+
+def test_reexport_reuses_indexed_destination_containers(tmpdir):
+    from deid_export.container_export import export_container
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1, files_per_acquisition=1)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    for _ in range(2):
+        assert export_container(client, origin_id, dest_id, template_path, overwrite=True,
+                                csv_output_path=str(tmpdir.join('export.csv'))) == 0
+    # the destination index matches the existing containers by their origin ids, which finders do not return
+    assert len(client.sessions.find(f'parents.project={dest_id}')) == 1
+    assert len(client.acquisitions.find(f'parents.project={dest_id}')) == 1
+
+
+def test_failed_export_uninstalls_api_limiter(tmpdir):
+    from deid_export.container_export import export_container
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    call_api = client.api_client.call_api
+    with pytest.raises(FileNotFoundError):
+        export_container(client, origin_id, dest_id, str(tmpdir.join('missing.yaml')), max_api_concurrency=4)
+    assert client.api_client.call_api == call_api
+
+
+def test_export_with_subject_csv(tmpdir):
+    import pandas as pd
+    from deid_export.container_export import export_container
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=3)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n"
+                                       "export:\n  subject:\n    code: 'FLYWHEEL'\n")
+    # subject-00002 is not in the csv, its files are reported as errors
+    subject_csv_path = str(tmpdir.join('subjects.csv'))
+    tmpdir.join('subjects.csv').write('subject.code,export.subject.code,dicom.fields.PatientID.replace-with\n'
+                                      'subject-00000,NEW0,ID0\nsubject-00001,NEW1,ID1\n')
+    csv_path = str(tmpdir.join('export.csv'))
+    assert export_container(client, origin_id, dest_id, template_path, csv_output_path=csv_path,
+                            subject_csv_path=subject_csv_path) == 1
+    assert len(pd.read_csv(csv_path)) == 3
+    for index in range(2):
+        dest_subject = client.subjects.find_first(f'parents.project={dest_id},code=NEW{index}')
+        dest_acquisition = client.acquisitions.find_first(f'parents.subject={dest_subject.id}')
+        file_obj = dest_acquisition.files[0]
+        dataset = pydicom.dcmread(io.BytesIO(client.get_file_content(dest_acquisition.id, file_obj.name)))
+        assert dataset.PatientID == f'ID{index}'
+
+
+def test_plan_predicts_collisions_with_exported_files(tmpdir, monkeypatch):
+    import pandas as pd
+    from deid_export import container_export
+
+    journals = list()
+
+    class _TrackedJournal(container_export.ExportJournal):
+        def __init__(self, path):
+            super().__init__(path)
+            journals.append(self)
+
+    monkeypatch.setattr(container_export, 'ExportJournal', _TrackedJournal)
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=2, files_per_acquisition=2)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n"
+                                       "  filenames:\n    - output: '{filename}'\n"
+                                       "      input-regex: '^(?P<filename>.*)$'\n")
+    assert container_export.export_container(client, origin_id, dest_id, template_path) == 0
+
+    plan_path = str(tmpdir.join('plan.csv'))
+    assert container_export.export_container(client, origin_id, dest_id, template_path, plan=True,
+                                             plan_output_path=plan_path,
+                                             journal_path=str(tmpdir.join('journal.sqlite'))) == 0
+    plan_df = pd.read_csv(plan_path)
+    assert plan_df['file_count'].sum() == plan_df['existing_files'].sum() == 4
+    assert journals and all(journal._conn is None for journal in journals)
+
+
+def test_sharded_export_exports_each_file_once(tmpdir):
+    from deid_export.container_export import export_container
+    from deid_export.sharding import get_shard_path, merge_status_csvs
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=6, files_per_acquisition=1)
+    client.create_file(origin_id, 'project.dcm', make_dicom_bytes('project'), file_type='dicom')
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    csv_paths = [get_shard_path(str(tmpdir.join('export.csv')), shard_index, 3) for shard_index in range(3)]
+    for shard_index, csv_path in enumerate(csv_paths):
+        export_container(client, origin_id, dest_id, template_path, csv_output_path=csv_path,
+                         shard_index=shard_index, shard_count=3)
+
+    merged_df, error_counts = merge_status_csvs(csv_paths, str(tmpdir.join('export.csv')))
+    assert sum(error_counts.values()) == 0
+    assert len(merged_df) == 7
+    assert not merged_df.duplicated(subset=['origin_parent', 'origin_filename']).any()
+    assert merged_df['origin_parent_type'].value_counts()['project'] == 1
+    assert len(list(client.subjects.iter_find(f'parents.project={dest_id}'))) == 6
+
+
+def test_project_files_are_exported_by_a_shard_without_sessions(tmpdir):
+    import pandas as pd
+    from deid_export.container_export import export_container
+    from deid_export.sharding import PROJECT_FILES_SHARD, get_shard_index, get_shard_path
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1)
+    client.create_file(origin_id, 'project.dcm', make_dicom_bytes('project'), file_type='dicom')
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    subject_id = client.subjects.find_first(f'parents.project={origin_id}').id
+    # the only subject is assigned to another shard than the project files shard
+    shard_count = next(count for count in range(2, 20) if get_shard_index(subject_id, count) != PROJECT_FILES_SHARD)
+    csv_path = get_shard_path(str(tmpdir.join('export.csv')), PROJECT_FILES_SHARD, shard_count)
+    assert export_container(client, origin_id, dest_id, template_path, csv_output_path=csv_path,
+                            shard_index=PROJECT_FILES_SHARD, shard_count=shard_count) == 0
+    status_df = pd.read_csv(csv_path)
+    assert list(status_df['origin_parent_type']) == ['project']
+    assert len(client.get(dest_id).files) == 1
+    assert not list(client.subjects.iter_find(f'parents.project={dest_id}'))
+
+
+def test_shard_without_sessions_writes_status_csv_header(tmpdir):
+    import pandas as pd
+    from deid_export.container_export import STATUS_COLUMNS, export_container
+    from deid_export.sharding import PROJECT_FILES_SHARD, get_shard_index, get_shard_path
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    subject_id = client.subjects.find_first(f'parents.project={origin_id}').id
+    # a shard that neither the only subject nor the project files are assigned to
+    shard_count = 3
+    shard_index = next(index for index in range(shard_count)
+                       if index not in (PROJECT_FILES_SHARD, get_shard_index(subject_id, shard_count)))
+    csv_path = get_shard_path(str(tmpdir.join('export.csv')), shard_index, shard_count)
+    assert export_container(client, origin_id, dest_id, template_path, csv_output_path=csv_path,
+                            shard_index=shard_index, shard_count=shard_count) == 0
+    status_df = pd.read_csv(csv_path)
+    assert list(status_df.columns) == STATUS_COLUMNS
+    assert status_df.empty
+
+
+def test_small_files_are_exported_in_memory(tmpdir):
+    from deid_export.container_export import export_container
+    from deid_export.spool import SPOOL
+
+    client = FakeFlywheelClient()
+    origin_id = build_project(client, subjects=1, files_per_acquisition=1)
+    acquisition = client.acquisitions.find_first(f'parents.project={origin_id}')
+    for index in range(3):
+        client.create_file(acquisition.id, f'record-{index}.xml', make_xml_bytes(seed=index), file_type='xml')
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write(
+        "dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n"
+        "xml:\n  fields:\n    - name: /Patient/Patient_Name\n      remove: true\n"
+    )
+    spool_reservations = SPOOL.get_counts()['spool_reservations']
+    assert export_container(client, origin_id, dest_id, template_path, csv_output_path=str(tmpdir.join('export.csv')),
+                            in_memory_max_bytes=2 ** 20) == 0
+
+    # only the dicom file went through the spool
+    assert SPOOL.get_counts()['spool_reservations'] == spool_reservations + 1
+    dest_acquisition = client.acquisitions.find_first(f'parents.project={dest_id}')
+    xml_names = sorted(file_obj.name for file_obj in dest_acquisition.files if file_obj.name.endswith('.xml'))
+    assert xml_names == ['record-0.xml', 'record-1.xml', 'record-2.xml']
+    content = client.get_file_content(dest_acquisition.id, 'record-0.xml')
+    assert b'Patient_Name' not in content
+    assert b'SUBJECT_ID' in content
+
+
+def test_concurrent_uploads_to_the_same_parent_are_exported(tmpdir):
+    import pandas as pd
+    from deid_export.container_export import export_container
+
+    # latency keeps reloads of the acquisition in flight while other files are uploaded to it
+    client = FakeFlywheelClient(latency=0.005, latency_jitter=0.01)
+    origin_id = build_project(client, subjects=1, files_per_acquisition=8)
+    dest_id = client.create_container('project', client.get(origin_id).parents.group, label='destination')
+    template_path = str(tmpdir.join('template.yaml'))
+    tmpdir.join('template.yaml').write("dicom:\n  fields:\n    - name: PatientID\n      replace-with: 'FLYWHEEL'\n")
+    csv_path = str(tmpdir.join('export.csv'))
+    assert export_container(client, origin_id, dest_id, template_path, csv_output_path=csv_path,
+                            max_upload_workers=4) == 0
+    status_df = pd.read_csv(csv_path)
+    assert list(status_df['state']) == ['exported'] * 8
+    dest_acquisition = client.acquisitions.find_first(f'parents.project={dest_id}').reload()
+    assert len(dest_acquisition.files) == 8
+    assert all(file_obj.info.get('export') for file_obj in dest_acquisition.files)
@@ -0,0 +1,140 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from deid_export.async_client import AsyncFlywheelClient
+from deid_export.async_export import AsyncSessionExporter
+from deid_export.container_cache import CONTAINER_CACHE
+from deid_export.export_summary import ExportSummary
+
+
+class _Client:
+    def __init__(self):
+        self.threads = set()
+
+    def get(self, container_id):
+        self.threads.add(threading.get_ident())
+        time.sleep(0.01)
+        return container_id
+
+
+def test_async_client_bounds_concurrency():
+    fw_client = _Client()
+    async_client = AsyncFlywheelClient(fw_client, max_threads=2, max_concurrency=4)
+
+    async def _get_all():
+        return await asyncio.gather(*[async_client.get(f'id{i}') for i in range(20)])
+
+    assert asyncio.run(_get_all()) == [f'id{i}' for i in range(20)]
+    assert async_client.get_counts() == {'async_calls': 20, 'async_max_in_flight': 4}
+    assert len(fw_client.threads) <= 2
+    # the client can be used again on another event loop
+    assert asyncio.run(_get_all()) == [f'id{i}' for i in range(20)]
+    assert async_client.get_counts()['async_calls'] == 40
+    async_client.close()
+
+
+class _Origin(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+    def download(self, dest_path):
+        with open(dest_path, 'w') as f:
+            f.write(self.id)
+
+
+class _DestParent(_Origin):
+    def __init__(self):
+        super().__init__(id='dest_acq', files=dict(), calls=list())
+
+    def reload(self):
+        return self
+
+    def get_file(self, filename):
+        return self.files.get(filename)
+
+    def upload_file(self, file_path):
+        self.calls.append(('upload_file', file_path))
+        self.files[file_path] = _Origin(name=file_path)
+
+    def update_file_info(self, filename, info):
+        self.calls.append(('update_file_info', filename))
+        self.files[filename]['info'] = info
+
+
+class _FileExporter:
+    def __init__(self, name, filename, dest_parent, tmpdir):
+        self.origin_filename = name
+        self.origin = _Origin(id=name, size=1)
+        self.dest_parent = dest_parent
+        self.dest = None
+        self.overwrite = False
+        self.filename = ''
+        self._deid_filename = filename
+        self._tmpdir = tmpdir
+        self.state = 'initialized'
+        self.errors = list()
+
+    def can_deidentify_in_memory(self, deid_profile):
+        return False
+
+    def reserve_spool(self):
+        pass
+
+    def get_download_path(self):
+        return str(self._tmpdir.join(self.origin_filename))
+
+    def deidentify(self, deid_profile, local_file_path=None):
+        assert local_file_path == self.get_download_path()
+        self.filename = self._deid_filename
+        self.state = 'processed'
+
+    def record_stage(self, stage, seconds, byte_count=None):
+        pass
+
+    def error_handler(self, log_str):
+        self.state = 'error'
+        self.errors.append(log_str)
+
+    def get_upload_file(self):
+        return self.filename, 1
+
+    def get_metadata_dict(self):
+        return {'info': {'export': {'origin_id': self.origin.id}}}
+
+    def cleanup(self):
+        pass
+
+    def get_status_dict(self):
+        # FileExporter.reload marks files whose metadata was updated as exported
+        return {'origin_filename': self.origin_filename,
+                'state': 'exported' if self.state == 'metadata_updated' else self.state}
+
+
+def test_async_session_exporter_local_file_export(tmpdir):
+    CONTAINER_CACHE.clear()
+    dest_parent = _DestParent()
+    session_exporter = AsyncSessionExporter.__new__(AsyncSessionExporter)
+    session_exporter.async_client = AsyncFlywheelClient(None, max_threads=2)
+    session_exporter._owns_async_client = True
+    session_exporter.deid_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    session_exporter._owns_deid_executor = True
+    session_exporter.deid_profile = None
+    session_exporter.summary = ExportSummary()
+    session_exporter._uploads_in_flight = 0
+    session_exporter.skipped_status = list()
+    session_exporter.files = [_FileExporter(f'file{i}', name, dest_parent, tmpdir)
+                              for i, name in enumerate(['a', 'b', 'a'])]
+
+    status_df = asyncio.run(session_exporter.local_file_export_async())
+    assert list(status_df['state']) == ['exported', 'exported', 'error']
+    assert session_exporter.summary.to_dict()['upload_attempts'] == 2
+    # files are uploaded and their metadata updated through the async client's API methods
+    assert sorted(dest_parent.calls) == [('update_file_info', 'a'), ('update_file_info', 'b'), ('upload_file', 'a'),
+                                         ('upload_file', 'b')]
+    assert session_exporter.async_client.get_counts()['async_calls'] >= 4
+    # the client and de-identification executor created by the exporter are closed with it
+    session_exporter.close()
+    assert session_exporter.async_client._executor._shutdown
+    assert session_exporter.deid_executor._shutdown
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+from deid_export.concurrency import AdaptiveLimiter, install_limiter, uninstall_limiter
+
+
+class _ApiException(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+def test_adaptive_limiter_increases_additively():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=4)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.01)
+    assert limiter.limit == 4
+    assert limiter.max_limit_reached == 4
+
+
+def test_adaptive_limiter_backs_off_on_throttling():
+    limiter = AdaptiveLimiter(initial_limit=16, cooldown=60)
+    for status in ['429', 503]:
+        with pytest.raises(_ApiException):
+            with limiter.limit_call():
+                raise _ApiException(status)
+    # the second throttled call is within the cooldown of the first
+    assert limiter.limit == 8
+    assert limiter.get_counts() == {'api_calls': 2, 'api_throttle_events': 2, 'api_server_error_events': 0}
+    # client errors do not reduce the limit
+    with pytest.raises(_ApiException):
+        with limiter.limit_call():
+            raise _ApiException('404')
+    assert limiter.limit == 8
+
+
+def test_adaptive_limiter_does_not_increase_on_slow_calls():
+    limiter = AdaptiveLimiter(initial_limit=2, latency_tolerance=2)
+    limiter.acquire()
+    limiter.release(0.01)
+    limit = limiter.limit
+    limiter.acquire()
+    limiter.release(1.0)
+    assert limiter.limit == limit
+
+
+def test_adaptive_limiter_bounds_concurrency():
+    limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+    in_flight = list()
+    lock = threading.Lock()
+    current = [0]
+
+    def _call():
+        with limiter.limit_call():
+            with lock:
+                current[0] += 1
+                in_flight.append(current[0])
+            time.sleep(0.01)
+            with lock:
+                current[0] -= 1
+
+    threads = [threading.Thread(target=_call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(in_flight) == 2
+
+
+def test_install_limiter():
+    class _ApiClient:
+        def call_api(self, *args):
+            return args
+
+    fw_client = type('Client', (), {'api_client': _ApiClient()})()
+    limiter = AdaptiveLimiter()
+    install_limiter(fw_client, limiter)
+    # installing again replaces the limiter instead of stacking them
+    install_limiter(fw_client, limiter)
+    assert fw_client.api_client.call_api('/projects', 'GET') == ('/projects', 'GET')
+    assert limiter.calls == 1
+    uninstall_limiter(fw_client)
+    fw_client.api_client.call_api('/projects', 'GET')
+    assert limiter.calls == 1
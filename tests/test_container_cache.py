@@ -0,0 +1,117 @@
+import threading
+import time
+
+from deid_export.container_cache import ContainerCache
+
+
+class _Container(dict):
+    def __init__(self, reload_delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.reload_count = 0
+        self.reload_delay = reload_delay
+
+    def __getattr__(self, item):
+        return self[item]
+
+    def reload(self):
+        self.reload_count += 1
+        time.sleep(self.reload_delay)
+        return _Container(id=self['id'], modified=self.get('modified'), version=self.reload_count)
+
+
+def test_container_cache_hit_and_invalidate():
+    cache = ContainerCache()
+    container = _Container(id='ses1', modified=1)
+    assert cache.reload(container).version == 1
+    assert cache.reload(container).version == 1
+    assert container.reload_count == 1
+    cache.invalidate('ses1')
+    assert cache.reload(container).version == 2
+    assert cache.get_counts() == {
+        'container_cache_hits': 1, 'container_cache_misses': 2, 'container_cache_invalidations': 1,
+        'container_cache_evictions': 0
+    }
+
+
+def test_container_cache_expires_entries():
+    cache = ContainerCache(ttl=0)
+    container = _Container(id='ses1')
+    cache.reload(container)
+    time.sleep(0.01)
+    cache.reload(container)
+    assert container.reload_count == 2
+    assert cache.get_counts()['container_cache_evictions'] == 1
+    assert len(cache._entries) == 1
+
+
+def test_container_cache_evicts_least_recently_used():
+    cache = ContainerCache(max_entries=2)
+    containers = {container_id: _Container(id=container_id) for container_id in ['ses1', 'ses2', 'ses3']}
+    for container_id in ['ses1', 'ses2', 'ses1', 'ses3']:
+        cache.reload(containers[container_id])
+    assert list(cache._entries) == ['ses1', 'ses3']
+    assert cache.get_counts()['container_cache_evictions'] == 1
+    cache.reload(containers['ses2'])
+    assert containers['ses2'].reload_count == 2
+    assert containers['ses1'].reload_count == 1
+
+
+def test_container_cache_refreshes_when_container_is_newer():
+    cache = ContainerCache()
+    cache.reload(_Container(id='ses1', modified=1))
+    newer = _Container(id='ses1', modified=2)
+    assert cache.reload(newer).modified == 2
+    assert newer.reload_count == 1
+    # an older copy is served the cached container
+    older = _Container(id='ses1', modified=1)
+    assert cache.reload(older).modified == 2
+    assert older.reload_count == 0
+
+
+def test_container_cache_coalesces_concurrent_reloads():
+    cache = ContainerCache()
+    container = _Container(id='ses1', reload_delay=0.05)
+    results = list()
+    threads = [threading.Thread(target=lambda: results.append(cache.reload(container))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert container.reload_count == 1
+    assert len({id(result) for result in results}) == 1
+    # the per-container locks are removed once no thread holds them
+    assert not cache._key_locks
+
+
+class _BlockingContainer(_Container):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started = threading.Event()
+        self.finish = threading.Event()
+
+    def reload(self):
+        self.started.set()
+        self.finish.wait(5)
+        return super().reload()
+
+
+def test_container_cache_does_not_serve_reloads_invalidated_in_flight():
+    cache = ContainerCache()
+    container = _BlockingContainer(id='acq1')
+    results = dict()
+    stale_thread = threading.Thread(target=lambda: results.setdefault('stale', cache.reload(container)))
+    stale_thread.start()
+    container.started.wait(5)
+    # waits for the reload in flight, as an upload thread reloading its parent would
+    waiting_thread = threading.Thread(target=lambda: results.setdefault('waiting', cache.reload(container)))
+    waiting_thread.start()
+    # e.g. a file was uploaded to the container by another thread
+    cache.invalidate('acq1')
+    container.finish.set()
+    stale_thread.join()
+    waiting_thread.join()
+    assert results['stale'].version == 1
+    assert results['waiting'].version == 2
+    assert cache.reload(container).version == 2
+    assert container.reload_count == 2
+    assert not cache._key_locks
@@ -1,11 +1,24 @@
+import datetime
+import pickle
+import threading
+import time
 import pytest
 from pathlib import Path
-from deid_export.container_export import hash_string, load_template_dict, quote_numeric_string, matches_file
+from deid_export import container_export
+from deid_export.container_export import hash_string, load_template_dict, quote_numeric_string, matches_file, \
+    SessionExportTask
 from deid_export.deid_template import load_deid_profile
+from deid_export.export_journal import ExportJournal
+from deid_export.export_summary import ExportSummary
 
 DATA_ROOT = Path(__file__).parent/'data'
 
 
+class _Container(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+
 def test_hash_string():
     input_str = 'just a test'
     output_hash = hash_string('just a test')
@@ -54,4 +67,421 @@ def test_matches_file():
     assert not matches_file(deid_profile, {'name': 'test.jpg'})
     template_dict.pop('dicom')
     deid_profile, _ = load_deid_profile(template_dict)
-    assert not matches_file(deid_profile, {'type': 'dicom', 'name': 'test.dcm'})
\ No newline at end of file
+    assert not matches_file(deid_profile, {'type': 'dicom', 'name': 'test.dcm'})
+
+
+def test_iter_session_export_results_yields_sessions_as_they_complete(monkeypatch):
+    tasks = [
+        SessionExportTask(session_id='ses1', subject_id='sub1', template_path='t.yml', project_files=True,
+                          subject_files=True),
+        SessionExportTask(session_id='ses2', subject_id='sub1', template_path='t.yml'),
+        SessionExportTask(session_id='ses3', subject_id='sub2', template_path='t.yml', subject_files=True),
+        SessionExportTask(session_id='ses4', subject_id='sub2', template_path='t.yml'),
+    ]
+    call_order = list()
+    yielded = threading.Event()
+
+    def _fake_run(fw_client, task, dest_proj_id, **export_kwargs):
+        call_order.append(task.session_id)
+        if task.session_id == 'ses3':
+            # completes only once another session's result has been yielded
+            assert yielded.wait(timeout=5)
+        return task.session_id, None
+
+    monkeypatch.setattr(container_export, 'run_session_export_task', _fake_run)
+    results = list()
+    for result in container_export.iter_session_export_results(None, tasks, 'dest', max_workers=2):
+        results.append(result)
+        yielded.set()
+    assert results[0][1] == 'ses1'
+    assert sorted(res for _, res, _ in results) == ['ses1', 'ses2', 'ses3', 'ses4']
+    # first sessions of each subject are exported before any other sessions
+    assert set(call_order[:2]) == {'ses1', 'ses3'}
+
+    with pytest.raises(ValueError):
+        list(container_export.iter_session_export_results(None, tasks, 'dest', max_workers=2, backend='spam'))
+
+
+def test_process_worker_closes_journal_after_task(monkeypatch, tmp_path):
+    # process workers are sent a pickled copy of the journal with each task
+    journal = pickle.loads(pickle.dumps(ExportJournal(str(tmp_path / 'journal.sqlite'))))
+
+    def _fake_run(fw_client, task, dest_proj_id, journal=None, **export_kwargs):
+        journal.record({'origin_filename': 'file0', 'origin_parent': 'acq', 'export_parent': 'dest_acq',
+                        'state': 'exported'})
+        journal.flush()
+        return None, ExportSummary()
+
+    monkeypatch.setitem(container_export._WORKER_CLIENTS, 'api_key', object())
+    monkeypatch.setattr(container_export, 'run_session_export_task', _fake_run)
+    task = SessionExportTask(session_id='ses1', subject_id='sub1', template_path='t.yml')
+    container_export._run_session_export_task_in_process('api_key', task, 'dest', journal=journal)
+    assert journal._conn is None
+    assert ExportJournal(journal.path).get_status('acq', 'file0', 'dest_acq')['state'] == 'exported'
+
+
+class _FakeParent:
+    id = 'dest_acq'
+
+
+class _FakeFileExporter:
+    def __init__(self, name, filename):
+        self.origin_filename = name
+        self.origin = _Container(id=name, size=1)
+        self.dest_parent = _FakeParent()
+        self.filename = ''
+        self._deid_filename = filename
+        self.state = 'initialized'
+        self.errors = list()
+        self.events = list()
+
+    def can_deidentify_in_memory(self, deid_profile):
+        return False
+
+    def download(self, directory=None):
+        self.events.append('download')
+        return directory
+
+    def deidentify(self, deid_profile, local_file_path=None):
+        self.events.append('deidentify')
+        self.filename = self._deid_filename
+        self.state = 'processed'
+
+    def error_handler(self, log_str):
+        self.state = 'error'
+        self.errors.append(log_str)
+
+    def reload(self):
+        return self
+
+    def upload(self):
+        self.events.append('upload')
+        self.state = 'upload_attempted'
+
+    def update_metadata(self):
+        self.state = 'exported'
+
+    def cleanup(self):
+        self.events.append('cleanup')
+
+    def get_status_dict(self):
+        return {'origin_filename': self.origin_filename, 'state': self.state}
+
+
+def _make_session_exporter(files, journal=None):
+    session_exporter = container_export.SessionExporter.__new__(container_export.SessionExporter)
+    session_exporter.origin = type('Origin', (), {'id': 'ses1'})()
+    session_exporter.deid_profile = None
+    session_exporter.max_upload_workers = 1
+    session_exporter.pipeline_depth = 0
+    session_exporter.summary = container_export.ExportSummary()
+    session_exporter._uploads_in_flight = 0
+    session_exporter._upload_lock = container_export.threading.Lock()
+    session_exporter.journal = journal
+    session_exporter.resume = journal is not None
+    session_exporter.skipped_status = list()
+    session_exporter.files = files
+    return session_exporter
+
+
+def test_pipeline_file_export_checks_filename_collisions():
+    session_exporter = _make_session_exporter(
+        [_FakeFileExporter(f'file{i}', name) for i, name in enumerate(['a', 'b', 'a', 'c'])]
+    )
+
+    status_df = session_exporter.pipeline_file_export(max_pending=1)
+    assert list(status_df['state']) == ['exported', 'exported', 'error', 'exported']
+    assert session_exporter.files[0].events == ['download', 'deidentify', 'upload', 'cleanup']
+    assert 'upload' not in session_exporter.files[2].events
+    assert session_exporter.summary.to_dict()['max_upload_concurrency'] == 1
+    assert session_exporter.summary.to_dict()['upload_bytes'] == 3
+
+
+class _SlowUploadFileExporter(_FakeFileExporter):
+    def upload(self):
+        time.sleep(0.05)
+        super().upload()
+
+
+def test_pipeline_file_export_uses_upload_workers():
+    session_exporter = _make_session_exporter(
+        [_SlowUploadFileExporter(f'file{i}', name) for i, name in enumerate(['a', 'b', 'c', 'a', 'd', 'e'])]
+    )
+    session_exporter.max_upload_workers = 3
+
+    status_df = session_exporter.pipeline_file_export(max_pending=2)
+    assert list(status_df['state']) == ['exported', 'exported', 'exported', 'error', 'exported', 'exported']
+    assert 1 < session_exporter.summary.to_dict()['max_upload_concurrency'] <= 3
+    assert session_exporter.summary.to_dict()['upload_attempts'] == 5
+    for file_exporter in session_exporter.files:
+        assert file_exporter.events[-1] == 'cleanup'
+
+
+class _FailingFileExporter(_FakeFileExporter):
+    def deidentify(self, deid_profile, local_file_path=None):
+        self.events.append('deidentify')
+        raise OSError('disk full')
+
+
+class _BrokenJournalFileExporter(_FailingFileExporter):
+    def error_handler(self, log_str):
+        raise RuntimeError('journal is gone')
+
+
+def test_pipeline_file_export_continues_after_deidentify_errors():
+    session_exporter = _make_session_exporter(
+        [_FakeFileExporter('file0', 'a'), _FailingFileExporter('file1', 'b'), _FakeFileExporter('file2', 'c')]
+    )
+
+    status_df = session_exporter.pipeline_file_export(max_pending=1)
+    assert list(status_df['state']) == ['exported', 'error', 'exported']
+    assert 'disk full' in session_exporter.files[1].errors[0]
+    assert session_exporter.files[1].events == ['download', 'deidentify', 'cleanup']
+
+
+def test_pipeline_file_export_does_not_hang_when_a_stage_fails():
+    files = [_BrokenJournalFileExporter('file0', 'a')] + [_FakeFileExporter(f'file{i}', f'{i}') for i in range(1, 8)]
+    session_exporter = _make_session_exporter(files)
+
+    with pytest.raises(RuntimeError, match='journal is gone'):
+        session_exporter.pipeline_file_export(max_pending=1)
+    # files downloaded but not yet de-identified are cleaned up
+    for file_exporter in files[1:]:
+        if 'download' in file_exporter.events:
+            assert file_exporter.events[-1] == 'cleanup'
+
+
+def test_skip_exported_files_carries_over_journaled_status(tmp_path):
+    journal = ExportJournal(str(tmp_path / 'journal.sqlite'))
+    for name, state in [('file0', 'exported'), ('file1', 'error')]:
+        journal.record({'origin_filename': name, 'origin_parent': 'acq', 'export_parent': 'dest_acq',
+                        'state': state})
+    session_exporter = _make_session_exporter([_FakeFileExporter(f'file{i}', f'{i}') for i in range(3)], journal)
+    for file_exporter in session_exporter.files:
+        file_exporter.origin_parent = type('Parent', (), {'id': 'acq'})()
+
+    session_exporter.skip_exported_files()
+    assert [file_exporter.origin_filename for file_exporter in session_exporter.files] == ['file1', 'file2']
+    status_df = session_exporter.local_file_export()
+    assert list(status_df['origin_filename']) == ['file0', 'file1', 'file2']
+    assert list(status_df['state']) == ['exported', 'exported', 'exported']
+    assert session_exporter.summary.to_dict()['files_resumed'] == 1
+
+
+def test_resume_after_interrupted_journal_batch_exports_uncommitted_files(tmp_path):
+    journal = ExportJournal(str(tmp_path / 'journal.sqlite'), commit_every=4, commit_seconds=3600)
+    for name in ['file0', 'file1', 'file2']:
+        for state in ['processed', 'exported']:
+            journal.record({'origin_filename': name, 'origin_parent': 'acq', 'export_parent': 'dest_acq',
+                            'state': state})
+    # the export is interrupted without closing the journal, so the transitions of file2 are never committed
+    resumed_journal = ExportJournal(journal.path)
+    session_exporter = _make_session_exporter([_FakeFileExporter(f'file{i}', f'{i}') for i in range(3)],
+                                              resumed_journal)
+    for file_exporter in session_exporter.files:
+        file_exporter.origin_parent = type('Parent', (), {'id': 'acq'})()
+
+    session_exporter.skip_exported_files()
+    assert [file_exporter.origin_filename for file_exporter in session_exporter.files] == ['file2']
+    status_df = session_exporter.local_file_export()
+    assert list(status_df['origin_filename']) == ['file0', 'file1', 'file2']
+    assert list(status_df['state']) == ['exported', 'exported', 'exported']
+    resumed_journal.close()
+
+
+class _ModifiedFinder:
+    def __init__(self, containers):
+        self.containers = containers
+        self.filters = list()
+
+    def iter_find(self, filter_str):
+        self.filters.append(filter_str)
+        return iter(self.containers)
+
+
+def test_get_modified_session_ids():
+    fw_client = _Container(
+        sessions=_ModifiedFinder([
+            _Container(id='ses1', container_type='session', modified=datetime.datetime(2020, 1, 1, 12))
+        ]),
+        acquisitions=_ModifiedFinder([
+            _Container(id='acq1', container_type='acquisition', parents=_Container(session='ses2'),
+                       modified=datetime.datetime(2020, 1, 2, 12))
+        ])
+    )
+    project = _Container(id='proj', container_type='project')
+    session_ids, high_water_mark = container_export.get_modified_session_ids(fw_client, project,
+                                                                             since='2020-01-01T00:00:00.000000')
+    assert session_ids == {'ses1', 'ses2'}
+    assert high_water_mark == '2020-01-02T12:00:00.000000'
+    assert fw_client.sessions.filters == ['parents.project=proj,modified>2020-01-01T00:00:00.000000']
+
+
+class _WatchSnapshot:
+    instances = list()
+
+    def __init__(self, fw_client, root_container):
+        self.refreshed = list()
+        self.instances.append(self)
+
+    def refresh_sessions(self, session_ids):
+        self.refreshed.append(session_ids)
+
+
+def test_watch_container_persists_high_water_mark(monkeypatch, tmp_path):
+    polls = [({'ses1', 'ses2'}, 'mark1'), (set(), 'mark1'), ({'ses3'}, 'mark2'), ({'ses4'}, 'mark3')]
+    since_list = list()
+    exported = list()
+    dest_indexes = list()
+
+    def get_modified_session_ids(fw_client, container, since=None):
+        since_list.append(since)
+        return polls[len(since_list) - 1]
+
+    def export_container(session_ids, snapshot, dest_index, failed_session_ids, **kwargs):
+        exported.append(session_ids)
+        dest_indexes.append(dest_index)
+        assert snapshot is _WatchSnapshot.instances[-1]
+        return 0
+
+    fw_client = _Container(get=lambda container_id: _Container(id=container_id, container_type='project'))
+    monkeypatch.setattr(container_export, 'get_modified_session_ids', get_modified_session_ids)
+    monkeypatch.setattr(container_export, 'export_container', export_container)
+    monkeypatch.setattr(container_export, 'OriginSnapshot', _WatchSnapshot)
+    monkeypatch.setattr(container_export, 'DestinationIndex', lambda fw_client, dest_proj_id: object())
+    _WatchSnapshot.instances.clear()
+    state_path = str(tmp_path / 'state.json')
+    error_count = container_export.watch_container(fw_client, 'proj', 'dest', 'template.yml', state_path,
+                                                   poll_interval=0, max_polls=3)
+    assert error_count == 0
+    assert since_list == [None, 'mark1', 'mark1']
+    # the snapshot and index are built once, later polls only refresh the modified sessions
+    assert len(_WatchSnapshot.instances) == 1
+    assert _WatchSnapshot.instances[0].refreshed == [{'ses3'}]
+    assert dest_indexes[0] is dest_indexes[1]
+    # a restarted watch picks up from the persisted high-water mark
+    container_export.watch_container(fw_client, 'proj', 'dest', 'template.yml', state_path, poll_interval=0,
+                                     max_polls=1)
+    assert since_list == [None, 'mark1', 'mark1', 'mark2']
+    assert exported == [{'ses1', 'ses2'}, {'ses3'}, {'ses4'}]
+    assert container_export.load_watch_state(state_path) == {'container_id': 'proj', 'high_water_mark': 'mark3',
+                                                             'failed_session_ids': []}
+
+
+def test_watch_container_retries_sessions_with_errors(monkeypatch, tmp_path):
+    polls = [({'ses1', 'ses2'}, 'mark1'), ({'ses3'}, 'mark2'), (set(), 'mark2')]
+    since_list = list()
+    exported = list()
+    # ses2 fails in the first poll, then is exported when it is retried
+    session_errors = [{'ses2': 2}, dict(), dict()]
+
+    def get_modified_session_ids(fw_client, container, since=None):
+        since_list.append(since)
+        return polls[len(since_list) - 1]
+
+    def export_container(session_ids, failed_session_ids, **kwargs):
+        errors = session_errors[len(exported)]
+        exported.append(session_ids)
+        failed_session_ids.update(errors)
+        return sum(errors.values())
+
+    fw_client = _Container(get=lambda container_id: _Container(id=container_id, container_type='project'))
+    monkeypatch.setattr(container_export, 'get_modified_session_ids', get_modified_session_ids)
+    monkeypatch.setattr(container_export, 'export_container', export_container)
+    monkeypatch.setattr(container_export, 'OriginSnapshot', _WatchSnapshot)
+    monkeypatch.setattr(container_export, 'DestinationIndex', lambda fw_client, dest_proj_id: object())
+    _WatchSnapshot.instances.clear()
+    state_path = str(tmp_path / 'state.json')
+    error_count = container_export.watch_container(fw_client, 'proj', 'dest', 'template.yml', state_path,
+                                                   poll_interval=0, max_polls=1)
+    assert error_count == 2
+    assert container_export.load_watch_state(state_path) == {'container_id': 'proj', 'high_water_mark': 'mark1',
+                                                             'failed_session_ids': ['ses2']}
+    # a restarted watch retries the failed session along with the newly modified ones
+    error_count = container_export.watch_container(fw_client, 'proj', 'dest', 'template.yml', state_path,
+                                                   poll_interval=0, max_polls=2)
+    assert error_count == 0
+    assert since_list == [None, 'mark1', 'mark2']
+    assert exported == [{'ses1', 'ses2'}, {'ses2', 'ses3'}]
+    assert container_export.load_watch_state(state_path) == {'container_id': 'proj', 'high_water_mark': 'mark2',
+                                                             'failed_session_ids': []}
+
+
+class _PlanSnapshot:
+    def __init__(self):
+        self.project = _Container(id='proj', container_type='project', label='Project', files=[])
+        self.subject = _Container(id='sub', container_type='subject', label='001', code='001', files=[])
+        self.session = _Container(id='ses', container_type='session', label='ses', parents=_Container(project='proj'),
+                                  files=[_Container(name='a.jpg', type='image', size=5)])
+        self.acquisition = _Container(id='acq', container_type='acquisition', label='acq', files=[
+            _Container(name='b.jpg', type='image', size=10), _Container(name='b.jpg', type='image', size=10),
+            _Container(name='c.dcm', type='dicom', size=20), _Container(name='d.txt', type='text', size=40)
+        ])
+
+    def get(self, container_id):
+        return {'proj': self.project}[container_id]
+
+    def subjects(self):
+        return [self.subject]
+
+    def sessions(self, subject_id):
+        return [self.session]
+
+    def acquisitions(self, session_id):
+        return [self.acquisition]
+
+
+class _PlanIndex:
+    def __init__(self, containers):
+        self.containers = containers
+
+    def find_indexed(self, container_type, parent_id, label, origin_id_hash=None):
+        return self.containers.get(container_type)
+
+
+def test_plan_session():
+    task = SessionExportTask(session_id='ses', subject_id='sub',
+                             template_path=str(DATA_ROOT/'example-3-deid-profile.yaml'), subject_files=True)
+    plan_rows = container_export.plan_session(task, 'dest_proj', _PlanSnapshot(),
+                                              _PlanIndex({'subject': _Container(id='dest_sub', files=[])}))
+    assert [(row['container_type'], row['dest_id'], row['create_container']) for row in plan_rows] == [
+        ('subject', 'dest_sub', False), ('session', None, True), ('acquisition', None, True)
+    ]
+    acquisition_row = plan_rows[-1]
+    assert acquisition_row['file_count'] == 3
+    assert acquisition_row['total_bytes'] == 40
+    assert acquisition_row['unpredictable_filenames'] == 1
+    assert acquisition_row['collisions'] == 1
+    assert acquisition_row['collision_filenames'] == 'b.jpg'
+    assert acquisition_row['existing_files'] == 0
+
+
+def test_plan_session_predicts_collisions_with_destination_files():
+    task = SessionExportTask(session_id='ses', subject_id='sub', project_files=True,
+                             template_path=str(DATA_ROOT/'example-3-deid-profile.yaml'))
+    snapshot = _PlanSnapshot()
+    snapshot.project.files.append(_Container(name='e.jpg', type='image', size=7))
+    dest_index = _PlanIndex({
+        'subject': _Container(id='dest_sub', files=[]),
+        'session': _Container(id='dest_ses', files=[]),
+        'acquisition': _Container(id='dest_acq', files=[_Container(name='b.jpg'), _Container(name='other.jpg')])
+    })
+    dest_proj = _Container(id='dest_proj', files=[_Container(name='e.jpg')])
+    plan_rows = container_export.plan_session(task, 'dest_proj', snapshot, dest_index, dest_proj=dest_proj)
+    assert [(row['container_type'], row['dest_id'], row['existing_files']) for row in plan_rows] == [
+        ('project', 'dest_proj', 1), ('session', 'dest_ses', 0), ('acquisition', 'dest_acq', 1)
+    ]
+    assert plan_rows[0]['existing_filenames'] == 'e.jpg'
+    assert plan_rows[-1]['existing_filenames'] == 'b.jpg'
+    assert plan_rows[-1]['collisions'] == 1
+
+
+def test_plan_project_files_task():
+    snapshot = _PlanSnapshot()
+    snapshot.project.files.append(_Container(name='e.jpg', type='image', size=7))
+    task = SessionExportTask(session_id=None, subject_id=None, project_files=True, project_id='proj',
+                             template_path=str(DATA_ROOT/'example-3-deid-profile.yaml'))
+    plan_rows = container_export.plan_session(task, 'dest_proj', snapshot, _PlanIndex(dict()))
+    assert [(row['container_type'], row['dest_id'], row['file_count']) for row in plan_rows] == [
+        ('project', 'dest_proj', 1)
+    ]
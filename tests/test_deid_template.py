@@ -1,9 +1,11 @@
+import copy
 import pytest
 import pandas as pd
 import tempfile
 from pathlib import Path
 from ruamel import yaml
-from deid_export.deid_template import update_deid_profile, validate, process_csv, DEFAULT_REQUIRED_COLUMNS
+from deid_export.deid_template import update_deid_profile, validate, process_csv, DEFAULT_REQUIRED_COLUMNS, \
+    get_template_hash, SubjectTemplateMap
 import logging
 
 DATA_ROOT = Path(__file__).parent/'data'
@@ -97,3 +99,40 @@ def test_can_update_deid_dicom_profile_filename_section():
 
     new_config = update_deid_profile(config, replace_with)
     assert new_config['dicom']['filenames'][0]['groups'][0]['replace-with'] == 'TEST'
+
+
+def test_get_template_hash():
+    template_dict = {'dicom': {'fields': [{'name': 'PatientID', 'replace-with': 'X'}]}, 'export': {}}
+    reordered = {'export': {}, 'dicom': {'fields': [{'replace-with': 'X', 'name': 'PatientID'}]}}
+    assert get_template_hash(template_dict) == get_template_hash(reordered)
+    changed = {'dicom': {'fields': [{'name': 'PatientID', 'replace-with': 'Y'}]}, 'export': {}}
+    assert get_template_hash(template_dict) != get_template_hash(changed)
+
+
+@pytest.mark.parametrize('profile_name', ['example1-deid-profile.yaml', 'example2-deid-profile-with-filenames.yaml'])
+def test_subject_template_map_matches_update_deid_profile(profile_name):
+    with open(DATA_ROOT/profile_name) as fid:
+        config = yaml.load(fid, Loader=yaml.SafeLoader)
+    original = copy.deepcopy(config)
+    df = pd.read_csv(DATA_ROOT/'example-csv-mapping.csv', dtype=str)
+    df['dicom.filenames.0.groups.subject.replace-with'] = df['subject.code']
+    subject_templates = SubjectTemplateMap(df, config, subject_code_col='subject.code')
+    for _, row in df.iterrows():
+        replace_with = row.drop('subject.code').to_dict()
+        expected = update_deid_profile(copy.deepcopy(config), replace_with)
+        assert subject_templates.get_template(row['subject.code']) == expected
+    # subject templates do not share modified elements with the template or each other
+    assert config == original
+    assert subject_templates.get_template('001') != subject_templates.get_template('002')
+
+
+def test_subject_template_map_raises_for_missing_or_duplicate_codes():
+    with open(DATA_ROOT/'example1-deid-profile.yaml') as fid:
+        config = yaml.load(fid, Loader=yaml.SafeLoader)
+    df = pd.read_csv(DATA_ROOT/'example-csv-mapping.csv', dtype=str)
+    df.iloc[2, 0] = df.iloc[1, 0]
+    subject_templates = SubjectTemplateMap(df, config, subject_code_col='subject.code')
+    with pytest.raises(ValueError, match='not found'):
+        subject_templates.get_template('004')
+    with pytest.raises(ValueError, match='more than one row'):
+        subject_templates.get_template('002')
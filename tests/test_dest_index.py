@@ -0,0 +1,80 @@
+from deid_export.dest_index import DestinationIndex
+
+
+class _Container(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+
+class _Finder:
+    def __init__(self, containers):
+        self.containers = containers
+        self.queries = list()
+
+    def iter_find(self, filter_str):
+        # as in the SDK, finder results do not include info
+        return iter(_Container({key: value for key, value in container.items() if key != 'info'})
+                    for container in self.containers)
+
+    def find_first(self, query):
+        self.queries.append(query)
+        return _Container(id='queried')
+
+
+class _Client:
+    def __init__(self):
+        self.subjects = _Finder([_Container(id='sub1', code='001', parents={'project': 'proj'})])
+        self.sessions = _Finder([
+            _Container(id='ses1', label='ses', parents={'subject': 'sub1'}, info={'export': {'origin_id': 'hash1'}})
+        ])
+        self.acquisitions = _Finder([])
+
+        self.get_calls = list()
+
+    def get(self, container_id):
+        self.get_calls.append(container_id)
+        for container in self.sessions.containers + self.acquisitions.containers:
+            if container.id == container_id:
+                return container
+        return _Container(id=container_id)
+
+
+def test_destination_index_find_and_add():
+    client = _Client()
+    dest_index = DestinationIndex(client, 'proj')
+    assert dest_index.find('subject', 'proj', '001').id == 'sub1'
+    assert dest_index.find('session', 'sub1', 'ses', 'hash1').id == 'ses1'
+    assert dest_index.find('session', 'sub1', 'ses', 'hash2') is None
+    dest_index.add('session', 'sub1', 'ses', 'hash2', _Container(id='ses2'))
+    assert dest_index.find('session', 'sub1', 'ses', 'hash2').id == 'ses2'
+    assert dest_index.get_counts() == {'dest_index_hits': 3, 'dest_index_misses': 1, 'dest_index_api_calls': 4}
+    # containers are loaded once per label to read their origin ids, hits are then served from the index
+    assert client.get_calls == ['ses1']
+
+
+def test_non_authoritative_destination_index_queries_on_miss():
+    dest_index = DestinationIndex(_Client(), 'proj', authoritative=False)
+    finder = _Finder([])
+    assert dest_index.find('subject', 'proj', '002', finder=finder, query='code=002').id == 'queried'
+    assert finder.queries == ['code=002']
+    # the queried container is added to the index
+    assert dest_index.find('subject', 'proj', '002', finder=finder, query='code=002').id == 'queried'
+    assert finder.queries == ['code=002']
+
+
+def test_destination_index_find_id():
+    dest_index = DestinationIndex(_Client(), 'proj')
+    assert dest_index.find_id('session', 'sub1', 'ses', 'hash1') == 'ses1'
+    assert dest_index.find_id('session', 'sub1', 'ses', 'hash2') is None
+    assert dest_index.get_counts()['dest_index_hits'] == 0
+
+
+def test_destination_index_loads_origin_ids_of_matching_labels_only():
+    client = _Client()
+    client.sessions.containers.append(
+        _Container(id='ses3', label='other', parents={'subject': 'sub1'}, info={'export': {'origin_id': 'hash3'}}))
+    dest_index = DestinationIndex(client, 'proj')
+    assert client.get_calls == list()
+    assert dest_index.find_indexed('session', 'sub1', 'other', 'hash3').id == 'ses3'
+    assert dest_index.find_indexed('session', 'sub1', 'other', 'hash3').id == 'ses3'
+    assert client.get_calls == ['ses3']
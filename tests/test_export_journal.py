@@ -0,0 +1,54 @@
+import pickle
+
+from deid_export.export_journal import ExportJournal
+
+
+def _status_dict(state, **kwargs):
+    status_dict = {'origin_filename': 'a.dcm', 'origin_parent': 'acq', 'origin_parent_type': 'acquisition',
+                   'export_filename': 'a.dcm', 'export_file_id': None, 'export_parent': 'dest_acq', 'state': state,
+                   'errors': ''}
+    status_dict.update(kwargs)
+    return status_dict
+
+
+def test_export_journal_records_transitions(tmp_path):
+    journal = ExportJournal(str(tmp_path / 'journal.sqlite'))
+    for state in ['processed', 'upload_attempted', 'metadata_updated']:
+        journal.record(_status_dict(state))
+    assert journal.get_exported_status('acq', 'a.dcm', 'dest_acq') is None
+    journal.record(_status_dict('exported', export_file_id='file1'))
+
+    assert journal.get_transitions('acq', 'a.dcm', 'dest_acq') == [
+        'processed', 'upload_attempted', 'metadata_updated', 'exported'
+    ]
+    assert journal.get_exported_status('acq', 'a.dcm', 'dest_acq') == _status_dict('exported', export_file_id='file1')
+    # files are keyed by destination parent as well as origin
+    assert journal.get_status('acq', 'a.dcm', 'other_acq') is None
+    journal.close()
+
+
+def test_export_journal_is_durable_and_picklable(tmp_path):
+    journal = ExportJournal(str(tmp_path / 'journal.sqlite'))
+    journal.record(_status_dict('exported'))
+    unpickled = pickle.loads(pickle.dumps(journal))
+    assert unpickled.get_exported_status('acq', 'a.dcm', 'dest_acq')['state'] == 'exported'
+    journal.close()
+    unpickled.close()
+    assert ExportJournal(journal.path).get_status('acq', 'a.dcm', 'dest_acq')['state'] == 'exported'
+
+
+def test_export_journal_commits_transitions_in_batches(tmp_path):
+    journal = ExportJournal(str(tmp_path / 'journal.sqlite'), commit_every=3, commit_seconds=3600)
+    reader = ExportJournal(journal.path)
+    journal.record(_status_dict('processed'))
+    journal.record(_status_dict('exported'))
+    # pending transitions are read from the journal that recorded them, but are not committed yet
+    assert journal.get_exported_status('acq', 'a.dcm', 'dest_acq')['state'] == 'exported'
+    assert reader.get_status('acq', 'a.dcm', 'dest_acq') is None
+    journal.record(_status_dict('processed', origin_filename='b.dcm'))
+    assert reader.get_status('acq', 'a.dcm', 'dest_acq')['state'] == 'exported'
+    assert reader.get_status('acq', 'b.dcm', 'dest_acq')['state'] == 'processed'
+    journal.record(_status_dict('exported', origin_filename='b.dcm'))
+    journal.close()
+    assert reader.get_transitions('acq', 'b.dcm', 'dest_acq') == ['processed', 'exported']
+    reader.close()
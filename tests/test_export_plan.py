@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import pandas as pd
+
+from deid_export.container_export import load_template_dict
+from deid_export.deid_template import load_deid_profile
+from deid_export.export_plan import PLAN_COLUMNS, estimate_duration, get_collisions, get_matching_file_profile, \
+    load_throughput_history, log_export_plan, predict_export_filename, record_throughput
+
+DATA_ROOT = Path(__file__).parent/'data'
+
+
+def _predict(deid_profile, file_obj):
+    file_profile = get_matching_file_profile(deid_profile, file_obj)
+    if file_profile is None:
+        return 'unmatched'
+    return predict_export_filename(file_profile, file_obj['name'])
+
+
+def test_predict_export_filename():
+    deid_profile, _ = load_deid_profile(load_template_dict(str(DATA_ROOT/'example-3-deid-profile.yaml')))
+    # output built from input-regex groups
+    assert _predict(deid_profile, {'name': 'photo1.jpg', 'type': 'image'}) == 'photo1.jpg'
+    # output built from DICOM header values
+    assert _predict(deid_profile, {'name': 'image.dcm', 'type': 'dicom'}) is None
+    assert _predict(deid_profile, {'name': 'notes.txt', 'type': 'text'}) == 'unmatched'
+
+
+def test_get_collisions():
+    assert get_collisions(['a.jpg', 'b.jpg', 'a.jpg', None, None, 'a.jpg']) == ['a.jpg']
+
+
+def test_throughput_history_and_estimate(tmp_path):
+    history_path = str(tmp_path / 'history.json')
+    assert estimate_duration(load_throughput_history(history_path), 10, 1000) is None
+    record_throughput(history_path, file_count=10, byte_count=1000, seconds=10)
+    record_throughput(history_path, file_count=30, byte_count=3000, seconds=30)
+    # runs without exported files do not change the history
+    record_throughput(history_path, file_count=0, byte_count=0, seconds=5)
+    history = load_throughput_history(history_path)
+    assert len(history) == 2
+    assert estimate_duration(history, 5, 2000) == 20
+    assert estimate_duration(history, 5, 0) == 5
+
+
+def test_log_export_plan(caplog):
+    plan_df = pd.DataFrame([
+        {'container_type': 'session', 'create_container': True, 'file_count': 2, 'total_bytes': 10,
+         'unpredictable_filenames': 1, 'collisions': 0},
+        {'container_type': 'acquisition', 'create_container': False, 'file_count': 3, 'total_bytes': 30,
+         'unpredictable_filenames': 0, 'collisions': 1, 'existing_files': 2},
+    ], columns=PLAN_COLUMNS)
+    with caplog.at_level('INFO'):
+        log_export_plan(plan_df, history=[{'files': 1, 'bytes': 4, 'seconds': 1}])
+    assert 'Export plan: 5 files (40 bytes) in 2 containers' in caplog.text
+    assert '1 session containers will be created' in caplog.text
+    assert '1 files will not be exported' in caplog.text
+    assert '2 files will not be exported because a file with their export filename exists' in caplog.text
+    assert 'estimated duration is 0.2 minutes' in caplog.text
+    caplog.clear()
+    with caplog.at_level('INFO'):
+        log_export_plan(plan_df, overwrite=True)
+    assert '2 files will replace files with the same name' in caplog.text
@@ -0,0 +1,34 @@
+import pickle
+
+from deid_export.export_summary import ExportSummary
+
+
+def test_export_summary_merge():
+    summary = ExportSummary()
+    summary.increment('upload_attempts')
+    summary.update_max('upload_concurrency', 2)
+    other = ExportSummary()
+    other.increment('upload_attempts', 3)
+    other.update_max('upload_concurrency', 4)
+    other.update_max('upload_concurrency', 1)
+    summary.merge(other)
+    assert summary.to_dict() == {'upload_attempts': 4, 'max_upload_concurrency': 4}
+
+
+def test_export_summary_can_be_pickled():
+    summary = ExportSummary()
+    summary.increment('sessions')
+    unpickled = pickle.loads(pickle.dumps(summary))
+    unpickled.increment('sessions')
+    assert unpickled.to_dict() == {'sessions': 2}
+
+
+def test_export_summary_percentiles():
+    summary = ExportSummary()
+    for value in range(1, 101):
+        summary.add_sample('upload_seconds', value)
+    other = ExportSummary()
+    other.add_sample('upload_seconds', 1000)
+    summary.merge(pickle.loads(pickle.dumps(other)))
+    assert summary.get_percentiles() == {'upload_seconds_p50': 51, 'upload_seconds_p95': 96,
+                                         'upload_seconds_max': 1000}
@@ -0,0 +1,114 @@
+import datetime
+import os
+import zipfile
+
+from deid_export.container_cache import CONTAINER_CACHE
+from deid_export.file_exporter import FileExporter
+from deid_export.metadata_export import hash_string
+from deid_export.spool import FILE_SPOOL_FACTOR, SPOOL
+
+
+class _Container(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+    def get_file(self, name):
+        return next((file_obj for file_obj in self.get('files', list()) if file_obj.name == name), None)
+
+    def reload(self):
+        return self
+
+
+MODIFIED = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _get_file_exporter(dest_export_dict, profile_hash='profile1'):
+    CONTAINER_CACHE.clear()
+    origin_file = _Container(id='file1', name='a.dcm', hash='content1', modified=MODIFIED)
+    origin_parent = _Container(id='acq1', container_type='acquisition', files=[origin_file])
+    dest_file = _Container(id='file2', name='a_deid.dcm', info={'export': dest_export_dict})
+    dest_parent = _Container(id='acq2', container_type='acquisition', files=[dest_file])
+    return FileExporter(None, origin_parent, 'a.dcm', dest_parent, profile_hash=profile_hash)
+
+
+def test_get_metadata_dict_records_origin_and_profile():
+    file_exporter = _get_file_exporter(dict())
+    assert file_exporter.get_metadata_dict()['info']['export'] == {
+        'origin_id': hash_string('file1'),
+        'origin_hash': 'content1',
+        'origin_modified': str(MODIFIED),
+        'profile_hash': 'profile1'
+    }
+
+
+def test_skip_if_unchanged():
+    export_dict = {'origin_id': hash_string('file1'), 'origin_hash': 'content1', 'origin_modified': str(MODIFIED),
+                   'profile_hash': 'profile1'}
+    file_exporter = _get_file_exporter(export_dict)
+    assert file_exporter.skip_if_unchanged()
+    assert file_exporter.state == 'unchanged'
+    assert file_exporter.filename == 'a_deid.dcm'
+
+    # the template changed
+    assert not _get_file_exporter(export_dict, profile_hash='profile2').skip_if_unchanged()
+    # the origin content changed
+    assert not _get_file_exporter(dict(export_dict, origin_hash='content0')).skip_if_unchanged()
+    # exported before the origin and profile were recorded
+    assert not _get_file_exporter({'origin_id': hash_string('file1')}).skip_if_unchanged()
+    # the profile hash is unknown
+    assert not _get_file_exporter(export_dict, profile_hash=None).skip_if_unchanged()
+
+
+def test_download_records_stage_stats(tmpdir):
+    file_exporter = _get_file_exporter(dict())
+    file_exporter.origin['download'] = lambda path: open(path, 'wb').write(b'12345')
+    file_exporter.download(str(tmpdir))
+    file_exporter.record_stage('metadata', 0.5)
+    file_exporter.record_stage('metadata', 0.25)
+    status_dict = file_exporter._get_status_dict()
+    assert status_dict['download_bytes'] == 5
+    assert status_dict['download_seconds'] >= 0
+    assert status_dict['metadata_seconds'] == 0.75
+    assert status_dict['upload_seconds'] is None
+
+
+def test_deidentify_failure_releases_spool(tmp_path):
+    SPOOL.configure(base_dir=str(tmp_path))
+    file_exporter = _get_file_exporter(dict())
+    file_exporter.origin['size'] = 5
+    file_exporter.origin['download'] = lambda path: open(path, 'wb').write(b'12345')
+
+    class _FailingProfile:
+        def process_file(self, **kwargs):
+            raise ValueError('cannot de-identify')
+
+    file_exporter.deidentify(_FailingProfile())
+    assert file_exporter.state == 'error'
+    assert file_exporter.spool_dir is None
+    assert SPOOL.reserved_bytes == 0
+    SPOOL.cleanup()
+    SPOOL.configure()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_deidentify_reserves_spool_for_archive_members(tmp_path):
+    SPOOL.configure(base_dir=str(tmp_path))
+    zip_path = tmp_path / 'a.zip'
+    with zipfile.ZipFile(str(zip_path), 'w') as zipf:
+        zipf.writestr('a/1.dcm', b'1' * 1000)
+        zipf.writestr('a/2.dcm', b'2' * 500)
+    zip_bytes = zip_path.read_bytes()
+    file_exporter = _get_file_exporter(dict())
+    file_exporter.origin['size'] = len(zip_bytes)
+    file_exporter.origin['download'] = lambda path: open(path, 'wb').write(zip_bytes)
+    reserved_bytes = list()
+
+    class _Profile:
+        def process_file(self, **kwargs):
+            reserved_bytes.append(SPOOL.reserved_bytes)
+
+    file_exporter.deidentify(_Profile())
+    assert reserved_bytes == [FILE_SPOOL_FACTOR * len(zip_bytes) + 1500]
+    assert SPOOL.reserved_bytes == 0
+    SPOOL.cleanup()
+    SPOOL.configure()
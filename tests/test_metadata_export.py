@@ -24,6 +24,13 @@ def test_export_config_to_whitelist():
     assert output == expected_output
 
 
+def test_export_config_to_whitelist_without_dict_whitelist():
+    export_config = {'whitelist': ['info.spam', 'modality']}
+    assert export_config_to_whitelist(export_config) == ['info.spam', 'modality']
+    assert export_config_to_whitelist({}) == list()
+    assert export_config_to_whitelist({'whitelist': 'modality'}) == list()
+
+
 def test_filter_metadata_list():
     input_list = ['python', 'classification.custom', 'info.python', 'modality']
     expected_output = ['classification.custom', 'info.python', 'modality']
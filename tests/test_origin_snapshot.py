@@ -0,0 +1,105 @@
+import pytest
+
+from deid_export.origin_snapshot import OriginSnapshot, load_acquisitions, load_container
+
+
+class _Container(dict):
+    def __getattr__(self, item):
+        return self[item]
+
+    def reload(self):
+        raise AssertionError('snapshot containers should not be reloaded')
+
+
+class _Finder:
+    def __init__(self, containers):
+        self.containers = containers
+        self.filters = list()
+
+    def iter_find(self, filter_str):
+        self.filters.append(filter_str)
+        return iter(self.containers)
+
+
+class _Client:
+    def __init__(self, subjects, sessions, acquisitions):
+        self.subjects = _Finder(subjects)
+        self.sessions = _Finder(sessions)
+        self.acquisitions = _Finder(acquisitions)
+        self.get_calls = list()
+
+    def get(self, container_id):
+        self.get_calls.append(container_id)
+        return _Container(id=container_id, loaded=True)
+
+
+def _make_client():
+    subjects = [_Container(id='sub1', parents={'project': 'proj'})]
+    sessions = [_Container(id='ses1', parents={'project': 'proj', 'subject': 'sub1'}),
+                _Container(id='ses2', parents={'project': 'proj', 'subject': 'sub1'})]
+    acquisitions = [_Container(id='acq1', parents={'session': 'ses1'}),
+                    _Container(id='acq2', parents={'session': 'ses2'})]
+    return _Client(subjects, sessions, acquisitions)
+
+
+def test_origin_snapshot_enumerates_hierarchy_once():
+    fw_client = _make_client()
+    project = _Container(id='proj', container_type='project')
+    snapshot = OriginSnapshot(fw_client, project)
+
+    assert fw_client.acquisitions.filters == ['parents.project=proj']
+    assert [sub.id for sub in snapshot.subjects()] == ['sub1']
+    assert [ses.id for ses in snapshot.sessions('sub1')] == ['ses1', 'ses2']
+    assert [acq.id for acq in snapshot.acquisitions('ses2')] == ['acq2']
+    assert snapshot.api_calls == 3
+
+    # containers are loaded once and then served from memory
+    assert load_container(_Container(id='ses1'), snapshot).loaded
+    assert load_container(_Container(id='ses1'), snapshot).loaded
+    assert [acq.id for acq in load_acquisitions(_Container(id='ses1'), snapshot)] == ['acq1']
+    assert fw_client.get_calls == ['ses1', 'acq1']
+    assert load_container(project, snapshot) is project
+
+
+def test_origin_snapshot_raises_for_acquisition():
+    with pytest.raises(ValueError):
+        OriginSnapshot(_make_client(), _Container(id='acq', container_type='acquisition'))
+
+
+class _SessionFinder(_Finder):
+    def iter_find(self, filter_str):
+        self.filters.append(filter_str)
+        key, value = filter_str.split('=')
+        return iter([container for container in self.containers
+                     if key == 'parents.project' or container.parents['session'] == value])
+
+
+def test_origin_snapshot_refreshes_modified_sessions():
+    fw_client = _make_client()
+    fw_client.acquisitions = _SessionFinder(fw_client.acquisitions.containers)
+    snapshot = OriginSnapshot(fw_client, _Container(id='proj', container_type='project'))
+    loaded = {
+        'proj': _Container(id='proj', label='reloaded'),
+        'sub1': _Container(id='sub1', parents={'project': 'proj'}),
+        'sub2': _Container(id='sub2', parents={'project': 'proj'}),
+        'ses2': _Container(id='ses2', label='modified', parents={'project': 'proj', 'subject': 'sub1'}),
+        'ses3': _Container(id='ses3', parents={'project': 'proj', 'subject': 'sub2'}),
+    }
+    fw_client.get = lambda container_id: fw_client.get_calls.append(container_id) or loaded[container_id]
+    # ses2 has a new acquisition, and ses3 is a new session of a new subject
+    fw_client.acquisitions.containers.extend([_Container(id='acq3', parents={'session': 'ses2'}),
+                                              _Container(id='acq4', parents={'session': 'ses3'})])
+
+    snapshot.refresh_sessions(['ses2', 'ses3'])
+    assert sorted(fw_client.get_calls) == ['proj', 'ses2', 'ses3', 'sub1', 'sub2']
+    assert fw_client.acquisitions.filters[1:] == ['parents.session=ses2', 'parents.session=ses3']
+    assert snapshot.get('proj').label == 'reloaded'
+    assert [sub.id for sub in snapshot.subjects()] == ['sub1', 'sub2']
+    assert [ses.id for ses in snapshot.sessions('sub1')] == ['ses1', 'ses2']
+    assert snapshot.get('ses2').label == 'modified'
+    assert [ses.id for ses in snapshot.sessions('sub2')] == ['ses3']
+    assert [acq.id for acq in snapshot.acquisitions('ses1')] == ['acq1']
+    assert [acq.id for acq in snapshot.acquisitions('ses2')] == ['acq2', 'acq3']
+    assert [acq.id for acq in snapshot.acquisitions('ses3')] == ['acq4']
+    # the enumeration is not repeated
+    assert fw_client.sessions.filters == ['parents.project=proj']
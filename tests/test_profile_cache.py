@@ -0,0 +1,61 @@
+import shutil
+from pathlib import Path
+
+from deid_export.container_export import load_template_dict
+from deid_export.profile_cache import ProfileCache
+
+DATA_ROOT = Path(__file__).parent / 'data'
+
+
+def test_templates_are_parsed_once_per_content(tmpdir):
+    cache = ProfileCache()
+    parse_count = list()
+
+    def _parse(template_path):
+        parse_count.append(template_path)
+        return load_template_dict(template_path)
+
+    template_path = str(DATA_ROOT / 'example-3-deid-profile.yaml')
+    # a per-subject template written to a new path with the same content
+    copy_path = str(tmpdir.join('subject_example-3-deid-profile.yaml'))
+    shutil.copy(template_path, copy_path)
+    template = cache.get_template(template_path, _parse)
+    template['dicom'] = None
+    assert cache.get_template(copy_path, _parse)['dicom']
+    assert parse_count == [template_path]
+    assert cache.get_counts()['template_cache_hits'] == 1
+
+
+def test_profiles_are_reused_after_release():
+    cache = ProfileCache()
+    template_dict = load_template_dict(str(DATA_ROOT / 'example-3-deid-profile.yaml'))
+    profile_a, export_config, profile_hash = cache.acquire(template_dict)
+    # a profile in use is not handed out again
+    profile_b, _, _ = cache.acquire(template_dict)
+    assert profile_b is not profile_a
+    profile_a.get_file_profile('dicom').record = 'first record'
+    cache.release(profile_hash, profile_a, export_config)
+
+    with cache.checkout(template_dict) as (profile_c, _):
+        assert profile_c is profile_a
+        assert profile_c.get_file_profile('dicom').record is None
+    assert cache.get_counts()['profile_cache_hits'] == 1
+    assert cache.get_counts()['profile_cache_misses'] == 2
+    # load_config does not modify the caller's template
+    assert template_dict == load_template_dict(str(DATA_ROOT / 'example-3-deid-profile.yaml'))
+
+
+def test_least_recently_used_profiles_are_evicted():
+    cache = ProfileCache(max_entries=2)
+    template_dict = load_template_dict(str(DATA_ROOT / 'example-3-deid-profile.yaml'))
+    profiles = dict()
+    for code in ['a', 'b', 'a', 'c']:
+        subject_template = dict(template_dict, export={'subject': {'code': code}})
+        with cache.checkout(subject_template) as (deid_profile, export_config):
+            assert export_config == {'subject': {'code': code}}
+            profiles.setdefault(code, deid_profile)
+    assert cache.get_counts()['profile_cache_evictions'] == 1
+    with cache.checkout(dict(template_dict, export={'subject': {'code': 'a'}})) as (deid_profile, _):
+        assert deid_profile is profiles['a']
+    with cache.checkout(dict(template_dict, export={'subject': {'code': 'b'}})) as (deid_profile, _):
+        assert deid_profile is not profiles['b']
@@ -0,0 +1,56 @@
+import os
+import pstats
+import threading
+import time
+
+import pytest
+
+from deid_export.profiling import ExportProfiler, StackSampler, profile_file, profile_option
+
+
+def _busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_stack_sampler_samples_other_threads(tmpdir):
+    sampler = StackSampler()
+    worker = threading.Thread(target=_busy, args=(0.05,), name='worker')
+    worker.start()
+    sampler.sample()
+    worker.join()
+    assert any(stack.startswith('worker;') and '_busy' in stack for stack in sampler.stack_counts)
+    path = os.path.join(str(tmpdir), 'profile.collapsed')
+    sampler.write_collapsed(path)
+    with open(path) as f_data:
+        assert all(line.rsplit(' ', 1)[1].strip().isdigit() for line in f_data)
+
+
+def test_export_profiler_keeps_slowest_files(tmpdir):
+    with ExportProfiler('files', str(tmpdir), top_n=2):
+        for filename, seconds in [('a.dcm', 0.01), ('b.dcm', 0.05), ('c.dcm', 0.03)]:
+            with profile_file(filename):
+                _busy(seconds)
+    with open(os.path.join(str(tmpdir), 'export_profile_files.txt')) as f_data:
+        report = f_data.read()
+    assert report.index('1. b.dcm') < report.index('2. c.dcm')
+    assert 'a.dcm' not in report
+    pstats.Stats(os.path.join(str(tmpdir), 'export_profile_file_1.pstats'))
+    assert not os.path.exists(os.path.join(str(tmpdir), 'export_profile_file_3.pstats'))
+    assert os.path.exists(os.path.join(str(tmpdir), 'export_profile.collapsed'))
+
+
+def test_profile_option(tmpdir):
+    @profile_option
+    def export(csv_output_path=None):
+        _busy(0.01)
+        return 3
+
+    assert export() == 3
+    csv_output_path = os.path.join(str(tmpdir), 'export.csv')
+    assert export(csv_output_path=csv_output_path, profile='run') == 3
+    stats = pstats.Stats(os.path.join(str(tmpdir), 'export_profile.pstats'))
+    assert any(func_name == '_busy' for _, _, func_name in stats.stats)
+    with pytest.raises(ValueError):
+        export(profile='everything')
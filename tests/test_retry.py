@@ -0,0 +1,89 @@
+import pytest
+
+from deid_export import retry as retry_module
+from deid_export.retry import get_backoff_delay, get_retry_counts, is_retryable, retry
+
+
+class _ApiException(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = list()
+    monkeypatch.setattr(retry_module, '_sleep', delays.append)
+    return delays
+
+
+def test_is_retryable():
+    assert is_retryable(_ApiException(429))
+    assert is_retryable(_ApiException('503'))
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(_ApiException(403))
+    assert not is_retryable(_ApiException('404'))
+    assert not is_retryable(KeyError('missing'))
+
+
+def test_get_backoff_delay():
+    assert get_backoff_delay(0, 0.5, 30, jitter=False) == 0.5
+    assert get_backoff_delay(3, 0.5, 30, jitter=False) == 4
+    assert get_backoff_delay(10, 0.5, 30, jitter=False) == 30
+    for _ in range(10):
+        assert 0 <= get_backoff_delay(3, 0.5, 30) <= 4
+
+
+def test_retry_backs_off_until_success(sleeps):
+    calls = list()
+
+    @retry(5, backoff=1, jitter=False)
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _ApiException(502)
+        return 'ok'
+
+    assert flaky() == 'ok'
+    assert sleeps == [1, 2]
+    counts = get_retry_counts()
+    assert counts[f'retries.{flaky.__qualname__}'] == 2
+    assert counts[f'retry_failures.{flaky.__qualname__}'] == 0
+
+
+def test_retry_does_not_retry_fatal_errors(sleeps):
+    calls = list()
+
+    @retry(5)
+    def forbidden():
+        calls.append(1)
+        raise _ApiException(403)
+
+    with pytest.raises(_ApiException):
+        forbidden()
+    assert len(calls) == 1
+    assert sleeps == []
+    assert get_retry_counts()[f'retry_failures.{forbidden.__qualname__}'] == 1
+
+
+def test_retry_raises_last_exception_when_exhausted(sleeps):
+    @retry(3, backoff=1, jitter=False)
+    def unavailable():
+        raise _ApiException(503)
+
+    with pytest.raises(_ApiException):
+        unavailable()
+    assert sleeps == [1, 2]
+
+
+def test_retry_stops_at_deadline(sleeps):
+    calls = list()
+
+    @retry(10, backoff=1, jitter=False, deadline=3.5)
+    def unavailable():
+        calls.append(1)
+        raise _ApiException(503)
+
+    with pytest.raises(_ApiException):
+        unavailable()
+    # a third retry would wait 4s, beyond the deadline
+    assert len(calls) == 3
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+from deid_export.sharding import get_shard_index, get_shard_path, in_shard, merge_status_csvs, validate_shard
+
+
+def test_shard_assignment_is_stable_and_balanced():
+    # sha1 based, so assignments do not change between processes or python versions
+    assert get_shard_index('subject-a', 4) == 1
+    assert get_shard_index('5e1f0000000000000000000a', 4) == 0
+    counts = [0] * 4
+    for index in range(1000):
+        counts[get_shard_index(f'subject-{index}', 4)] += 1
+    assert min(counts) > 200
+    assert all(in_shard(f'subject-{index}') for index in range(10))
+    assert sum(in_shard('subject-a', shard_index, 3) for shard_index in range(3)) == 1
+
+
+def test_validate_shard():
+    validate_shard(0, 1)
+    validate_shard(3, 4)
+    for shard_index, shard_count in [(1, 1), (-1, 2), (0, 0)]:
+        with pytest.raises(ValueError):
+            validate_shard(shard_index, shard_count)
+
+
+def test_get_shard_path():
+    assert get_shard_path('/out/export.csv', 0, 1) == '/out/export.csv'
+    assert get_shard_path('/out/export.csv', 1, 4) == '/out/export_shard-1-of-4.csv'
+    assert get_shard_path(None, 1, 4) is None
+
+
+def test_merge_status_csvs(tmp_path):
+    shard_paths = [str(tmp_path / f'export_shard-{index}-of-3.csv') for index in range(3)]
+    pd.DataFrame({'origin_parent': ['acq1', 'acq1'], 'origin_filename': ['a.dcm', 'b.dcm'],
+                  'state': ['exported', 'error']}).to_csv(shard_paths[0], index=False)
+    pd.DataFrame({'origin_parent': ['acq2'], 'origin_filename': ['a.dcm'], 'state': ['exported'],
+                  'download_seconds': [0.5]}).to_csv(shard_paths[1], index=False)
+    output_path = str(tmp_path / 'export.csv')
+
+    merged_df, error_counts = merge_status_csvs(shard_paths, output_path)
+
+    assert error_counts == {shard_paths[0]: 1, shard_paths[1]: 0}
+    assert list(merged_df.columns) == ['origin_parent', 'origin_filename', 'state', 'download_seconds']
+    assert pd.read_csv(output_path)['origin_parent'].tolist() == ['acq1', 'acq1', 'acq2']
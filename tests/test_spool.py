@@ -0,0 +1,200 @@
+import os
+import threading
+import time
+
+from deid_export.spool import SPOOL_PREFIX, SpoolError, SpoolManager, spool_option
+
+
+def test_spool_waits_for_budget(tmp_path):
+    spool = SpoolManager(max_bytes=100, base_dir=str(tmp_path))
+    first_path = spool.acquire(60)
+    assert os.path.isdir(first_path)
+    acquired = list()
+    waiter = threading.Thread(target=lambda: acquired.append(spool.acquire(60)))
+    waiter.start()
+    time.sleep(0.1)
+    assert not acquired
+    spool.release(first_path)
+    waiter.join(timeout=5)
+    assert len(acquired) == 1
+    assert not os.path.exists(first_path)
+    assert spool.reserved_bytes == 60
+    # larger than the budget, so it is granted once nothing else is reserved
+    spool.release(acquired[0])
+    oversized_path = spool.acquire(1000)
+    assert spool.max_reserved_bytes == 1000
+    spool.release(oversized_path)
+    assert spool.get_counts()['spool_waits'] == 1
+    assert spool.get_counts()['spool_reservations'] == 3
+
+
+def test_nested_reservations_of_only_reserving_thread_do_not_wait(tmp_path):
+    spool = SpoolManager(max_bytes=100, base_dir=str(tmp_path))
+    with spool.reserve(90) as outer_path:
+        with spool.reserve(90) as inner_path:
+            assert spool.reserved_bytes == 180
+            assert os.path.dirname(inner_path) == os.path.dirname(outer_path)
+    assert spool.reserved_bytes == 0
+    assert spool.get_counts()['spool_waits'] == 0
+
+
+def _run_with_timeout(func, timeout=5):
+    results = list()
+    thread = threading.Thread(target=lambda: results.append(func()), daemon=True)
+    thread.start()
+    thread.join(timeout=timeout)
+    return results
+
+
+def test_reservations_nested_in_acquired_reservation_of_only_reserving_thread_do_not_wait(tmp_path):
+    spool = SpoolManager(max_bytes=300, base_dir=str(tmp_path))
+
+    def _nested():
+        outer_path = spool.acquire(200)
+        with spool.reserve(150):
+            reserved_bytes = spool.reserved_bytes
+        spool.release(outer_path)
+        return reserved_bytes
+
+    assert _run_with_timeout(_nested) == [350]
+    assert spool.reserved_bytes == 0
+    assert not spool._held
+
+
+def test_held_reservation_handed_to_another_thread(tmp_path):
+    spool = SpoolManager(max_bytes=300, base_dir=str(tmp_path))
+    # acquired without being held, as a file's spool directory is by the thread that downloads it
+    file_path = spool.acquire(200, hold=False)
+
+    def _deidentify():
+        with spool.hold(file_path):
+            with spool.reserve(150):
+                return spool.reserved_bytes
+
+    assert _run_with_timeout(_deidentify) == [350]
+    # a thread that does not hold a reservation still waits for space
+    assert _run_with_timeout(lambda: spool.acquire(150), timeout=0.1) == []
+    spool.release(file_path)
+    assert spool.reserved_bytes <= 150
+    assert not spool._held
+
+
+def test_nested_reservations_wait_for_other_threads(tmp_path):
+    spool = SpoolManager(max_bytes=300, base_dir=str(tmp_path))
+    other_path = spool.acquire(100)
+    # queued behind the nested reservation, which waits ahead of it
+    queued = list()
+
+    def _nested():
+        with spool.reserve(150):
+            threading.Thread(target=lambda: queued.append(spool.acquire(100)), daemon=True).start()
+            time.sleep(0.1)
+            with spool.reserve(100):
+                return spool.reserved_bytes
+
+    nested = list()
+    nested_thread = threading.Thread(target=lambda: nested.append(_nested()), daemon=True)
+    nested_thread.start()
+    time.sleep(0.3)
+    assert not nested
+    assert not queued
+    spool.release(other_path)
+    nested_thread.join(timeout=5)
+    assert nested == [250]
+    for _ in range(50):
+        if queued:
+            break
+        time.sleep(0.1)
+    assert len(queued) == 1
+    assert spool.reserved_bytes == 100
+    assert spool.get_counts()['spool_waits'] == 2
+
+
+def test_nested_reservations_waiting_on_each_other_fail(tmp_path):
+    spool = SpoolManager(max_bytes=300, base_dir=str(tmp_path))
+    first_waiting = threading.Event()
+    results = list()
+
+    def _nested(index):
+        try:
+            with spool.reserve(100):
+                if index:
+                    first_waiting.wait(timeout=5)
+                    time.sleep(0.1)
+                else:
+                    threading.Thread(target=lambda: results.append(_nested(1)), daemon=True).start()
+                    time.sleep(0.1)
+                    first_waiting.set()
+                with spool.reserve(150):
+                    return 'reserved'
+        except SpoolError:
+            return 'failed'
+
+    assert _run_with_timeout(lambda: _nested(0)) == ['reserved']
+    for _ in range(50):
+        if results:
+            break
+        time.sleep(0.1)
+    assert results == ['failed']
+    assert spool.reserved_bytes == 0
+
+
+def test_extend_waits_for_budget(tmp_path):
+    spool = SpoolManager(max_bytes=300, base_dir=str(tmp_path))
+    file_path = spool.acquire(100, hold=False)
+    other_path = spool.acquire(150)
+    assert _run_with_timeout(lambda: spool.extend(file_path, 100), timeout=0.1) == []
+    spool.release(other_path)
+    for _ in range(50):
+        if spool.reserved_bytes == 200:
+            break
+        time.sleep(0.1)
+    assert spool.reserved_bytes == 200
+    # larger than the budget, so it is granted once nothing else is reserved
+    assert _run_with_timeout(lambda: spool.extend(file_path, 1000)) == [None]
+    spool.release(file_path)
+    assert spool.reserved_bytes == 0
+
+
+def test_cleanup_and_stale_dirs(tmp_path):
+    # a pid that is not running
+    dead_pid = 4194304
+    while True:
+        try:
+            os.kill(dead_pid, 0)
+            dead_pid -= 1
+        except ProcessLookupError:
+            break
+        except PermissionError:
+            dead_pid -= 1
+    stale_dir = tmp_path / f'{SPOOL_PREFIX}{dead_pid}_abc'
+    stale_dir.mkdir()
+    (stale_dir / 'a.dcm').write_bytes(b'123')
+    spool = SpoolManager()
+    spool.configure(base_dir=str(tmp_path))
+    assert not stale_dir.exists()
+    assert spool.get_counts()['spool_stale_dirs_removed'] == 1
+
+    spool.acquire(10)
+    assert len(os.listdir(str(tmp_path))) == 1
+    spool.cleanup()
+    assert os.listdir(str(tmp_path)) == []
+    assert spool.reserved_bytes == 0
+
+
+def test_spool_option_cleans_up_on_error(tmp_path):
+    from deid_export.spool import SPOOL
+
+    @spool_option
+    def _export():
+        SPOOL.acquire(10)
+        assert SPOOL.max_bytes == 50
+        raise KeyboardInterrupt
+
+    try:
+        _export(spool_max_bytes=50, spool_dir=str(tmp_path))
+    except KeyboardInterrupt:
+        pass
+    assert os.listdir(str(tmp_path)) == []
+    assert SPOOL.reserved_bytes == 0
+    SPOOL.configure()
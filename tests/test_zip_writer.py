@@ -0,0 +1,123 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from deid_export.zip_writer import is_member_unchanged, open_output_zip, validate_compression, write_members
+
+
+class _UnseekableBuffer(io.RawIOBase):
+    """A write-only stream, to which zipfile writes members with data descriptors"""
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def _make_zip(path, members, comment=b''):
+    with zipfile.ZipFile(path, 'w') as zipf:
+        zipf.comment = comment
+        for name, data, compress_type in members:
+            zipf.writestr(name, data, compress_type=compress_type)
+
+
+def test_copied_members_keep_their_data_and_compression(tmpdir):
+    src_path = str(tmpdir.join('src.zip'))
+    _make_zip(src_path, [
+        ('dir/', b'', zipfile.ZIP_STORED),
+        ('dir/a.txt', b'a' * 1000, zipfile.ZIP_DEFLATED),
+        ('b.txt', b'b' * 10, zipfile.ZIP_STORED),
+    ], comment=b'comment')
+    out_path = str(tmpdir.join('out.zip'))
+    with zipfile.ZipFile(src_path) as zin, open_output_zip(out_path) as zout:
+        zout.comment = zin.comment
+        write_members(zin, zout, [(zip_item, None) for zip_item in zin.infolist()])
+
+    with zipfile.ZipFile(src_path) as zin, zipfile.ZipFile(out_path) as zout:
+        assert zout.testzip() is None
+        assert zout.comment == b'comment'
+        assert [info.filename for info in zout.infolist()] == ['dir/', 'dir/a.txt', 'b.txt']
+        assert [info.compress_type for info in zout.infolist()] == [info.compress_type for info in zin.infolist()]
+        assert [info.date_time for info in zout.infolist()] == [info.date_time for info in zin.infolist()]
+        assert all(zout.read(name) == zin.read(name) for name in zin.namelist())
+
+
+def test_copied_members_drop_data_descriptors(tmpdir):
+    stream = _UnseekableBuffer()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+        with zipf.open('a.txt', 'w') as f_data:
+            f_data.write(b'a' * 1000)
+    src_path = str(tmpdir.join('src.zip'))
+    with open(src_path, 'wb') as f_data:
+        f_data.write(stream.buffer.getvalue())
+    with zipfile.ZipFile(src_path) as zin:
+        assert zin.getinfo('a.txt').flag_bits & 0x08
+
+    out_path = str(tmpdir.join('out.zip'))
+    with zipfile.ZipFile(src_path) as zin, open_output_zip(out_path) as zout:
+        write_members(zin, zout, [(zip_item, None) for zip_item in zin.infolist()])
+    with zipfile.ZipFile(out_path) as zout:
+        assert zout.testzip() is None
+        assert not zout.getinfo('a.txt').flag_bits & 0x08
+        assert zout.read('a.txt') == b'a' * 1000
+
+
+@pytest.mark.parametrize('compression_workers', [1, 3])
+def test_replaced_members_use_output_compression(tmpdir, compression_workers):
+    src_path = str(tmpdir.join('src.zip'))
+    names = [f'{index}.txt' for index in range(8)]
+    _make_zip(src_path, [(name, b'original', zipfile.ZIP_STORED) for name in names])
+    members = list()
+    with zipfile.ZipFile(src_path) as zin:
+        for index, zip_item in enumerate(zin.infolist()):
+            if index % 2:
+                members.append((zip_item, None))
+                continue
+            file_path = str(tmpdir.join(zip_item.filename))
+            with open(file_path, 'wb') as f_data:
+                f_data.write(zip_item.filename.encode() * 100)
+            members.append((zip_item, file_path))
+        out_path = str(tmpdir.join('out.zip'))
+        with open_output_zip(out_path, compression='deflate', compresslevel=9) as zout:
+            write_members(zin, zout, members, compression_workers=compression_workers)
+
+    with zipfile.ZipFile(out_path) as zout:
+        assert zout.testzip() is None
+        assert zout.namelist() == names
+        for index, info in enumerate(zout.infolist()):
+            if index % 2:
+                assert info.compress_type == zipfile.ZIP_STORED
+                assert zout.read(info) == b'original'
+            else:
+                assert info.compress_type == zipfile.ZIP_DEFLATED
+                assert zout.read(info) == info.filename.encode() * 100
+
+
+def test_is_member_unchanged(tmpdir):
+    src_path = str(tmpdir.join('src.zip'))
+    _make_zip(src_path, [('a.txt', b'abc', zipfile.ZIP_DEFLATED)])
+    file_path = str(tmpdir.join('a.txt'))
+    with zipfile.ZipFile(src_path) as zin:
+        zip_item = zin.getinfo('a.txt')
+        with open(file_path, 'wb') as f_data:
+            f_data.write(b'abc')
+        assert is_member_unchanged(file_path, zip_item)
+        with open(file_path, 'wb') as f_data:
+            f_data.write(b'abd')
+        assert not is_member_unchanged(file_path, zip_item)
+        os.remove(file_path)
+        assert not is_member_unchanged(file_path, zip_item)
+
+
+def test_validate_compression():
+    validate_compression('stored')
+    validate_compression('deflate', 9)
+    with pytest.raises(ValueError):
+        validate_compression('bzip2')
+    with pytest.raises(ValueError):
+        validate_compression('deflate', 10)